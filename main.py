@@ -39,10 +39,29 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 import requests
 import warnings
+import json
+import math
+import argparse
+import contextlib
 from datetime import datetime, timedelta
 import time as time_module
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+import hashlib
+import itertools
+import pickle
 
 warnings.filterwarnings('ignore')
 
@@ -51,161 +70,885 @@ warnings.filterwarnings('ignore')
 # بخش ۱: دریافت داده‌های CAKE/BNB - اصلاح‌شده برای ۱ سال کامل
 # ═══════════════════════════════════════════════════════════
 
-def get_pancakeswap_pair_data(target_days=365):
+BINANCE_KLINES_URL = 'https://api.binance.com/api/v3/klines'
+
+
+def _silent(*args, **kwargs):
+    """جایگزین print در حالت verbose=False"""
+
+
+# طول هر کندل بر حسب میلی‌ثانیه (برای محاسبه endTime دسته‌ها)
+INTERVAL_MS = {
+    '1m': 60_000,
+    '5m': 300_000,
+    '15m': 900_000,
+    '1h': 3_600_000,
+    '4h': 14_400_000,
+    '1d': 86_400_000,
+}
+
+DAY_MS = 86_400_000
+
+
+def periods_per_day(interval):
+    """تعداد کندل در یک روز ('1h' → 24، '5m' → 288، '1m' → 1440)"""
+    return DAY_MS // INTERVAL_MS[interval]
+
+
+def infer_periods_per_day(price_data):
     """
-    دریافت داده‌های CAKE/BNB برای PancakeSwap - حداقل ۱ سال
+    تعداد کندل در روز از فاصله timestamp های price_data (میانه فاصله
+    حداکثر ۱۰۰۰ کندل اول؛ مقاوم در برابر چند سوراخ). کمتر از ۲ ردیف → 24
+    """
+    if isinstance(price_data, PriceArrays):
+        return price_data.periods_per_day
+    timestamps = price_data['timestamp']
+    if len(timestamps) < 2:
+        return 24
+    head = timestamps.iloc[:1001].to_numpy(dtype='datetime64[ms]')
+    step_ms = float(np.median(np.diff(head).astype(np.int64)))
+    return DAY_MS / step_ms if step_ms > 0 else 24
 
-    تغییرات:
-    - تعداد دورهای درخواست افزایش یافته تا ۱ سال پوشش دهد
-    - هر درخواست ۱۰۰۰ کندل ساعتی = ~۴۱.۶ روز
-    - برای ۳۶۵ روز: حداقل ۹ درخواست (۹ × ۱۰۰۰ = ۹۰۰۰ ساعت = ۳۷۵ روز)
-    - ۱۲ درخواست می‌زنیم تا مطمئن شویم (≈۵۰۰ روز پوشش)
+
+class TokenBucket:
     """
-    print("📥 دریافت داده‌های CAKE/BNB برای PancakeSwap...")
-    print(f"   🎯 هدف: {target_days} روز ({target_days * 24} کندل ساعتی)")
+    محدودکننده نرخ درخواست (token bucket) - thread-safe.
 
-    url = 'https://api.binance.com/api/v3/klines'
+    rate:     تعداد توکن در ثانیه
+    capacity: حداکثر توکن ذخیره (اندازه burst)
+    """
 
-    # تعداد کندل مورد نیاز
-    target_candles = target_days * 24
-    # تعداد دورهای لازم (هر دور ۱۰۰۰ کندل)
-    num_batches = (target_candles // 1000) + 2  # +2 برای اطمینان
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time_module.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """صبر تا آزاد شدن یک توکن"""
+        while True:
+            with self.lock:
+                now = time_module.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time_module.sleep(wait)
+
+
+def _make_http_session(pool_size=8):
+    """یک Session مشترک با connection pool (به جای اتصال جدید برای هر درخواست)"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    print(f"   📡 تعداد درخواست‌ها: {num_batches} (هر کدام ۱۰۰۰ کندل)")
 
-    # ─── دریافت CAKE/USDT ───
-    all_cake = []
-    current_end_time = int(datetime.now().timestamp() * 1000)
+class _RateLimited(Exception):
+    """پاسخ 429/418 از Binance (همراه با Retry-After)"""
 
-    print(f"\n   دریافت CAKE/USDT...")
-    for i in range(num_batches):
-        params = {
-            'symbol': 'CAKEUSDT',
-            'interval': '1h',
-            'limit': 1000,
-            'endTime': current_end_time
-        }
-        try:
-            response = requests.get(url, params=params, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            if not data or len(data) == 0:
-                print(f"      ⚠ بخش {i + 1}: داده‌ای نیست، توقف")
-                break
-            all_cake = data + all_cake
-            # زمان پایان بعدی = زمان شروع اولین کندل دریافتی - ۱ms
-            current_end_time = data[0][0] - 1
-            print(f"      ✓ بخش {i + 1}/{num_batches} "
-                  f"({len(data)} کندل، مجموع: {len(all_cake)})")
-            time_module.sleep(0.1)  # احترام به rate limit
-        except Exception as e:
-            print(f"      ✗ خطا در بخش {i + 1}: {e}")
-            time_module.sleep(1)
-            continue
-
-    # ─── دریافت BNB/USDT ───
-    all_bnb = []
-    current_end_time = int(datetime.now().timestamp() * 1000)
-
-    print(f"\n   دریافت BNB/USDT...")
-    for i in range(num_batches):
-        params = {
-            'symbol': 'BNBUSDT',
-            'interval': '1h',
-            'limit': 1000,
-            'endTime': current_end_time
-        }
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _is_retryable(error):
+    """
+    خطاهای گذرا: rate limit، پاسخ 5xx و خطای اتصال/timeout.
+    بقیه (مثلاً 400 برای نماد یا interval نامعتبر) هیچ‌وقت درست نمی‌شوند.
+    """
+    if isinstance(error, (_RateLimited, requests.ConnectionError,
+                          requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is not None and response.status_code >= 500
+    return False
+
+
+def _fetch_klines_batch(session, url, symbol, interval, window, limiter,
+                        limit=1000, max_retries=5, backoff=0.5, log=print):
+    """
+    دریافت یک دسته کندل با retry و backoff نمایی.
+
+    window = (startTime, endTime) بر حسب ms (هر دو شامل)
+
+    به جای `continue` (که بی‌صدا شکاف در داده می‌گذاشت)، در صورت شکست
+    گذرا (_is_retryable) دوباره تلاش می‌شود و بعد از max_retries خطا
+    بالا برده می‌شود؛ خطاهای دائمی (4xx) بلافاصله بالا می‌روند.
+    log: تابع گزارش (print یا _silent طبق verbose فراخواننده)
+    """
+    start_time, end_time = window
+    params = {
+        'symbol': symbol,
+        'interval': interval,
+        'limit': limit,
+        'startTime': start_time,
+        'endTime': end_time
+    }
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        started = time_module.perf_counter()
         try:
-            response = requests.get(url, params=params, timeout=15)
+            response = session.get(url, params=params, timeout=15)
+            if response.status_code in (418, 429):
+                raise _RateLimited(
+                    float(response.headers.get('Retry-After') or 0)
+                )
             response.raise_for_status()
             data = response.json()
-            if not data or len(data) == 0:
-                print(f"      ⚠ بخش {i + 1}: داده‌ای نیست، توقف")
-                break
-            all_bnb = data + all_bnb
-            current_end_time = data[0][0] - 1
-            print(f"      ✓ بخش {i + 1}/{num_batches} "
-                  f"({len(data)} کندل، مجموع: {len(all_bnb)})")
-            time_module.sleep(0.1)
+            METRICS.observe('http_request',
+                            time_module.perf_counter() - started, symbol)
+            return data
         except Exception as e:
-            print(f"      ✗ خطا در بخش {i + 1}: {e}")
-            time_module.sleep(1)
-            continue
+            METRICS.observe('http_request',
+                            time_module.perf_counter() - started, symbol,
+                            failed=True)
+            if not _is_retryable(e):
+                METRICS.count('http_failures')
+                log(f"      ✗ {symbol}: خطای غیرقابل تکرار در "
+                    f"endTime={end_time}: {e}")
+                raise
+            if attempt == max_retries:
+                METRICS.count('http_failures')
+                log(f"      ✗ {symbol}: خطا در endTime={end_time} "
+                    f"بعد از {max_retries + 1} تلاش: {e}")
+                raise
+            METRICS.count('http_retries')
+            delay = backoff * (2 ** attempt)
+            if isinstance(e, _RateLimited):
+                METRICS.count('http_rate_limited')
+                delay = max(delay, e.retry_after)
+            log(f"      ↻ {symbol}: تلاش مجدد {attempt + 1}/{max_retries} "
+                f"بعد از {delay:.1f}s ({e})")
+            time_module.sleep(delay)
+
+
+def _split_range_windows(ranges, window_ms):
+    """
+    تقسیم بازه‌های [start, end] (ms، شامل) به پنجره‌های حداکثر window_ms.
+    Returns: لیست (start, end) مرتب از قدیم به جدید
+    """
+    windows = []
+    for start, end in ranges:
+        while start <= end:
+            windows.append((start, min(start + window_ms - 1, end)))
+            start += window_ms
+    return windows
 
-    if len(all_cake) == 0 or len(all_bnb) == 0:
-        raise ValueError("❌ داده‌ای دریافت نشد! اتصال اینترنت را بررسی کنید.")
 
-    # ─── ساخت DataFrame ───
-    cols = [
-        'timestamp', 'open', 'high', 'low', 'close', 'volume',
-        'close_time', 'quote_volume', 'trades', 'taker_buy_base',
-        'taker_buy_quote', 'ignore'
-    ]
+# ستون‌هایی از هر kline که نگه داشته می‌شوند (بقیه دور ریخته می‌شوند)
+KLINE_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('quote_volume', '<f8'),
+])
+
+# شماره ستون هر فیلد در پاسخ JSON بایننس
+_KLINE_JSON_COLUMNS = {'high': 2, 'low': 3, 'close': 4, 'quote_volume': 7}
+
+
+def _klines_to_array(rows, out=None):
+    """
+    تبدیل یک دسته kline JSON (۱۲ ستونی، رشته) به آرایه KLINE_DTYPE.
+
+    out: بافر از پیش تخصیص‌یافته؛ اگر داده شود ردیف‌ها مستقیم در
+    out[:len(rows)] نوشته می‌شوند (بدون لیست میانی برای کل داده)
+    """
+    n = len(rows)
+    arr = np.empty(n, dtype=KLINE_DTYPE) if out is None else out[:n]
+    if n:
+        arr['timestamp'] = np.fromiter((row[0] for row in rows),
+                                       dtype=np.int64, count=n)
+        for name, col in _KLINE_JSON_COLUMNS.items():
+            arr[name] = np.fromiter((row[col] for row in rows),
+                                    dtype=np.float64, count=n)
+    return arr
+
+
+def _as_kline_dtype(arr):
+    """تبدیل بر اساس نام فیلد (astype ساختاریافته بر اساس موقعیت است)"""
+    if arr.dtype == KLINE_DTYPE:
+        return arr
+    out = np.empty(len(arr), dtype=KLINE_DTYPE)
+    for name in KLINE_DTYPE.names:
+        out[name] = arr[name]
+    return out
+
+
+def _download_windows(windows_by_symbol, interval='1h',
+                      base_url=BINANCE_KLINES_URL, max_workers=8,
+                      rate_per_sec=10, limit=1000, verbose=True):
+    """
+    دانلود همزمان پنجره‌های از پیش محاسبه‌شده برای چند نماد.
+
+    windows_by_symbol = {symbol: [(start_ms, end_ms), ...]}  (قدیم → جدید)
+
+    هر پاسخ JSON بلافاصله در بافر از پیش تخصیص‌یافته (limit ردیف به ازای
+    هر پنجره) decode می‌شود و دور ریخته می‌شود؛ هیچ‌وقت لیست کل کندل‌ها
+    ساخته نمی‌شود.
+
+    Returns: {symbol: آرایه KLINE_DTYPE} مرتب از قدیم به جدید
+    """
+    log = print if verbose else _silent
+    limiter = TokenBucket(rate_per_sec)
+    buffers = {symbol: np.empty(len(windows) * limit, dtype=KLINE_DTYPE)
+               for symbol, windows in windows_by_symbol.items()}
+    counts = {symbol: np.zeros(len(windows), dtype=np.int64)
+              for symbol, windows in windows_by_symbol.items()}
+    done = {symbol: 0 for symbol in windows_by_symbol}
+    progress_lock = threading.Lock()
+
+    def fetch(symbol, k):
+        with METRICS.stage('download_batch', symbol):
+            data = _fetch_klines_batch(session, base_url, symbol, interval,
+                                       windows_by_symbol[symbol][k], limiter,
+                                       limit=limit, log=log) or []
+            rows = data[:limit]
+            _klines_to_array(rows, out=buffers[symbol][k * limit:])
+        counts[symbol][k] = len(rows)
+        METRICS.count('rows_downloaded', len(rows))
+        if verbose:
+            with progress_lock:
+                done[symbol] += 1
+                print(f"      ✓ {symbol} بخش {done[symbol]}/"
+                      f"{len(counts[symbol])} ({len(rows)} کندل)")
+
+    with METRICS.stage('download'), \
+            _make_http_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, symbol, k)
+                   for symbol, windows in windows_by_symbol.items()
+                   for k in range(len(windows))]
+        for future in futures:
+            future.result()  # خطای نهایی (بعد از retry) اینجا بالا می‌آید
+
+    # فشرده‌سازی: فقط ردیف‌های پرشده هر پنجره
+    result = {}
+    for symbol, buffer in buffers.items():
+        filled = np.zeros(len(buffer), dtype=bool)
+        for k, count in enumerate(counts[symbol]):
+            filled[k * limit:k * limit + count] = True
+        result[symbol] = buffer[filled]
+    return result
+
+
+def download_klines(symbols, num_batches, interval='1h', end_time=None,
+                    base_url=BINANCE_KLINES_URL, max_workers=8,
+                    rate_per_sec=10, limit=1000, verbose=True):
+    """
+    دانلود همزمان کندل‌های چند نماد.
+
+    - پنجره همه دسته‌ها از قبل محاسبه می‌شود:
+      [end_time - (k+1) × limit × interval, end_time - k × limit × interval)
+      پس دسته‌ها مستقل‌اند و موازی ارسال می‌شوند
+    - یک Session مشترک (connection pool) برای همه درخواست‌ها
+    - token bucket برای رعایت rate limit
+    - base_url قابل تنظیم (مثلاً برای سرور stub محلی)
+
+    Returns: {symbol: آرایه KLINE_DTYPE} مرتب از قدیم به جدید
+    """
+    if end_time is None:
+        end_time = int(datetime.now().timestamp() * 1000)
+    window_ms = limit * INTERVAL_MS[interval]
+    windows = _split_range_windows(
+        [(end_time - num_batches * window_ms + 1, end_time)], window_ms
+    )
+    return _download_windows(
+        {symbol: windows for symbol in symbols}, interval=interval,
+        base_url=base_url, max_workers=max_workers,
+        rate_per_sec=rate_per_sec, limit=limit, verbose=verbose
+    )
+
 
-    df_cake = pd.DataFrame(all_cake, columns=cols)
-    df_bnb = pd.DataFrame(all_bnb, columns=cols)
+# ─── کش محلی کندل‌ها ───
 
-    for df_temp in [df_cake, df_bnb]:
-        df_temp['timestamp'] = pd.to_datetime(df_temp['timestamp'], unit='ms')
-        for col in ['close', 'high', 'low', 'volume', 'quote_volume']:
-            df_temp[col] = df_temp[col].astype(float)
+KLINE_CACHE_DIR = '.kline_cache'
 
-    # حذف تکراری‌ها
-    df_cake = df_cake.drop_duplicates(subset='timestamp').set_index('timestamp')
-    df_bnb = df_bnb.drop_duplicates(subset='timestamp').set_index('timestamp')
 
-    # ترکیب
-    df = pd.DataFrame()
-    df['cake_usdt'] = df_cake['close']
-    df['bnb_usdt'] = df_bnb['close']
-    df['cake_volume'] = df_cake['quote_volume']
-    df['bnb_volume'] = df_bnb['quote_volume']
-    df = df.dropna()
+def _missing_timestamp_ranges(ts, start_time, end_time, interval_ms):
+    """
+    بازه‌های [start, end] بدون کندل در timestamp های مرتب ts، محدود به
+    [start_time, end_time]: ابتدا، سوراخ‌های میانی و انتها.
+    """
+    ts = ts[(ts >= start_time) & (ts <= end_time)]
+    if len(ts) == 0:
+        return [(start_time, end_time)]
+    ranges = []
+    if ts[0] > start_time:
+        ranges.append((start_time, int(ts[0]) - interval_ms))
+    holes = np.flatnonzero(np.diff(ts) > interval_ms)
+    ranges.extend((int(ts[i]) + interval_ms, int(ts[i + 1]) - interval_ms)
+                  for i in holes)
+    if ts[-1] < end_time:
+        ranges.append((int(ts[-1]) + interval_ms, end_time))
+    return ranges
+
+
+class KlineCache:
+    """
+    کش دائمی کندل‌ها روی دیسک - یک فایل به ازای (symbol, interval).
+
+    - داده: آرایه ساختاریافته KLINE_DTYPE در فایل .npy
+      (با np.load(mmap_mode='r') بدون کپی خوانده می‌شود)
+    - متا: فایل .json کنار آن؛ شکاف‌هایی که Binance واقعاً داده ندارد
+      (قبل از لیست شدن، توقف صرافی) تا هر بار دوباره درخواست نشوند
+    """
+
+    def __init__(self, cache_dir=KLINE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, symbol, interval, ext):
+        return os.path.join(self.cache_dir, f'{symbol}_{interval}.{ext}')
+
+    def load(self, symbol, interval, mmap=False):
+        """کندل‌های کش‌شده (مرتب، بدون تکرار) یا آرایه خالی"""
+        path = self._path(symbol, interval, 'npy')
+        if not os.path.exists(path):
+            return np.empty(0, dtype=KLINE_DTYPE)
+        return _as_kline_dtype(
+            np.load(path, mmap_mode='r' if mmap else None)
+        )
+
+    def known_gaps(self, symbol, interval):
+        path = self._path(symbol, interval, 'json')
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding='utf-8') as f:
+            return [tuple(g) for g in json.load(f).get('known_gaps', [])]
+
+    def add_known_gaps(self, symbol, interval, gaps):
+        if not gaps:
+            return
+        merged = sorted(set(self.known_gaps(symbol, interval)) |
+                        {tuple(int(x) for x in g) for g in gaps})
+        self._atomic_write(
+            self._path(symbol, interval, 'json'),
+            lambda f: f.write(json.dumps({'known_gaps': merged}).encode())
+        )
+
+    def merge(self, symbol, interval, new_rows):
+        """افزودن کندل‌های جدید به کش (نسخه جدید هر timestamp برنده است)"""
+        cached = self.load(symbol, interval)
+        merged = np.concatenate([_as_kline_dtype(new_rows), cached])
+        _, first_idx = np.unique(merged['timestamp'], return_index=True)
+        merged = merged[first_idx]  # np.unique خروجی مرتب می‌دهد
+        del cached
+        self._atomic_write(self._path(symbol, interval, 'npy'),
+                           lambda f: np.save(f, merged))
+        return merged
+
+    def missing_ranges(self, symbol, interval, start_time, end_time):
+        """
+        بازه‌های [start, end] (زمان باز شدن کندل، ms) که در کش نیستند:
+        ابتدای بازه، سوراخ‌های میانی و کندل‌های جدیدتر از آخرین کش،
+        منهای شکاف‌های شناخته‌شده (known_gaps). شکاف فقط وقتی ثبت می‌شود
+        که کندلی بعد از آن وجود داشته باشد، پس کندل‌های جدیدتر از آخرین
+        کش همیشه دوباره درخواست می‌شوند.
+        """
+        ts = self.load(symbol, interval, mmap=True)['timestamp']
+        known = self.known_gaps(symbol, interval)
+        return [(a, b) for a, b in _missing_timestamp_ranges(
+                    ts, start_time, end_time, INTERVAL_MS[interval])
+                if not any(ka <= a and b <= kb for ka, kb in known)]
+
+    @staticmethod
+    def _atomic_write(path, writer):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            writer(f)
+        os.replace(tmp_path, path)
+
+
+def load_klines_cached(symbols, interval, start_time, end_time=None,
+                       cache_dir=KLINE_CACHE_DIR, offline=False,
+                       limit=1000, verbose=True, **download_kwargs):
+    """
+    کندل‌های [start_time, end_time] از کش محلی + دانلود فقط بخش‌های کم.
+
+    - اجرای اول: کل بازه دانلود و ذخیره می‌شود
+    - اجراهای بعدی: فقط کندل‌های جدیدتر از آخرین کش و سوراخ‌ها
+    - فقط کندل‌های بسته‌شده ذخیره می‌شوند (کندل جاری ناقص است)
+    - offline=True → بدون شبکه، فقط از کش
+
+    Returns: {symbol: آرایه KLINE_DTYPE}
+    """
+    interval_ms = INTERVAL_MS[interval]
+    if end_time is None:
+        end_time = int(datetime.now().timestamp() * 1000)
+    # زمان باز شدن آخرین کندل بسته‌شده و اولین کندل بازه (هم‌تراز با interval)
+    last_open = (end_time // interval_ms) * interval_ms - interval_ms
+    first_open = -(-start_time // interval_ms) * interval_ms
+
+    cache = KlineCache(cache_dir)
+    missing = {
+        symbol: cache.missing_ranges(symbol, interval, first_open, last_open)
+        for symbol in symbols
+    }
+    windows = {
+        symbol: _split_range_windows(ranges, limit * interval_ms)
+        for symbol, ranges in missing.items()
+    }
+
+    if verbose:
+        for symbol in symbols:
+            cached_rows = len(cache.load(symbol, interval, mmap=True))
+            print(f"      💾 {symbol}: {cached_rows:,} کندل در کش، "
+                  f"{len(windows[symbol])} درخواست برای "
+                  f"{len(missing[symbol])} بازه ناقص")
+
+    if not offline and any(windows.values()):
+        fetched = _download_windows(
+            {symbol: w for symbol, w in windows.items() if w},
+            interval=interval, limit=limit, verbose=verbose, **download_kwargs
+        )
+        for symbol, arr in fetched.items():
+            arr = arr[arr['timestamp'] <= last_open]
+            merged = cache.merge(symbol, interval, arr)
+            # هر چه بعد از دانلود هنوز کم است و کندل کش‌شده‌ای بعد از آن
+            # هست (قبل از لیست شدن، توقف صرافی)، در Binance وجود ندارد.
+            # انتهای خالی (تأخیر صرافی، پاسخ خالی موقت) ثبت نمی‌شود تا
+            # اجرای بعد دوباره درخواست شود
+            if len(merged):
+                last_cached = int(merged['timestamp'][-1])
+                cache.add_known_gaps(symbol, interval, [
+                    (a, b) for a, b in cache.missing_ranges(
+                        symbol, interval, first_open, last_open)
+                    if b < last_cached
+                ])
+
+    result = {}
+    for symbol in symbols:
+        arr = cache.load(symbol, interval, mmap=True)
+        mask = (arr['timestamp'] >= first_open) & (arr['timestamp'] <= last_open)
+        result[symbol] = np.array(arr[mask])
+        METRICS.count('kline_rows_loaded', len(result[symbol]))
+    return result
+
+
+def _fetch_leg_klines(symbols, target_days, interval='1h',
+                      base_url=BINANCE_KLINES_URL, max_workers=8,
+                      rate_per_sec=10, use_cache=True,
+                      cache_dir=KLINE_CACHE_DIR, offline=False, verbose=True):
+    """
+    دریافت کندل‌های چند نماد (leg) در یک مرحله - هر نماد یک بار.
+
+    Returns: {symbol: آرایه KLINE_DTYPE}
+    """
+    log = print if verbose else _silent
+
+    # تعداد کندل مورد نیاز
+    target_candles = target_days * periods_per_day(interval)
+    # تعداد دورهای لازم (هر دور ۱۰۰۰ کندل)
+    num_batches = (target_candles // 1000) + 2  # +2 برای اطمینان
+
+    download_kwargs = {
+        'base_url': base_url,
+        'max_workers': max_workers,
+        'rate_per_sec': rate_per_sec,
+    }
+
+    if use_cache:
+        end_time = int(datetime.now().timestamp() * 1000)
+        start_time = end_time - num_batches * 1000 * INTERVAL_MS[interval]
+        return load_klines_cached(
+            symbols, interval, start_time, end_time,
+            cache_dir=cache_dir, offline=offline, verbose=verbose,
+            **download_kwargs
+        )
+    log(f"   📡 تعداد درخواست‌ها: {num_batches} × {len(symbols)} نماد "
+        f"(هر کدام ۱۰۰۰ کندل، {max_workers} اتصال همزمان)")
+    return download_klines(
+        symbols, num_batches, interval=interval, verbose=verbose,
+        **download_kwargs
+    )
+
+
+GAP_POLICIES = ('drop', 'ffill', 'split')
+
+
+def _missing_runs(missing):
+    """(شروع، پایان شامل) دنباله‌های پیوسته True در آرایه bool"""
+    edges = np.diff(np.concatenate(([0], missing.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+
+def align_pair_legs(arr0, arr1, interval='1h', gap_policy='drop',
+                    max_fill=None, labels=('CAKE', 'BNB')):
+    """
+    هم‌ترازی دو leg روی timestamp صحیح (ms) با ادغام مرتب.
+
+    محور زمان = شبکه کامل interval در بازه مشترک دو leg؛ جای هر کندل
+    هر leg با searchsorted (آرایه‌های مرتب) پیدا می‌شود، پس روی داده
+    چندساله دقیقه‌ای هم فقط چند عمل برداری است.
+
+    gap_policy:
+        'drop'  → فقط کندل‌هایی که هر دو leg دارند (رفتار قبلی join + dropna)
+        'ffill' → کندل گم‌شده با آخرین قیمت همان leg پر می‌شود (حجم صفر)؛
+                  max_fill = حداکثر طول سوراخ قابل پر کردن (کندل)، بیشتر → drop
+        'split' → مثل drop + ستون segment که بعد از هر سوراخ یکی زیاد می‌شود
+                  (run_backtest_segmented هر بخش را جدا اجرا می‌کند)
+
+    Returns: (dict ستون → آرایه با timestamp به ms، DataFrame گزارش سوراخ‌ها)
+    """
+    if gap_policy not in GAP_POLICIES:
+        raise ValueError(f"❌ سیاست ناشناخته: {gap_policy!r} "
+                         f"(مجاز: {', '.join(GAP_POLICIES)})")
+    interval_ms = INTERVAL_MS[interval]
+
+    # مرتب‌سازی + حذف تکراری‌ها (اولین رخداد) فقط اگر لازم باشد
+    legs = []
+    for arr in (arr0, arr1):
+        ts = arr['timestamp']
+        if len(ts) > 1 and not (ts[1:] > ts[:-1]).all():
+            _, first = np.unique(ts, return_index=True)
+            arr = arr[first]
+        legs.append(arr)
+    ts0, ts1 = legs[0]['timestamp'], legs[1]['timestamp']
+    if len(ts0) == 0 or len(ts1) == 0:
+        raise ValueError(f"❌ leg خالی: {labels[0]} {len(ts0)} کندل، "
+                         f"{labels[1]} {len(ts1)} کندل")
+
+    start = max(ts0[0], ts1[0])
+    end = min(ts0[-1], ts1[-1])
+    if end < start:
+        def span(ts):
+            return (f"{pd.to_datetime(ts[0], unit='ms')} → "
+                    f"{pd.to_datetime(ts[-1], unit='ms')}")
+        raise ValueError(f"❌ بازه زمانی دو leg همپوشانی ندارد: "
+                         f"{labels[0]} [{span(ts0)}]، "
+                         f"{labels[1]} [{span(ts1)}]")
+    n_grid = max(int((end - start) // interval_ms) + 1, 0)
+    grid = start + np.arange(n_grid, dtype=np.int64) * interval_ms
+
+    # جای هر کندل روی شبکه = (ts - start) / interval → scatter خطی
+    # (کندل‌های خارج از بازه مشترک یا خارج از شبکه کنار گذاشته می‌شوند)
+    present = []
+    positions = []
+    for ts in (ts0, ts1):
+        offset = ts - start
+        slot = offset // interval_ms
+        on_grid = np.flatnonzero((offset >= 0) & (slot < n_grid) &
+                                 (offset % interval_ms == 0))
+        pos = np.zeros(n_grid, dtype=np.int64)
+        pos[slot[on_grid]] = on_grid
+        mask = np.zeros(n_grid, dtype=bool)
+        mask[slot[on_grid]] = True
+        present.append(mask)
+        positions.append(pos)
+    both = present[0] & present[1]
+
+    # ─── گزارش سوراخ‌ها ───
+    run_starts, run_ends = _missing_runs(~both)
+    if len(run_starts):
+        # reduceat تا شروع run بعدی جمع می‌زند؛ بین runها هر دو leg کامل‌اند
+        missing = [np.add.reduceat((~mask).astype(np.int64), run_starts)
+                   for mask in present]
+    else:
+        missing = [np.zeros(0, dtype=np.int64)] * 2
+    gap_report = pd.DataFrame({
+        'start': pd.to_datetime(grid[run_starts], unit='ms'),
+        'end': pd.to_datetime(grid[run_ends], unit='ms'),
+        'candles': run_ends - run_starts + 1,
+        f'{labels[0]}_missing': missing[0],
+        f'{labels[1]}_missing': missing[1],
+    })
+
+    if gap_policy == 'ffill':
+        # اندیس آخرین کندل واقعی هر leg تا هر نقطه شبکه
+        idx = np.arange(len(grid))
+        filled = []
+        keep = np.ones(len(grid), dtype=bool)
+        for k in range(2):
+            last_real = np.maximum.accumulate(np.where(present[k], idx, -1))
+            keep &= last_real >= 0
+            if max_fill is not None:
+                keep &= idx - last_real <= max_fill
+            filled.append(positions[k][np.maximum(last_real, 0)])
+        rows_kept = np.flatnonzero(keep)
+        out = {'timestamp': grid[rows_kept]}
+        for k, leg in enumerate(legs):
+            sel = leg[filled[k][rows_kept]]
+            real = present[k][rows_kept]
+            out[k] = {
+                'close': sel['close'],
+                # کندل پرشده: بدون دامنه و بدون معامله
+                'high': np.where(real, sel['high'], sel['close']),
+                'low': np.where(real, sel['low'], sel['close']),
+                'quote_volume': np.where(real, sel['quote_volume'], 0.0),
+            }
+    else:
+        rows_kept = np.flatnonzero(both)
+        out = {'timestamp': grid[rows_kept]}
+        for k, leg in enumerate(legs):
+            sel = leg[positions[k][rows_kept]]
+            out[k] = {field: sel[field]
+                      for field in ('close', 'high', 'low', 'quote_volume')}
+        if gap_policy == 'split':
+            # هر سوراخ یک بخش جدید شروع می‌کند
+            gap_after = np.zeros(len(grid), dtype=np.int64)
+            gap_after[run_ends[run_ends + 1 < len(grid)] + 1] = 1
+            out['segment'] = np.cumsum(gap_after)[rows_kept]
+
+    return out, gap_report
+
+
+def _build_pair_frame(arr0, arr1, target_days, labels=('CAKE', 'BNB'),
+                      interval='1h', verbose=True, gap_policy='drop',
+                      max_fill=None):
+    """
+    ساخت DataFrame جفت‌ارز از کندل‌های دو leg دلاری.
+
+    ستون‌ها مثل get_pancakeswap_pair_data: cake_usdt/bnb_usdt همان قیمت
+    دلاری token0/token1 هستند و close = token0 / token1.
+    هم‌ترازی و سوراخ‌ها: align_pair_legs.
+    Returns: (df، DataFrame گزارش سوراخ‌ها)
+    """
+    log = print if verbose else _silent
+    name0, name1 = labels
+
+    if len(arr0) == 0 or len(arr1) == 0:
+        raise ValueError("❌ داده‌ای دریافت نشد! اتصال اینترنت را بررسی کنید.")
+
+    # ─── هم‌ترازی دو leg ───
+    with METRICS.stage('assemble', f'{name0}/{name1}'):
+        aligned, gap_report = align_pair_legs(arr0, arr1, interval,
+                                              gap_policy, max_fill, labels)
+        if len(aligned['timestamp']) == 0:
+            raise ValueError(f"❌ هیچ کندل مشترکی بین {name0} و {name1} "
+                             f"نماند (سیاست سوراخ: {gap_policy})")
+        cake, bnb = aligned[0], aligned[1]
+
+        df = pd.DataFrame({
+            'timestamp': pd.to_datetime(aligned['timestamp'], unit='ms'),
+            'cake_usdt': cake['close'],
+            'bnb_usdt': bnb['close'],
+            'cake_volume': cake['quote_volume'],
+            'bnb_volume': bnb['quote_volume'],
+            # پوش بیرونی نسبت داخل کندل: کف/سقف واقعی token0/token1
+            # بین این دو است
+            'ratio_low': cake['low'] / bnb['high'],
+            'ratio_high': cake['high'] / bnb['low'],
+        })
+        if 'segment' in aligned:
+            df['segment'] = aligned['segment']
+        df = df.set_index('timestamp')
+
+    if len(gap_report):
+        log(f"\n   🕳️ {len(gap_report)} سوراخ در داده "
+            f"({gap_report['candles'].sum():,} کندل، بزرگ‌ترین "
+            f"{gap_report['candles'].max():,} کندل) → سیاست: {gap_policy}")
 
     # ─── برش به بازه مورد نظر (آخرین target_days روز) ───
-    total_available_hours = len(df)
-    needed_hours = target_days * 24
-
-    if total_available_hours > needed_hours:
-        df = df.iloc[-needed_hours:]
-        print(f"\n   ✂️ برش به {target_days} روز اخیر "
-              f"(از {total_available_hours} ساعت → {needed_hours} ساعت)")
-    elif total_available_hours < needed_hours:
-        actual_days = total_available_hours / 24
-        print(f"\n   ⚠️ فقط {actual_days:.0f} روز داده موجود است "
-              f"(درخواست: {target_days} روز)")
-
-    # نسبت CAKE/BNB
+    per_day = periods_per_day(interval)
+    total_available = len(df)
+    needed = target_days * per_day
+
+    if total_available > needed:
+        df = df.iloc[-needed:]
+        log(f"\n   ✂️ برش به {target_days} روز اخیر "
+            f"(از {total_available} کندل → {needed} کندل {interval})")
+    elif total_available < needed:
+        actual_days = total_available / per_day
+        log(f"\n   ⚠️ فقط {actual_days:.0f} روز داده موجود است "
+            f"(درخواست: {target_days} روز)")
+
+    # نسبت token0/token1 (مثلاً CAKE/BNB)
     df['close'] = df['cake_usdt'] / df['bnb_usdt']
     df['quote_volume'] = (df['cake_volume'] + df['bnb_volume']) / 2
 
     df = df.reset_index()
+    METRICS.count('rows_assembled', len(df))
 
     # ─── گزارش ───
-    days = len(df) / 24
-    print(f"\n✅ داده‌های CAKE/BNB آماده شد")
-    print(f"   📊 تعداد کندل: {len(df):,} ({days:.0f} روز ≈ {days / 30:.1f} ماه)")
-    print(f"   📅 از: {df['timestamp'].iloc[0]}")
-    print(f"   📅 تا: {df['timestamp'].iloc[-1]}")
-    print(f"   💰 CAKE/BNB شروع: {df['close'].iloc[0]:.6f}")
-    print(f"   💰 CAKE/BNB پایان: {df['close'].iloc[-1]:.6f}")
-    print(f"   💰 CAKE شروع: ${df['cake_usdt'].iloc[0]:.2f}")
-    print(f"   💰 BNB شروع:  ${df['bnb_usdt'].iloc[0]:.2f}")
-    print(f"   💰 CAKE پایان: ${df['cake_usdt'].iloc[-1]:.2f}")
-    print(f"   💰 BNB پایان:  ${df['bnb_usdt'].iloc[-1]:.2f}")
+    days = len(df) / per_day
+    log(f"\n✅ داده‌های {name0}/{name1} آماده شد")
+    log(f"   📊 تعداد کندل: {len(df):,} ({days:.0f} روز ≈ {days / 30:.1f} ماه)")
+    log(f"   📅 از: {df['timestamp'].iloc[0]}")
+    log(f"   📅 تا: {df['timestamp'].iloc[-1]}")
+    log(f"   💰 {name0}/{name1} شروع: {df['close'].iloc[0]:.6f}")
+    log(f"   💰 {name0}/{name1} پایان: {df['close'].iloc[-1]:.6f}")
+    log(f"   💰 {name0} شروع: ${df['cake_usdt'].iloc[0]:.2f}")
+    log(f"   💰 {name1} شروع:  ${df['bnb_usdt'].iloc[0]:.2f}")
+    log(f"   💰 {name0} پایان: ${df['cake_usdt'].iloc[-1]:.2f}")
+    log(f"   💰 {name1} پایان:  ${df['bnb_usdt'].iloc[-1]:.2f}")
 
     # اعتبارسنجی
     if days < 300:
-        print(f"\n   ⚠️ هشدار: داده کمتر از ۳۰۰ روز ({days:.0f} روز)")
-        print(f"      نتایج ممکن است دقیق نباشد")
+        log(f"\n   ⚠️ هشدار: داده کمتر از ۳۰۰ روز ({days:.0f} روز)")
+        log(f"      نتایج ممکن است دقیق نباشد")
     else:
-        print(f"\n   ✅ بازه زمانی کافی: {days:.0f} روز")
+        log(f"\n   ✅ بازه زمانی کافی: {days:.0f} روز")
 
-    return df
+    return df, gap_report
+
+
+def get_pancakeswap_pair_data(target_days=365, base_url=BINANCE_KLINES_URL,
+                              max_workers=8, rate_per_sec=10,
+                              use_cache=True, cache_dir=KLINE_CACHE_DIR,
+                              offline=False, verbose=True, interval='1h',
+                              gap_policy='drop', max_fill=None,
+                              return_gaps=False):
+    """
+    دریافت داده‌های CAKE/BNB برای PancakeSwap - حداقل ۱ سال
+
+    تغییرات:
+    - تعداد دورهای درخواست افزایش یافته تا ۱ سال پوشش دهد
+    - هر درخواست ۱۰۰۰ کندل ساعتی = ~۴۱.۶ روز
+    - برای ۳۶۵ روز: حداقل ۹ درخواست (۹ × ۱۰۰۰ = ۹۰۰۰ ساعت = ۳۷۵ روز)
+    - ۱۲ درخواست می‌زنیم تا مطمئن شویم (≈۵۰۰ روز پوشش)
+    - هر دو نماد همزمان و با دسته‌های موازی دریافت می‌شوند
+      (download_klines)
+    - use_cache=True → کش محلی (KlineCache)؛ فقط کندل‌های جدید و
+      سوراخ‌ها دانلود می‌شوند. offline=True → فقط از کش
+    - verbose=False → بدون چاپ گزارش و پیشرفت دانلود
+    - interval: '1h' (پیش‌فرض) تا '1m' (≈۵۲۵ هزار کندل در سال)؛
+      روز و سالانه‌سازی در بقیه خط لوله از فاصله کندل‌ها استنتاج می‌شود
+    - gap_policy / max_fill: رفتار با کندل‌های گم‌شده (align_pair_legs)؛
+      return_gaps=True → (df، گزارش سوراخ‌ها)
+    """
+    log = print if verbose else _silent
+    log("📥 دریافت داده‌های CAKE/BNB برای PancakeSwap...")
+    log(f"   🎯 هدف: {target_days} روز "
+        f"({target_days * periods_per_day(interval):,} کندل {interval})")
+
+    log(f"\n   دریافت CAKE/USDT و BNB/USDT...")
+    klines = _fetch_leg_klines(
+        ['CAKEUSDT', 'BNBUSDT'], target_days, interval, base_url=base_url,
+        max_workers=max_workers, rate_per_sec=rate_per_sec,
+        use_cache=use_cache, cache_dir=cache_dir, offline=offline,
+        verbose=verbose
+    )
+    df, gaps = _build_pair_frame(
+        klines['CAKEUSDT'], klines['BNBUSDT'], target_days,
+        interval=interval, verbose=verbose, gap_policy=gap_policy,
+        max_fill=max_fill
+    )
+    return (df, gaps) if return_gaps else df
+
+
+class PoolPair:
+    """
+    یک استخر PancakeSwap V3: token0/token1 + fee tier (درصد).
+
+    قیمت هر توکن از نماد دلاری Binance آن (مثلاً CAKE → CAKEUSDT)
+    گرفته می‌شود؛ قیمت استخر = token0 / token1.
+    """
+
+    __slots__ = ('token0', 'token1', 'fee_tier')
+
+    QUOTE = 'USDT'
+
+    def __init__(self, token0, token1, fee_tier=0.25):
+        self.token0 = token0.upper()
+        self.token1 = token1.upper()
+        self.fee_tier = float(fee_tier)
+
+    @classmethod
+    def parse(cls, text):
+        """'CAKE/BNB' یا 'CAKE/BNB@0.25' → PoolPair"""
+        usage = "قالب: TOKEN0/TOKEN1 یا TOKEN0/TOKEN1@FEE، مثلاً CAKE/BNB@0.25"
+        tokens, _, fee = text.strip().partition('@')
+        parts = [token.strip() for token in tokens.split('/')]
+        if len(parts) != 2 or not all(token.isalnum() for token in parts):
+            raise ValueError(f"❌ استخر نامعتبر: {text!r} ({usage})")
+        if parts[0].upper() == parts[1].upper():
+            raise ValueError(f"❌ استخر نامعتبر: {text!r} - دو توکن یکسان‌اند")
+        try:
+            fee_tier = float(fee) if fee else 0.25
+        except ValueError:
+            raise ValueError(f"❌ fee tier نامعتبر در {text!r}: {fee!r} "
+                             f"({usage})") from None
+        if not fee_tier > 0:
+            raise ValueError(f"❌ fee tier باید مثبت باشد: {text!r}")
+        return cls(parts[0], parts[1], fee_tier)
+
+    @property
+    def name(self):
+        return f"{self.token0}/{self.token1}"
+
+    @property
+    def key(self):
+        """شناسه یکتا (یک جفت می‌تواند با چند fee tier بیاید)"""
+        return f"{self.name}@{self.fee_tier:g}"
+
+    @property
+    def symbols(self):
+        """نمادهای دلاری لازم (stablecoin مرجع نماد ندارد)"""
+        return tuple(token + self.QUOTE for token in (self.token0, self.token1)
+                     if token != self.QUOTE)
+
+    def __repr__(self):
+        return f"PoolPair({self.key})"
+
+
+def _stable_leg_like(arr):
+    """leg ثابت ۱ دلاری (مثلاً USDT) هم‌زمان با کندل‌های arr"""
+    leg = np.zeros(len(arr), dtype=KLINE_DTYPE)
+    leg['timestamp'] = arr['timestamp']
+    for field in ('high', 'low', 'close'):
+        leg[field] = 1.0
+    leg['quote_volume'] = arr['quote_volume']
+    return leg
+
+
+def load_pairs_data(pairs, target_days=365, interval='1h', verbose=True,
+                    gap_policy='drop', max_fill=None, **data_kwargs):
+    """
+    داده چند استخر با دانلود مشترک leg ها.
+
+    همه نمادهای لازم (اجتماع legها) یک بار و با هم دریافت می‌شوند؛
+    مثلاً برای CAKE/BNB، ETH/BNB و BNB/USDT فقط سه نماد CAKEUSDT،
+    ETHUSDT و BNBUSDT - BNBUSDT یک بار، نه یک بار به ازای هر جفت.
+
+    data_kwargs: همان گزینه‌های get_pancakeswap_pair_data
+                 (base_url، use_cache، cache_dir، offline، ...)
+
+    Returns: {pair.key: DataFrame} با ستون‌های get_pancakeswap_pair_data
+    """
+    log = print if verbose else _silent
+    pairs = [PoolPair.parse(p) if isinstance(p, str) else p for p in pairs]
+    symbols = list(dict.fromkeys(s for pair in pairs for s in pair.symbols))
+
+    log(f"📥 دریافت {len(symbols)} نماد برای {len(pairs)} استخر: "
+        f"{', '.join(symbols)}")
+    klines = _fetch_leg_klines(symbols, target_days, interval,
+                               verbose=verbose, **data_kwargs)
+
+    pair_data = {}
+    for pair in pairs:
+        legs = [klines.get(token + PoolPair.QUOTE)
+                for token in (pair.token0, pair.token1)]
+        reference = next((leg for leg in legs if leg is not None), None)
+        if reference is None:
+            raise ValueError(
+                f"❌ استخر پشتیبانی نمی‌شود: {pair.name} - هیچ‌کدام از دو "
+                f"توکن جفت {PoolPair.QUOTE} (leg دلاری) در Binance ندارد"
+            )
+        arr0, arr1 = (leg if leg is not None else _stable_leg_like(reference)
+                      for leg in legs)
+        pair_data[pair.key], _ = _build_pair_frame(
+            arr0, arr1, target_days, labels=(pair.token0, pair.token1),
+            interval=interval, verbose=verbose, gap_policy=gap_policy,
+            max_fill=max_fill
+        )
+    return pair_data
 
 
 # ═══════════════════════════════════════════════════════════
-# بخش ۲: کلاس استخر V3 - بدون تغییر
+# بخش ۲: کلاس استخر V3 - حالت پیش‌محاسبه‌شده در __slots__
 # ═══════════════════════════════════════════════════════════
 
 class LiquidityPositionV3:
@@ -225,19 +968,29 @@ class LiquidityPositionV3:
     در قیمت P:
         amount0 = L × (√P_upper - √P) / (√P × √P_upper)    [CAKE]
         amount1 = L × (√P - √P_lower)                       [BNB]
+
+    حالت پوزیشن در __slots__ نگه داشته می‌شود و √P_lower و √P_upper
+    فقط هنگام open_position محاسبه و کش می‌شوند (بازه تا ریبالانس
+    بعدی ثابت است). برای ریبالانس، همان شیء دوباره open می‌شود.
     """
 
+    __slots__ = ('L', 'price_lower', 'price_upper', 'center_price',
+                 'range_percent', 'capital_usd', 'sqrt_lower', 'sqrt_upper')
+
     def __init__(self):
         self.L = 0
         self.price_lower = 0
         self.price_upper = 0
         self.center_price = 0
         self.range_percent = 0
+        self.capital_usd = 0
+        self.sqrt_lower = 0
+        self.sqrt_upper = 0
 
     def open_position(self, capital_usd, center_price, range_percent,
                       cake_usdt_price, bnb_usdt_price):
         """
-        باز کردن پوزیشن جدید.
+        باز کردن پوزیشن جدید (کل حالت قبلی جایگزین می‌شود).
 
         سرمایه ۵۰/۵۰ دلاری تقسیم می‌شود:
         - نصف دلاری → CAKE خریداری
@@ -247,15 +1000,17 @@ class LiquidityPositionV3:
         self.range_percent = range_percent
         self.price_lower = center_price * (1 - range_percent / 100)
         self.price_upper = center_price * (1 + range_percent / 100)
+        self.sqrt_lower = math.sqrt(max(self.price_lower, 1e-18))
+        self.sqrt_upper = math.sqrt(max(self.price_upper, 1e-18))
 
         # تقسیم ۵۰/۵۰ دلاری
         usd_per_side = capital_usd / 2
         amount0_cake = usd_per_side / cake_usdt_price  # تعداد CAKE
         amount1_bnb = usd_per_side / bnb_usdt_price    # تعداد BNB
 
-        sqrt_p = np.sqrt(center_price)
-        sqrt_pa = np.sqrt(self.price_lower)
-        sqrt_pb = np.sqrt(self.price_upper)
+        sqrt_p = math.sqrt(center_price)
+        sqrt_pa = self.sqrt_lower
+        sqrt_pb = self.sqrt_upper
 
         # محاسبه L
         if sqrt_pb - sqrt_p > 1e-15:
@@ -283,12 +1038,17 @@ class LiquidityPositionV3:
         """
         محاسبه مقدار CAKE و BNB در پوزیشن.
 
+        ورودی می‌تواند یک قیمت یا آرایه‌ای از قیمت‌ها باشد؛
+        برای آرایه، کل بردار یکجا ارزش‌گذاری می‌شود.
+
         Returns: (amount_cake, amount_bnb)
         """
+        if np.ndim(current_price_cake_bnb) > 0:
+            return self._get_amounts_batch(current_price_cake_bnb)
+
         P = current_price_cake_bnb
-        sqrt_p = np.sqrt(max(P, 1e-18))
-        sqrt_pa = np.sqrt(max(self.price_lower, 1e-18))
-        sqrt_pb = np.sqrt(max(self.price_upper, 1e-18))
+        sqrt_pa = self.sqrt_lower
+        sqrt_pb = self.sqrt_upper
 
         if P <= self.price_lower:
             # قیمت زیر بازه → همه CAKE شده
@@ -306,6 +1066,7 @@ class LiquidityPositionV3:
 
         else:
             # در بازه
+            sqrt_p = math.sqrt(max(P, 1e-18))
             denom = sqrt_p * sqrt_pb
             if denom > 1e-18:
                 amount0 = self.L * (sqrt_pb - sqrt_p) / denom
@@ -315,9 +1076,48 @@ class LiquidityPositionV3:
 
         return max(amount0, 0), max(amount1, 0)
 
+    def _get_amounts_batch(self, prices):
+        """
+        نسخه برداری get_amounts روی آرایه قیمت‌ها.
+
+        شاخه‌ها (زیر بازه / بالای بازه / داخل بازه) دقیقاً مثل نسخه اسکالر
+        هستند تا خروجی موتورها یکسان بماند.
+
+        Returns: (amounts_cake, amounts_bnb) به صورت ndarray
+        """
+        P = np.asarray(prices, dtype=np.float64)
+        L = self.L
+        sqrt_pa = self.sqrt_lower
+        sqrt_pb = self.sqrt_upper
+        sqrt_p = np.sqrt(np.maximum(P, 1e-18))
+
+        below = P <= self.price_lower
+        above = ~below & (P >= self.price_upper)
+
+        # در بازه
+        denom = sqrt_p * sqrt_pb
+        valid = denom > 1e-18
+        amount0 = np.where(
+            valid, L * (sqrt_pb - sqrt_p) / np.where(valid, denom, 1.0), 0.0
+        )
+        amount1 = L * (sqrt_p - sqrt_pa)
+
+        # زیر بازه → همه CAKE
+        denom_low = sqrt_pa * sqrt_pb
+        amount0_low = L * (sqrt_pb - sqrt_pa) / denom_low \
+            if denom_low > 1e-18 else 0.0
+        amount0 = np.where(below, amount0_low, amount0)
+        amount1 = np.where(below, 0.0, amount1)
+
+        # بالای بازه → همه BNB
+        amount0 = np.where(above, 0.0, amount0)
+        amount1 = np.where(above, L * (sqrt_pb - sqrt_pa), amount1)
+
+        return np.maximum(amount0, 0), np.maximum(amount1, 0)
+
     def get_value_usd(self, cake_bnb_price, cake_usdt, bnb_usdt):
         """
-        ارزش دلاری پوزیشن.
+        ارزش دلاری پوزیشن (اسکالر یا آرایه).
 
         = amount_cake × cake_usdt + amount_bnb × bnb_usdt
         """
@@ -325,13 +1125,60 @@ class LiquidityPositionV3:
         return amount_cake * cake_usdt + amount_bnb * bnb_usdt
 
 
+class RangeHistory:
+    """
+    تاریخچه بازه فعال - فقط در نقاط تغییر (ریبالانس‌ها) ذخیره می‌شود.
+
+    به جای یک dict برای هر ساعت (8760 dict)، برای هر پوزیشن یک ردیف:
+        starts[k]  = اندیس ساعتی که پوزیشن k از آن فعال شد
+        lower/upper/center[k] = بازه پوزیشن k
+
+    expand() آرایه‌های ساعتی را در صورت نیاز می‌سازد؛ اندیس‌گذاری و
+    پیمایش (rh['lower'] برای هر ساعت) مثل لیست قبلی کار می‌کند.
+    """
+
+    __slots__ = ('starts', 'lower', 'upper', 'center', 'n_rows')
+
+    def __init__(self, starts, lower, upper, center, n_rows):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.n_rows = n_rows
+
+    def __len__(self):
+        return self.n_rows
+
+    def expand(self):
+        """Returns: (lowers, uppers, centers) آرایه‌های ساعتی با طول n_rows"""
+        lengths = np.diff(np.append(self.starts, self.n_rows))
+        return tuple(np.repeat(values, lengths)
+                     for values in (self.lower, self.upper, self.center))
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.n_rows
+        if not 0 <= idx < self.n_rows:
+            raise IndexError(idx)
+        k = int(np.searchsorted(self.starts, idx, side='right')) - 1
+        return {'lower': float(self.lower[k]),
+                'upper': float(self.upper[k]),
+                'center': float(self.center[k])}
+
+    def __iter__(self):
+        for lower, upper, center in zip(*(a.tolist() for a in self.expand())):
+            yield {'lower': lower, 'upper': upper, 'center': center}
+
+
 # ═══════════════════════════════════════════════════════════
 # بخش ۳: بک‌تست با ریبالانسینگ اصلاح‌شده
 # ═══════════════════════════════════════════════════════════
 
 def run_backtest_with_rebalance(price_data, range_percent,
                                  initial_capital=10000, fee_tier=0.25,
-                                 gas_cost_usd=0.30, slippage_pct=0.1):
+                                 gas_cost_usd=0.30, slippage_pct=0.1,
+                                 engine='loop', record_history=True,
+                                 metrics_only=False):
     """
     بک‌تست با ریبالانسینگ اصلاح‌شده.
 
@@ -351,7 +1198,40 @@ def run_backtest_with_rebalance(price_data, range_percent,
 
     3. مرکز بازه جدید = قیمت فعلی CAKE/BNB (نه حد بازه قبلی)
        → اینطوری بازه جدید حتماً شامل قیمت فعلی خواهد بود
+
+    engine:
+        'loop'       → حلقه ساعت‌به‌ساعت (مرجع)
+        'vectorized' → موتور NumPy بخش‌به‌بخش (همان نتایج، بسیار سریع‌تر)
+        'kernel'     → backtest_all_widths با یک بازه (برای چند بازه
+                       run_all_scenarios همه را در یک گذر اجرا می‌کند)
+
+    record_history:
+        True  → تاریخچه‌های ساعتی در آرایه‌های float64 از پیش تخصیص‌یافته
+                و range_history به صورت RangeHistory (نقاط تغییر)
+        False → هیچ تاریخچه‌ای ساخته نمی‌شود (کلیدهای *_history = None)
+
+    metrics_only:
+        True → فقط معیارهای خلاصه (total_return، fee_apr، rebalance_count،
+               impermanent_loss، vs_hodl، ...) برگردانده می‌شود؛ نه
+               تاریخچه و نه rebalance_timestamps - برای sweep های بزرگ
     """
+    if metrics_only:
+        record_history = False
+    if engine == 'vectorized':
+        return _run_backtest_vectorized(
+            price_data, range_percent, initial_capital,
+            fee_tier, gas_cost_usd, slippage_pct, record_history,
+            metrics_only
+        )
+    if engine == 'kernel':
+        return backtest_all_widths(
+            price_data, [range_percent], initial_capital, fee_tier,
+            gas_cost_usd, slippage_pct, record_history, metrics_only
+        )[0]
+    if engine != 'loop':
+        raise ValueError(f"❌ موتور ناشناخته: {engine!r} "
+                         f"(مجاز: 'loop'، 'vectorized' یا 'kernel')")
+
     fee_rate = fee_tier / 100
 
     # ─── HODL ───
@@ -376,19 +1256,24 @@ def run_backtest_with_rebalance(price_data, range_percent,
     periods_in_range = 0
     periods_out_of_range = 0
 
-    fee_history = []
-    pool_value_history = []
-    hodl_value_history = []
-    total_value_history = []
+    n_rows = len(price_data)
     rebalance_timestamps = []
-    range_history = []
+    if record_history:
+        fee_history = np.zeros(n_rows, dtype=np.float64)
+        pool_value_history = np.empty(n_rows, dtype=np.float64)
+        hodl_value_history = np.empty(n_rows, dtype=np.float64)
+        total_value_history = np.empty(n_rows, dtype=np.float64)
+        # نقاط تغییر بازه: (اندیس شروع، lower، upper، center)
+        range_changes = [(0, position.price_lower, position.price_upper,
+                          position.center_price)]
 
     # تخمین سهم ما از حجم
-    avg_daily_volume = price_data['quote_volume'].mean() * 24
+    per_day = infer_periods_per_day(price_data)
+    avg_daily_volume = price_data['quote_volume'].mean() * per_day
     estimated_tvl = avg_daily_volume * 5
     our_share = min(initial_capital / estimated_tvl, 0.1)
 
-    for idx in range(len(price_data)):
+    for idx in range(n_rows):
         row = price_data.iloc[idx]
         price_cake_bnb = row['close']
         cake_usdt = row['cake_usdt']
@@ -433,8 +1318,7 @@ def run_backtest_with_rebalance(price_data, range_percent,
             #    اینطوری بازه جدید حتماً شامل قیمت فعلی خواهد بود
             new_center = price_cake_bnb
 
-            # 6. باز کردن پوزیشن جدید (۵۰/۵۰ دلاری)
-            position = LiquidityPositionV3()
+            # 6. باز کردن پوزیشن جدید (۵۰/۵۰ دلاری) - همان شیء بازاستفاده می‌شود
             position.open_position(
                 max(rebalance_capital, 0),
                 new_center,
@@ -444,7 +1328,12 @@ def run_backtest_with_rebalance(price_data, range_percent,
             )
 
             rebalance_count += 1
-            rebalance_timestamps.append(row['timestamp'])
+            if not metrics_only:
+                rebalance_timestamps.append(row['timestamp'])
+            if record_history:
+                range_changes.append((idx, position.price_lower,
+                                      position.price_upper,
+                                      position.center_price))
 
             # بازبررسی (باید در بازه جدید باشد)
             in_range = position.is_in_range(price_cake_bnb)
@@ -461,132 +1350,3523 @@ def run_backtest_with_rebalance(price_data, range_percent,
             fee = volume * fee_rate * our_share * concentration_factor
             fee = min(fee, volume * fee_rate * 0.5)
             total_fees_usd += fee
-            fee_history.append(fee)
+            if record_history:
+                fee_history[idx] = fee
         else:
             periods_out_of_range += 1
-            fee_history.append(0)
 
-        # ─── ثبت ───
-        pool_val = position.get_value_usd(price_cake_bnb, cake_usdt, bnb_usdt)
-        hodl_val = hodl_cake_amount * cake_usdt + hodl_bnb_amount * bnb_usdt
-        total_val = pool_val + total_fees_usd
-
-        pool_value_history.append(pool_val)
-        hodl_value_history.append(hodl_val)
-        total_value_history.append(total_val)
-
-        range_history.append({
-            'lower': position.price_lower,
-            'upper': position.price_upper,
-            'center': position.center_price
-        })
+        # ─── ثبت ───
+        if record_history:
+            pool_val = position.get_value_usd(price_cake_bnb, cake_usdt, bnb_usdt)
+            hodl_val = hodl_cake_amount * cake_usdt + hodl_bnb_amount * bnb_usdt
+            total_val = pool_val + total_fees_usd
+
+            pool_value_history[idx] = pool_val
+            hodl_value_history[idx] = hodl_val
+            total_value_history[idx] = total_val
+
+    # ─── نتایج ───
+    results = _summarize_backtest(
+        range_percent, entry_price, position, initial_capital,
+        final_prices=(price_data['close'].iloc[-1],
+                      price_data['cake_usdt'].iloc[-1],
+                      price_data['bnb_usdt'].iloc[-1]),
+        hodl_amounts=(hodl_cake_amount, hodl_bnb_amount),
+        total_fees_usd=total_fees_usd,
+        total_gas_costs=total_gas_costs,
+        total_slippage_costs=total_slippage_costs,
+        rebalance_count=rebalance_count,
+        periods_in_range=periods_in_range,
+        periods_out_of_range=periods_out_of_range,
+        periods_per_day=per_day,
+    )
+    if metrics_only:
+        return results
+
+    results['rebalance_timestamps'] = rebalance_timestamps
+    if record_history:
+        results.update({
+            'fee_history': fee_history,
+            'pool_value_history': pool_value_history,
+            'hodl_value_history': hodl_value_history,
+            'total_value_history': total_value_history,
+            'range_history': RangeHistory(*zip(*range_changes), n_rows),
+        })
+    else:
+        results.update(dict.fromkeys(_HISTORY_KEYS))
+
+    return results
+
+
+# کلیدهای تاریخچه ساعتی در dict نتایج
+_HISTORY_KEYS = ('fee_history', 'pool_value_history', 'hodl_value_history',
+                 'total_value_history', 'range_history')
+
+
+def _summarize_backtest(range_percent, entry_price, position, initial_capital,
+                        final_prices, hodl_amounts, total_fees_usd,
+                        total_gas_costs, total_slippage_costs,
+                        rebalance_count, periods_in_range,
+                        periods_out_of_range, periods_per_day=24):
+    """
+    محاسبه معیارهای نهایی بک‌تست (مشترک بین همه موتورها).
+
+    final_prices = (CAKE/BNB, CAKE/USDT, BNB/USDT) در آخرین کندل
+    hodl_amounts = (تعداد CAKE، تعداد BNB) استراتژی HODL
+    periods_per_day = تعداد کندل در روز (برای days و fee_apr)
+    """
+    final_cake_bnb, final_cake_usdt, final_bnb_usdt = final_prices
+    hodl_cake_amount, hodl_bnb_amount = hodl_amounts
+
+    final_pool_value = position.get_value_usd(
+        final_cake_bnb, final_cake_usdt, final_bnb_usdt
+    )
+    final_hodl_value = hodl_cake_amount * final_cake_usdt + \
+                       hodl_bnb_amount * final_bnb_usdt
+
+    net_fees = total_fees_usd - total_gas_costs - total_slippage_costs
+    final_total_value = final_pool_value + net_fees
+
+    # IL
+    il_percent = (final_pool_value / final_hodl_value - 1) * 100 \
+        if final_hodl_value > 0 else 0
+
+    total_periods = periods_in_range + periods_out_of_range
+    active_percent = (periods_in_range / total_periods) * 100
+    days = total_periods / periods_per_day
+
+    total_return = ((final_total_value - initial_capital) / initial_capital) * 100
+    fee_apr = (net_fees / initial_capital) * (365 / max(days, 1)) * 100
+    vs_hodl = ((final_total_value - final_hodl_value) / final_hodl_value) * 100 \
+        if final_hodl_value > 0 else 0
+
+    return {
+        'range_percent': range_percent,
+        'entry_price': entry_price,
+        'price_lower': position.price_lower,
+        'price_upper': position.price_upper,
+        'active_percent': active_percent,
+        'periods_in_range': periods_in_range,
+        'periods_out_of_range': periods_out_of_range,
+        'rebalance_count': rebalance_count,
+        'total_gas_costs': total_gas_costs,
+        'total_slippage_costs': total_slippage_costs,
+        'total_fees_gross': total_fees_usd,
+        'total_fees_net': net_fees,
+        'fee_apr': fee_apr,
+        'final_pool_value': final_pool_value,
+        'final_hodl_value': final_hodl_value,
+        'final_total_value': final_total_value,
+        'impermanent_loss': il_percent,
+        'total_return': total_return,
+        'vs_hodl': vs_hodl,
+        'days': days,
+    }
+
+
+def run_backtest_segmented(price_data, range_percent, initial_capital=10000,
+                           engine='vectorized', **backtest_kwargs):
+    """
+    بک‌تست جداگانه هر بخش پیوسته (ستون segment از gap_policy='split').
+
+    سوراخ‌ها زمان پیوسته فرض نمی‌شوند: هر بخش با پوزیشن تازه ۵۰/۵۰ روی
+    اولین کندل خودش شروع می‌شود و ارزش نهایی هر بخش سرمایه بخش بعدی
+    است. بدون ستون segment → همان run_backtest_with_rebalance (metrics_only).
+
+    Returns: معیارهای تجمیعی (کلیدهای metrics_only) + segments (لیست
+             معیارهای هر بخش)
+    """
+    if 'segment' not in price_data:
+        return run_backtest_with_rebalance(
+            price_data, range_percent, initial_capital, engine=engine,
+            metrics_only=True, **backtest_kwargs
+        )
+
+    segment_ids = price_data['segment'].to_numpy()
+    bounds = np.flatnonzero(np.diff(segment_ids)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(price_data)]))
+
+    segments = []
+    capital = initial_capital
+    for lo, hi in zip(starts, ends):
+        result = run_backtest_with_rebalance(
+            price_data.iloc[lo:hi], range_percent, capital, engine=engine,
+            metrics_only=True, **backtest_kwargs
+        )
+        segments.append(result)
+        capital = result['final_total_value']
+
+    totals = {key: sum(seg[key] for seg in segments)
+              for key in ('periods_in_range', 'periods_out_of_range',
+                          'rebalance_count', 'total_gas_costs',
+                          'total_slippage_costs', 'total_fees_gross',
+                          'total_fees_net', 'days')}
+    total_periods = totals['periods_in_range'] + totals['periods_out_of_range']
+
+    # HODL روی کل دوره (سوراخ‌ها برای HODL اهمیتی ندارند)
+    first, last = price_data.iloc[0], price_data.iloc[-1]
+    final_hodl_value = (initial_capital / 2) * (
+        last['cake_usdt'] / first['cake_usdt'] +
+        last['bnb_usdt'] / first['bnb_usdt']
+    )
+    final_pool_value = segments[-1]['final_pool_value']
+    final_total_value = capital
+
+    return {
+        'range_percent': range_percent,
+        'entry_price': segments[0]['entry_price'],
+        'price_lower': segments[-1]['price_lower'],
+        'price_upper': segments[-1]['price_upper'],
+        'active_percent': totals['periods_in_range'] / total_periods * 100,
+        **totals,
+        'fee_apr': (totals['total_fees_net'] / initial_capital) *
+                   (365 / max(totals['days'], 1)) * 100,
+        'final_pool_value': final_pool_value,
+        'final_hodl_value': final_hodl_value,
+        'final_total_value': final_total_value,
+        'impermanent_loss': (final_pool_value / final_hodl_value - 1) * 100
+        if final_hodl_value > 0 else 0,
+        'total_return': (final_total_value / initial_capital - 1) * 100,
+        'vs_hodl': (final_total_value - final_hodl_value) /
+                   final_hodl_value * 100 if final_hodl_value > 0 else 0,
+        'segments': segments,
+    }
+
+
+def _is_segmented(price_data):
+    """داده gap_policy='split' (ستون segment) → run_backtest_segmented"""
+    return isinstance(price_data, pd.DataFrame) and 'segment' in price_data
+
+
+# بازه‌های پیش‌فرض (±%) برای اجرای کامل
+DEFAULT_SCENARIOS = [2, 3, 4, 5, 7, 10, 15, 20, 25, 30, 40, 50]
+
+# داده قیمت در پروسس‌های worker (یک بار از طریق initializer تنظیم می‌شود)
+_WORKER_PRICE_DATA = None
+
+
+def _get_pool_context():
+    """
+    context مناسب multiprocessing.
+
+    روی لینوکس از fork استفاده می‌شود تا price_data بدون pickle به
+    worker ها به ارث برسد؛ در غیر این صورت (ویندوز/macOS) هر worker
+    فقط یک بار داده را از initializer دریافت می‌کند.
+    """
+    if 'fork' in mp.get_all_start_methods():
+        return mp.get_context('fork')
+    return mp.get_context()
+
+
+def _init_worker_metrics(enabled):
+    """
+    METRICS پروسس worker از صفر (fork شمارنده‌های والد را هم کپی می‌کند)؛
+    enabled همان وضعیت والد است (با spawn نمونه تازه غیرفعال است)
+    """
+    METRICS.reset()
+    METRICS.enabled = enabled
+
+
+def _worker_result(result):
+    """نتیجه worker + تغییرات METRICS همین task (برای ادغام در والد)"""
+    return result, METRICS.drain()
+
+
+def _merge_worker_result(item):
+    """سمت والد: ادغام تغییرات METRICS یک task worker → نتیجه"""
+    result, delta = item
+    METRICS.merge(delta)
+    return result
+
+
+def _init_scenario_worker(price_data, metrics_enabled=False):
+    """initializer پروسس‌های worker: ذخیره price_data در سطح ماژول"""
+    global _WORKER_PRICE_DATA
+    _WORKER_PRICE_DATA = price_data
+    _init_worker_metrics(metrics_enabled)
+
+
+def _timed_backtest(price_data, range_pct, backtest_kwargs):
+    """
+    بک‌تست یک بازه → (نتیجه، زمان اجرا به ثانیه)؛ داده بخش‌بندی‌شده
+    (gap_policy='split') با run_backtest_segmented (فقط معیارها)
+    """
+    started = time_module.perf_counter()
+    if _is_segmented(price_data):
+        kwargs = {k: v for k, v in backtest_kwargs.items()
+                  if k != 'metrics_only'}
+        result = run_backtest_segmented(price_data, range_pct, **kwargs)
+    else:
+        result = run_backtest_with_rebalance(price_data, range_pct,
+                                             **backtest_kwargs)
+    return result, time_module.perf_counter() - started
+
+
+def _observe_scenarios(scenarios, timed_results):
+    """ثبت زمان هر بازه در METRICS (زمان در worker اندازه گرفته شده)"""
+    for range_pct, (result, elapsed) in zip(scenarios, timed_results):
+        METRICS.observe('backtest_scenario', elapsed, range_pct)
+        yield result
+
+
+def _scenario_worker(task):
+    """اجرای یک بک‌تست در worker روی price_data مشترک → (نتیجه، زمان)"""
+    range_pct, backtest_kwargs = task
+    return _worker_result(_timed_backtest(_WORKER_PRICE_DATA, range_pct,
+                                          backtest_kwargs))
+
+
+def _kernel_worker(task):
+    """اجرای هسته تک‌گذر برای زیرمجموعه‌ای از بازه‌ها در worker"""
+    range_percents, kernel_kwargs = task
+    return _worker_result(backtest_all_widths(_WORKER_PRICE_DATA,
+                                              range_percents, **kernel_kwargs))
+
+
+def run_all_scenarios(price_data, scenarios, initial_capital=10000,
+                      engine='loop', workers=1, metrics_only=False,
+                      cache=None, dataset=None, verbose=True):
+    """
+    اجرای بک‌تست برای همه بازه‌ها
+
+    workers > 1 → اجرای موازی با ProcessPoolExecutor.
+    price_data فقط یک بار به هر worker منتقل می‌شود (نه برای هر بازه)
+    و نتایج به ترتیب scenarios برمی‌گردند.
+
+    metrics_only=True → فقط معیارهای خلاصه هر بازه (بدون تاریخچه)؛
+    انتقال نتایج از worker ها هم بسیار سبک‌تر می‌شود.
+
+    engine='kernel' → همه بازه‌ها در یک گذر روی سری (backtest_all_widths)؛
+    با workers > 1 بازه‌ها یک‌درمیان بین worker ها تقسیم می‌شوند.
+
+    cache (BacktestCache) → بازه‌های موجود در کش از آن خوانده می‌شوند و
+    فقط بقیه (با همان engine/workers) اجرا و در کش ذخیره می‌شوند.
+    dataset: برچسب داده برای cache.track (مثلاً 'CAKEUSDT/BNBUSDT@1h')؛
+    وقتی کندل‌های جدید اضافه شوند نتایج نسخه قبلی همان داده حذف می‌شوند.
+
+    داده با ستون segment (gap_policy='split') → هر بازه با
+    run_backtest_segmented (هر engine)؛ فقط metrics_only=True.
+    """
+    if _is_segmented(price_data) and not metrics_only:
+        raise ValueError("❌ داده gap_policy='split' (ستون segment) تاریخچه "
+                         "پیوسته ندارد؛ فقط با metrics_only=True (بدون "
+                         "نمودار) اجرا می‌شود")
+    scenarios = list(scenarios)
+    with METRICS.stage('backtest', engine):
+        if cache is not None:
+            return _run_scenarios_cached(price_data, scenarios,
+                                         initial_capital, engine, workers,
+                                         metrics_only, cache, dataset, verbose)
+        all_results = _run_scenarios(price_data, scenarios, initial_capital,
+                                     engine, workers, metrics_only, verbose)
+    METRICS.count('rows_backtested', len(price_data) * len(scenarios))
+    return all_results
+
+
+def _run_scenarios(price_data, scenarios, initial_capital, engine, workers,
+                   metrics_only, verbose):
+    """بدنه run_all_scenarios (بدون کش)"""
+    log = print if verbose else _silent
+    days = len(price_data) / infer_periods_per_day(price_data)
+    log("\n" + "═" * 90)
+    log(f"🚀 شروع بک‌تست - PancakeSwap V3 - CAKE/BNB ({days:.0f} روز)")
+    log("═" * 90)
+    log(f"{'بازه':^8} │ {'فعال%':^8} │ {'ریبالانس':^10} │ "
+        f"{'کارمزد خالص':^14} │ {'APR':^8} │ {'بازده':^10}")
+    log("─" * 90)
+
+    backtest_kwargs = {'initial_capital': initial_capital, 'engine': engine,
+                       'metrics_only': metrics_only}
+
+    if engine == 'kernel' and not _is_segmented(price_data):
+        kernel_kwargs = {'initial_capital': initial_capital,
+                         'metrics_only': metrics_only}
+        if workers and workers > 1 and len(scenarios) > 1:
+            workers = min(workers, len(scenarios))
+            # یک‌درمیان: بازه‌های باریک (پرریبالانس) بین worker ها پخش شوند
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=_get_pool_context(),
+                initializer=_init_scenario_worker,
+                initargs=(price_data, METRICS.enabled)
+            )
+            with executor:
+                parts = list(map(_merge_worker_result, executor.map(
+                    _kernel_worker,
+                    [(scenarios[k::workers], kernel_kwargs)
+                     for k in range(workers)]
+                )))
+            results = [None] * len(scenarios)
+            for k, part in enumerate(parts):
+                results[k::workers] = part
+        else:
+            results = backtest_all_widths(price_data, scenarios,
+                                          **kernel_kwargs)
+        all_results = _collect_scenario_results(scenarios, results, log)
+    elif workers and workers > 1 and len(scenarios) > 1:
+        workers = min(workers, len(scenarios))
+        chunksize = max(1, len(scenarios) // (workers * 4))
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=_get_pool_context(),
+            initializer=_init_scenario_worker,
+            initargs=(price_data, METRICS.enabled)
+        )
+        with executor:
+            # map نتایج را به ترتیب ورودی برمی‌گرداند → جدول مرتب می‌ماند
+            timed_results = map(_merge_worker_result, executor.map(
+                _scenario_worker,
+                [(r, backtest_kwargs) for r in scenarios],
+                chunksize=chunksize
+            ))
+            all_results = _collect_scenario_results(
+                scenarios, _observe_scenarios(scenarios, timed_results), log
+            )
+    else:
+        timed_results = (_timed_backtest(price_data, r, backtest_kwargs)
+                         for r in scenarios)
+        all_results = _collect_scenario_results(
+            scenarios, _observe_scenarios(scenarios, timed_results), log
+        )
+
+    log("─" * 90)
+    return all_results
+
+
+def _run_scenarios_cached(price_data, scenarios, initial_capital, engine,
+                          workers, metrics_only, cache, dataset, verbose):
+    """run_all_scenarios با کش: فقط بازه‌های غایب در کش اجرا می‌شوند"""
+    fingerprint = dataset_fingerprint(price_data)
+    if dataset is not None:
+        cache.track(dataset, fingerprint=fingerprint)
+    keys = {r: cache.make_key(fingerprint, r, initial_capital,
+                              metrics_only=metrics_only)
+            for r in scenarios}
+    cached = {r: cache.get(keys[r]) for r in scenarios}
+    missing = [r for r in scenarios if cached[r] is None]
+    if missing:
+        fresh = _run_scenarios(price_data, missing, initial_capital, engine,
+                               workers, metrics_only, verbose=False)
+        METRICS.count('rows_backtested', len(price_data) * len(missing))
+        for r, result in fresh.items():
+            cache.put(keys[r], result)
+            cached[r] = dict(result)
+
+    log = print if verbose else _silent
+    days = len(price_data) / infer_periods_per_day(price_data)
+    log("\n" + "═" * 90)
+    log(f"🚀 شروع بک‌تست - PancakeSwap V3 - CAKE/BNB ({days:.0f} روز) | "
+        f"کش: {len(scenarios) - len(missing)}/{len(scenarios)}")
+    log("═" * 90)
+    log(f"{'بازه':^8} │ {'فعال%':^8} │ {'ریبالانس':^10} │ "
+        f"{'کارمزد خالص':^14} │ {'APR':^8} │ {'بازده':^10}")
+    log("─" * 90)
+    # ریبالانس‌های بازه‌های تازه را _run_scenarios شمرده است
+    all_results = _collect_scenario_results(
+        scenarios, (cached[r] for r in scenarios), log,
+        count_rebalances=False
+    )
+    log("─" * 90)
+    return all_results
+
+
+def _collect_scenario_results(scenarios, results_iter, log=print,
+                              count_rebalances=True):
+    """جمع‌آوری نتایج به ترتیب scenarios + چاپ هر سطر به محض آماده شدن"""
+    all_results = {}
+    for range_pct, result in zip(scenarios, results_iter):
+        all_results[range_pct] = result
+        if count_rebalances:
+            METRICS.count('rebalances', result['rebalance_count'])
+
+        status = "✅" if result['total_return'] > 0 else "❌"
+        log(f"  ±{range_pct:2g}%   │ {result['active_percent']:6.1f}% │ "
+            f"{result['rebalance_count']:8d}  │ "
+            f"${result['total_fees_net']:10.0f}   │ "
+            f"{result['fee_apr']:6.1f}% │ "
+            f"{result['total_return']:+8.2f}% {status}")
+
+    return all_results
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ب: موتور بک‌تست برداری (NumPy)
+# ═══════════════════════════════════════════════════════════
+
+def _find_range_exit(prices, start, price_lower, price_upper, block=32,
+                     highs=None):
+    """
+    اولین اندیس >= start که قیمت خارج [price_lower, price_upper] است.
+
+    جستجو در بلوک‌های دوبرابرشونده انجام می‌شود تا برای بازه‌های
+    باریک (ریبالانس زیاد) کل سری هر بار اسکن نشود.
+    highs داده شود → prices کف کندل‌هاست و اولین کندلی که محدوده
+    [low, high] آن به مرز بازه رسیده برگردانده می‌شود.
+    اگر خروجی پیدا نشد → len(prices)
+    """
+    n = len(prices)
+    if highs is None:
+        highs = prices
+    while start < n:
+        stop = min(start + block, n)
+        seg = prices[start:stop]
+        seg_high = highs[start:stop]
+        # شرط معکوس (نه seg < lower | seg > upper) تا NaN هم مثل
+        # is_in_range «خارج بازه» حساب شود
+        hits = np.flatnonzero(~((seg >= price_lower) &
+                                (seg_high <= price_upper)))
+        if hits.size:
+            return start + int(hits[0])
+        start = stop
+        block *= 2
+    return n
+
+
+class PriceArrays:
+    """
+    ستون‌های price_data به صورت آرایه‌های float64 (یک بار تبدیل).
+
+    slice(lo, hi) فقط view می‌سازد (بدون کپی)، پس اجرای چندین بک‌تست
+    روی پنجره‌های هم‌پوشان (walk-forward) تبدیل DataFrame → NumPy را
+    تکرار نمی‌کند. fee_volume(fee_tier) = حجم × نرخ کارمزد، یک بار
+    برای کل سری هر fee tier ساخته و بین همه پنجره‌ها و بازه‌ها مشترک
+    است.
+    """
+
+    __slots__ = ('close', 'cake_usdt', 'bnb_usdt', 'volume', 'timestamps',
+                 'periods_per_day', '_root_volume', '_fee_volume', '_offset')
+
+    def __init__(self, close, cake_usdt, bnb_usdt, volume, timestamps,
+                 periods_per_day=24):
+        self.close = close
+        self.cake_usdt = cake_usdt
+        self.bnb_usdt = bnb_usdt
+        self.volume = volume
+        self.timestamps = timestamps
+        self.periods_per_day = periods_per_day
+        self._root_volume = volume
+        self._fee_volume = {}
+        self._offset = 0
+
+    @classmethod
+    def from_frame(cls, price_data):
+        return cls(
+            price_data['close'].to_numpy(dtype=np.float64),
+            price_data['cake_usdt'].to_numpy(dtype=np.float64),
+            price_data['bnb_usdt'].to_numpy(dtype=np.float64),
+            price_data['quote_volume'].to_numpy(dtype=np.float64),
+            price_data['timestamp'],
+            infer_periods_per_day(price_data),
+        )
+
+    def __len__(self):
+        return len(self.close)
+
+    def slice(self, lo, hi):
+        """view پنجره [lo, hi) با کش fee_volume مشترک با والد"""
+        window = PriceArrays(
+            self.close[lo:hi], self.cake_usdt[lo:hi], self.bnb_usdt[lo:hi],
+            self.volume[lo:hi], self.timestamps.iloc[lo:hi],
+            self.periods_per_day
+        )
+        window._root_volume = self._root_volume
+        window._fee_volume = self._fee_volume
+        window._offset = self._offset + lo
+        return window
+
+    def fee_volume(self, fee_tier):
+        """حجم × نرخ کارمزد (fee_tier درصد) برای همین پنجره"""
+        full = self._fee_volume.get(fee_tier)
+        if full is None:
+            full = self._root_volume * (fee_tier / 100)
+            self._fee_volume[fee_tier] = full
+        return full[self._offset:self._offset + len(self)]
+
+
+def _run_backtest_vectorized(price_data, range_percent, initial_capital,
+                             fee_tier, gas_cost_usd, slippage_pct,
+                             record_history=True, metrics_only=False):
+    """
+    موتور برداری run_backtest_with_rebalance.
+
+    به جای iloc ساعت‌به‌ساعت، روی آرایه‌های NumPy کار می‌کند:
+    1. از ابتدای هر بخش، اولین خروج از بازه با جستجوی برداری پیدا می‌شود
+    2. کارمزد و ارزش پوزیشن برای کل بخش یکجا محاسبه می‌شود
+    3. در اندیس خروج، ریبالانس (همان منطق موتور حلقه‌ای) انجام می‌شود
+
+    کارمزد هر ساعت فقط به «در بازه بودن» بستگی دارد (نه به L)،
+    پس یک بار برای کل سری محاسبه و با ماسک فعال بودن ضرب می‌شود.
+
+    بدون record_history، ارزش ساعتی پوزیشن اصلاً محاسبه نمی‌شود؛
+    فقط مرزهای بخش‌ها و ارزش در لحظه ریبالانس لازم است.
+
+    price_data می‌تواند PriceArrays (مثلاً پنجره slice) هم باشد.
+    """
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    close = arrays.close
+    cake_usdt = arrays.cake_usdt
+    bnb_usdt = arrays.bnb_usdt
+    volume = arrays.volume
+    timestamps = arrays.timestamps
+    n = len(close)
+
+    # ─── HODL ───
+    hodl_cake_amount = (initial_capital / 2) / cake_usdt[0]
+    hodl_bnb_amount = (initial_capital / 2) / bnb_usdt[0]
+
+    # ─── پوزیشن اولیه ───
+    position = LiquidityPositionV3()
+    entry_price = close[0]
+    position.open_position(
+        initial_capital, entry_price, range_percent,
+        cake_usdt[0], bnb_usdt[0]
+    )
+
+    total_gas_costs = 0
+    total_slippage_costs = 0
+    rebalance_count = 0
+    rebalance_indices = []
+
+    avg_daily_volume = volume.mean() * arrays.periods_per_day
+    estimated_tvl = avg_daily_volume * 5
+    our_share = min(initial_capital / estimated_tvl, 0.1)
+
+    concentration_factor = 100 / range_percent
+    fee_volume = arrays.fee_volume(fee_tier)
+    fee_if_active = np.minimum(
+        fee_volume * our_share * concentration_factor,
+        fee_volume * 0.5
+    )
+
+    active = np.zeros(n, dtype=bool)
+    if record_history:
+        pool_values = np.empty(n, dtype=np.float64)
+        range_changes = [(0, position.price_lower, position.price_upper,
+                          position.center_price)]
+
+    start = 0
+    while start < n:
+        price = close[start]
+
+        # ─── ریبالانسینگ (همان منطق موتور حلقه‌ای) ───
+        if not position.is_in_range(price):
+            current_pool_value = position.get_value_usd(
+                price, cake_usdt[start], bnb_usdt[start]
+            )
+            swap_value_usd = current_pool_value / 2
+            slippage = swap_value_usd * (slippage_pct / 100)
+            total_gas_costs += gas_cost_usd
+            total_slippage_costs += slippage
+            rebalance_capital = current_pool_value - gas_cost_usd - slippage
+
+            position.open_position(
+                max(rebalance_capital, 0), price, range_percent,
+                cake_usdt[start], bnb_usdt[start]
+            )
+            rebalance_count += 1
+            rebalance_indices.append(start)
+            if record_history:
+                range_changes.append((start, position.price_lower,
+                                      position.price_upper,
+                                      position.center_price))
+
+        # ─── بخش فعلی: تا اولین خروج بعدی ───
+        in_range = position.is_in_range(price)
+        if in_range:
+            end = _find_range_exit(close, start + 1,
+                                   position.price_lower, position.price_upper)
+        else:
+            print(f"   ⚠️ هشدار: بعد از ریبالانس هنوز خارج بازه! "
+                  f"idx={start}, price={price:.6f}, "
+                  f"range=[{position.price_lower:.6f}, {position.price_upper:.6f}]")
+            end = start + 1
+
+        active[start:end] = in_range
+        if record_history:
+            pool_values[start:end] = position.get_value_usd(
+                close[start:end], cake_usdt[start:end], bnb_usdt[start:end]
+            )
+
+        start = end
+
+    # ─── کارمزد و ارزش‌ها ───
+    fees = np.where(active, fee_if_active, 0.0)
+    cum_fees = np.cumsum(fees)
+    total_fees_usd = float(cum_fees[-1]) if n else 0
+
+    periods_in_range = int(active.sum())
+
+    results = _summarize_backtest(
+        range_percent, entry_price, position, initial_capital,
+        final_prices=(close[-1], cake_usdt[-1], bnb_usdt[-1]),
+        hodl_amounts=(hodl_cake_amount, hodl_bnb_amount),
+        total_fees_usd=total_fees_usd,
+        total_gas_costs=total_gas_costs,
+        total_slippage_costs=total_slippage_costs,
+        rebalance_count=rebalance_count,
+        periods_in_range=periods_in_range,
+        periods_out_of_range=n - periods_in_range,
+        periods_per_day=arrays.periods_per_day,
+    )
+    if metrics_only:
+        return results
+
+    results['rebalance_timestamps'] = \
+        timestamps.iloc[rebalance_indices].tolist()
+    if record_history:
+        results.update({
+            'fee_history': fees,
+            'pool_value_history': pool_values,
+            'hodl_value_history': hodl_cake_amount * cake_usdt +
+                                  hodl_bnb_amount * bnb_usdt,
+            'total_value_history': pool_values + cum_fees,
+            'range_history': RangeHistory(*zip(*range_changes), n),
+        })
+    else:
+        results.update(dict.fromkeys(_HISTORY_KEYS))
+
+    return results
+
+
+def generate_synthetic_pair_data(n_rows=8760, seed=42,
+                                 start='2024-01-01', freq='h'):
+    """
+    سری مصنوعی CAKE/BNB (حرکت براونی هندسی) با همان ستون‌های
+    خروجی get_pancakeswap_pair_data - برای بنچمارک بدون شبکه.
+    """
+    rng = np.random.default_rng(seed)
+    cake_usdt = 2.5 * np.exp(np.cumsum(rng.normal(0, 0.010, n_rows)))
+    bnb_usdt = 600 * np.exp(np.cumsum(rng.normal(0, 0.006, n_rows)))
+    cake_volume = rng.lognormal(np.log(2e6), 0.5, n_rows)
+    bnb_volume = rng.lognormal(np.log(3e7), 0.5, n_rows)
+
+    df = pd.DataFrame({
+        'timestamp': pd.date_range(start, periods=n_rows, freq=freq),
+        'cake_usdt': cake_usdt,
+        'bnb_usdt': bnb_usdt,
+        'cake_volume': cake_volume,
+        'bnb_volume': bnb_volume,
+    })
+    df['close'] = df['cake_usdt'] / df['bnb_usdt']
+    df['quote_volume'] = (df['cake_volume'] + df['bnb_volume']) / 2
+    return df
+
+
+def benchmark_backtest_engines(n_rows=8760, range_percents=(2, 5, 20),
+                               repeats=1, seed=42):
+    """
+    مقایسه سرعت و دقت موتور حلقه‌ای و برداری روی سری ۱ ساله مصنوعی.
+
+    Returns: لیست dict با زمان هر موتور، ضریب سرعت و بیشترین اختلاف
+    """
+    price_data = generate_synthetic_pair_data(n_rows, seed)
+    history_keys = ['fee_history', 'pool_value_history',
+                    'hodl_value_history', 'total_value_history']
+
+    print("\n" + "═" * 75)
+    print(f"⏱️ بنچمارک موتورهای بک‌تست ({n_rows:,} کندل)")
+    print("═" * 75)
+
+    rows = []
+    for range_pct in range_percents:
+        timings = {}
+        outputs = {}
+        for engine in ('loop', 'vectorized'):
+            best = float('inf')
+            for _ in range(repeats):
+                t0 = time_module.perf_counter()
+                outputs[engine] = run_backtest_with_rebalance(
+                    price_data, range_pct, engine=engine
+                )
+                best = min(best, time_module.perf_counter() - t0)
+            timings[engine] = best
+
+        ref, vec = outputs['loop'], outputs['vectorized']
+        max_diff = max(
+            abs(ref['total_return'] - vec['total_return']),
+            abs(ref['fee_apr'] - vec['fee_apr']),
+            abs(ref['impermanent_loss'] - vec['impermanent_loss']),
+            *(float(np.max(np.abs(np.asarray(ref[k]) - np.asarray(vec[k]))))
+              for k in history_keys)
+        )
+        matches = (ref['rebalance_count'] == vec['rebalance_count'] and
+                   max_diff < 1e-6)
+        speedup = timings['loop'] / max(timings['vectorized'], 1e-12)
+
+        print(f"  ±{range_pct:2g}% │ loop: {timings['loop']:7.3f}s │ "
+              f"vectorized: {timings['vectorized']:7.4f}s │ "
+              f"x{speedup:6.1f} │ rebal: {vec['rebalance_count']:5d} │ "
+              f"{'✅' if matches else '❌'} (Δmax={max_diff:.2e})")
+
+        rows.append({
+            'range_percent': range_pct,
+            'loop_seconds': timings['loop'],
+            'vectorized_seconds': timings['vectorized'],
+            'speedup': speedup,
+            'max_abs_diff': max_diff,
+            'matches': matches,
+        })
+
+    print("─" * 75)
+    return rows
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ج: جستجوی شبکه‌ای (بازه × fee tier × gas × slippage)
+# ═══════════════════════════════════════════════════════════
+
+# ستون‌های خروجی جستجوی شبکه‌ای (به همین ترتیب در فایل نوشته می‌شوند)
+GRID_PARAM_COLUMNS = ['range_percent', 'fee_tier', 'gas_cost_usd',
+                      'slippage_pct']
+GRID_METRIC_COLUMNS = ['total_return', 'fee_apr', 'rebalance_count',
+                       'impermanent_loss', 'vs_hodl', 'active_percent',
+                       'total_fees_net', 'final_total_value']
+
+
+def build_parameter_grid(range_percents=None, fee_tiers=(0.01, 0.05, 0.25, 1.0),
+                         gas_costs=(0.10, 0.30, 1.00),
+                         slippages=(0.05, 0.1, 0.3)):
+    """
+    ساخت شبکه پارامترها (ضرب دکارتی).
+
+    پیش‌فرض بازه‌ها: ±0.5% تا ±50% با گام 0.1%
+    Returns: لیست tuple های (range_percent, fee_tier, gas_cost_usd, slippage_pct)
+    """
+    if range_percents is None:
+        range_percents = np.round(np.arange(0.5, 50.0 + 1e-9, 0.1), 4).tolist()
+    return list(itertools.product(range_percents, fee_tiers,
+                                  gas_costs, slippages))
+
+
+def rebalance_schedule(price_data, range_percent):
+    """
+    زمان‌بندی ریبالانس یک بازه (همان حلقه بخش‌ها در موتور برداری).
+
+    اینکه ریبالانس کی رخ می‌دهد فقط به سری قیمت و range_percent بستگی
+    دارد: بازه جدید حول قیمت فعلی ساخته می‌شود و is_in_range فقط مرزها
+    را می‌بیند. سرمایه، gas، slippage و fee tier فقط L و هزینه‌ها را
+    عوض می‌کنند، نه مرزها را.
+
+    Returns: (آرایه اندیس‌های ریبالانس، ماسک bool فعال بودن هر کندل)
+    """
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    close = arrays.close
+    n = len(close)
+    active = np.zeros(n, dtype=bool)
+    rebalance_indices = []
+
+    price_lower = close[0] * (1 - range_percent / 100)
+    price_upper = close[0] * (1 + range_percent / 100)
+    start = 0
+    while start < n:
+        price = close[start]
+        if not price_lower <= price <= price_upper:
+            price_lower = price * (1 - range_percent / 100)
+            price_upper = price * (1 + range_percent / 100)
+            rebalance_indices.append(start)
+
+        in_range = price_lower <= price <= price_upper
+        end = _find_range_exit(close, start + 1, price_lower, price_upper) \
+            if in_range else start + 1
+        active[start:end] = in_range
+        start = end
+
+    return np.asarray(rebalance_indices, dtype=np.int64), active
+
+
+def sweep_cost_variants(price_data, range_percent, variants):
+    """
+    بک‌تست یک بازه برای همه variants با یک زمان‌بندی ریبالانس مشترک.
+
+    variants: لیست (initial_capital, fee_tier, gas_cost_usd, slippage_pct)
+
+    زمان‌بندی و ماسک فعال بودن یک بار ساخته می‌شود (rebalance_schedule)؛
+    بعد زنجیره سرمایه همه variants با هم روی اندیس‌های ریبالانس جلو
+    می‌رود (_open_positions_vec / _position_values_vec) و کارمزد هر
+    (سرمایه، fee tier) یک جمع روی کندل‌های فعال است. هزینه تقریباً
+    مستقل از تعداد variants است.
+
+    Returns: لیست dict معیارها به ترتیب variants - همان خروجی
+             run_backtest_with_rebalance(..., metrics_only=True)
+    """
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    close = arrays.close
+    cake_usdt = arrays.cake_usdt
+    bnb_usdt = arrays.bnb_usdt
+    n = len(close)
+    rebalance_indices, active = rebalance_schedule(arrays, range_percent)
+
+    params = np.asarray(variants, dtype=np.float64).reshape(-1, 4)
+    capital, _, gas_costs, slippages = params.T
+
+    # ─── زنجیره سرمایه روی ریبالانس‌ها (همه variants با هم) ───
+    L, lower, upper, sqrt_pa, sqrt_pb = _open_positions_vec(
+        capital, close[0], range_percent, cake_usdt[0], bnb_usdt[0]
+    )
+    total_gas = np.zeros(len(params))
+    total_slippage = np.zeros(len(params))
+    last_open = 0
+    for idx in rebalance_indices:
+        value = _position_values_vec(
+            close[idx], L, lower, upper, sqrt_pa, sqrt_pb,
+            cake_usdt[idx], bnb_usdt[idx]
+        )
+        slippage = (value / 2) * (slippages / 100)
+        total_gas += gas_costs
+        total_slippage += slippage
+        capital = np.maximum(value - gas_costs - slippage, 0)
+        L, lower, upper, sqrt_pa, sqrt_pb = _open_positions_vec(
+            capital, close[idx], range_percent, cake_usdt[idx], bnb_usdt[idx]
+        )
+        last_open = idx
+
+    # ─── کارمزد: فقط به (سرمایه، fee tier) و ماسک فعال بستگی دارد ───
+    estimated_tvl = arrays.volume.mean() * arrays.periods_per_day * 5
+    concentration_factor = 100 / range_percent
+    active_volume = {}
+    fees_by_key = {}
+
+    def total_fees(initial_capital, fee_tier):
+        key = (initial_capital, fee_tier)
+        if key not in fees_by_key:
+            if fee_tier not in active_volume:
+                active_volume[fee_tier] = arrays.fee_volume(fee_tier)[active]
+            fee_volume = active_volume[fee_tier]
+            our_share = min(initial_capital / estimated_tvl, 0.1)
+            fees = np.minimum(fee_volume * our_share * concentration_factor,
+                              fee_volume * 0.5)
+            # همان ترتیب جمع cumsum موتور برداری (صفرها اثری ندارند)
+            fees_by_key[key] = float(np.cumsum(fees)[-1]) if len(fees) \
+                else 0.0
+        return fees_by_key[key]
+
+    periods_in_range = int(active.sum())
+    results = []
+    for v, (initial_capital, fee_tier, _, _) in enumerate(variants):
+        position = LiquidityPositionV3()
+        position.open_position(capital[v], close[last_open], range_percent,
+                               cake_usdt[last_open], bnb_usdt[last_open])
+        results.append(_summarize_backtest(
+            range_percent, close[0], position, initial_capital,
+            final_prices=(close[-1], cake_usdt[-1], bnb_usdt[-1]),
+            hodl_amounts=((initial_capital / 2) / cake_usdt[0],
+                          (initial_capital / 2) / bnb_usdt[0]),
+            total_fees_usd=total_fees(initial_capital, fee_tier),
+            total_gas_costs=float(total_gas[v]),
+            total_slippage_costs=float(total_slippage[v]),
+            rebalance_count=len(rebalance_indices),
+            periods_in_range=periods_in_range,
+            periods_out_of_range=n - periods_in_range,
+            periods_per_day=arrays.periods_per_day,
+        ))
+    return results
+
+
+def _run_grid_batch(price_data, batch, initial_capital, engine,
+                    share_paths=False):
+    """
+    اجرای یک دسته از پیکربندی‌ها (metrics_only) → لیست ردیف‌ها
+
+    share_paths=True → هر بازه یک بار (sweep_cost_variants)
+    """
+    if share_paths:
+        by_width = {}
+        for config in batch:
+            by_width.setdefault(config[0], []).append(config)
+        metrics_by_config = {}
+        for range_pct, configs in by_width.items():
+            variants = [(initial_capital,) + tuple(c[1:]) for c in configs]
+            metrics_by_config.update(zip(
+                configs, sweep_cost_variants(price_data, range_pct, variants)
+            ))
+        metrics_list = [metrics_by_config[config] for config in batch]
+    else:
+        metrics_list = [
+            run_backtest_with_rebalance(
+                price_data, range_pct, initial_capital,
+                fee_tier=fee_tier, gas_cost_usd=gas_cost,
+                slippage_pct=slippage, engine=engine, metrics_only=True
+            )
+            for range_pct, fee_tier, gas_cost, slippage in batch
+        ]
+    return [tuple(config) + tuple(metrics[c] for c in GRID_METRIC_COLUMNS)
+            for config, metrics in zip(batch, metrics_list)]
+
+
+def _grid_batch_worker(task):
+    """worker جستجوی شبکه‌ای روی price_data مشترک (_init_scenario_worker)"""
+    batch, initial_capital, engine, share_paths = task
+    return _worker_result(_run_grid_batch(_WORKER_PRICE_DATA, batch,
+                                          initial_capital, engine,
+                                          share_paths))
+
+
+COST_SWEEP_PARAM_COLUMNS = ['range_percent', 'initial_capital', 'fee_tier',
+                            'gas_cost_usd', 'slippage_pct']
+
+
+def _cost_sweep_worker(task):
+    """worker حساسیت هزینه: یک بازه، همه variants (_init_scenario_worker)"""
+    range_pct, variants = task
+    return _worker_result(sweep_cost_variants(_WORKER_PRICE_DATA, range_pct,
+                                              variants))
+
+
+def run_cost_sweep(price_data, range_percents=None, capitals=(10000,),
+                   fee_tiers=(0.25,), gas_costs=(0.30,), slippages=(0.1,),
+                   workers=None, verbose=True):
+    """
+    حساسیت به هزینه: همه ترکیب‌های (سرمایه، fee tier، gas، slippage)
+    برای هر بازه، با یک زمان‌بندی ریبالانس برای هر بازه.
+
+    شبکه‌ای با صدها نقطه gas/slippage تقریباً هم‌هزینه یک بک‌تست به ازای
+    هر بازه است؛ بازه‌ها بین worker ها پخش می‌شوند.
+
+    Returns: DataFrame با ستون‌های COST_SWEEP_PARAM_COLUMNS +
+             GRID_METRIC_COLUMNS (بازه × variants به ترتیب ورودی)
+    """
+    if range_percents is None:
+        range_percents = list(DEFAULT_SCENARIOS)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    variants = list(itertools.product(capitals, fee_tiers, gas_costs,
+                                      slippages))
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+
+    if verbose:
+        print(f"\n💸 حساسیت هزینه: {len(range_percents)} بازه × "
+              f"{len(variants):,} variant ({workers} worker)")
+    t0 = time_module.perf_counter()
+
+    if workers > 1 and len(range_percents) > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(range_percents)),
+            mp_context=_get_pool_context(),
+            initializer=_init_scenario_worker,
+            initargs=(arrays, METRICS.enabled)
+        )
+        with executor:
+            results = list(map(_merge_worker_result, executor.map(
+                _cost_sweep_worker,
+                [(range_pct, variants) for range_pct in range_percents]
+            )))
+    else:
+        results = [sweep_cost_variants(arrays, range_pct, variants)
+                   for range_pct in range_percents]
+
+    rows = [(range_pct,) + variant +
+            tuple(metrics[c] for c in GRID_METRIC_COLUMNS)
+            for range_pct, metrics_list in zip(range_percents, results)
+            for variant, metrics in zip(variants, metrics_list)]
+
+    if verbose:
+        elapsed = time_module.perf_counter() - t0
+        print(f"   ⏱️ {elapsed:.2f}s ({len(rows) / max(elapsed, 1e-9):,.0f} "
+              f"پیکربندی/ثانیه)")
+    return pd.DataFrame(rows, columns=COST_SWEEP_PARAM_COLUMNS +
+                        GRID_METRIC_COLUMNS)
+
+
+def pareto_front(results_df, maximize='total_return',
+                 minimize='rebalance_count'):
+    """
+    جبهه پارتو: پیکربندی‌هایی که هیچ پیکربندی دیگری با ریبالانس کمتر
+    (یا مساوی) بازده بیشتری ندارد.
+    """
+    ordered = results_df.sort_values([minimize, maximize],
+                                     ascending=[True, False])
+    best_so_far = ordered[maximize].cummax().shift(fill_value=-np.inf)
+    front = ordered[ordered[maximize] > best_so_far]
+    # از هر تعداد ریبالانس فقط بهترین
+    return front.drop_duplicates(subset=minimize).reset_index(drop=True)
+
+
+def run_grid_search(price_data, grid=None, initial_capital=10000,
+                    workers=None, batch_size=64, engine='vectorized',
+                    output_path='pancakeswap_grid_v3.csv', verbose=True,
+                    share_paths=True):
+    """
+    جستجوی شبکه‌ای روی run_backtest_with_rebalance.
+
+    - پیکربندی‌ها در دسته‌های batch_size به process pool فرستاده می‌شوند
+      (price_data یک بار به هر worker می‌رسد)
+    - هر دسته به محض اتمام به فایل خروجی اضافه می‌شود (stream)؛
+      اگر اجرا قطع شود، نتایج دسته‌های تمام‌شده در فایل می‌ماند
+    - در پایان جبهه پارتو «بازده ↔ تعداد ریبالانس» گزارش می‌شود
+    - share_paths=True → همه پیکربندی‌های یک بازه در یک دسته و با یک
+      زمان‌بندی ریبالانس (sweep_cost_variants)؛ نتایج همان بک‌تست تکی
+
+    Returns: (results_df به ترتیب grid، pareto_df)
+    """
+    if grid is None:
+        grid = build_parameter_grid()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if share_paths:
+        # هر بازه کامل در یک دسته؛ بازه‌های کوچک تا batch_size کنار هم
+        by_width = {}
+        for i, config in enumerate(grid):
+            by_width.setdefault(config[0], []).append(i)
+        batch_indices = []
+        for indices in by_width.values():
+            if batch_indices and \
+                    len(batch_indices[-1]) + len(indices) <= batch_size:
+                batch_indices[-1].extend(indices)
+            else:
+                batch_indices.append(indices)
+    else:
+        batch_indices = [range(i, min(i + batch_size, len(grid)))
+                         for i in range(0, len(grid), batch_size)]
+    batches = [[grid[i] for i in indices] for indices in batch_indices]
+    columns = GRID_PARAM_COLUMNS + GRID_METRIC_COLUMNS
+
+    if verbose:
+        print("\n" + "═" * 90)
+        print(f"🔎 جستجوی شبکه‌ای: {len(grid):,} پیکربندی در "
+              f"{len(batches)} دسته ({workers} worker)")
+        print("═" * 90)
+
+    results_by_batch = [None] * len(batches)
+    t0 = time_module.perf_counter()
+    done_configs = 0
+
+    with open(output_path, 'w', encoding='utf-8', newline='') as out:
+        out.write(','.join(columns) + '\n')
+
+        def write_batch(k, rows):
+            nonlocal done_configs
+            results_by_batch[k] = rows
+            out.writelines(','.join(str(v) for v in row) + '\n'
+                           for row in rows)
+            out.flush()
+            done_configs += len(rows)
+            if verbose:
+                elapsed = time_module.perf_counter() - t0
+                print(f"   ✓ {done_configs:,}/{len(grid):,} پیکربندی "
+                      f"({done_configs / max(elapsed, 1e-9):,.0f}/s)")
+
+        if workers > 1 and len(batches) > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=min(workers, len(batches)),
+                mp_context=_get_pool_context(),
+                initializer=_init_scenario_worker,
+                initargs=(price_data, METRICS.enabled)
+            )
+            with executor:
+                futures = {
+                    executor.submit(_grid_batch_worker,
+                                    (batch, initial_capital, engine,
+                                     share_paths)): k
+                    for k, batch in enumerate(batches)
+                }
+                for future in as_completed(futures):
+                    write_batch(futures[future],
+                                _merge_worker_result(future.result()))
+        else:
+            for k, batch in enumerate(batches):
+                write_batch(k, _run_grid_batch(price_data, batch,
+                                               initial_capital, engine,
+                                               share_paths))
+
+    rows_in_grid_order = [None] * len(grid)
+    for indices, rows in zip(batch_indices, results_by_batch):
+        for i, row in zip(indices, rows):
+            rows_in_grid_order[i] = row
+    results_df = pd.DataFrame(rows_in_grid_order, columns=columns)
+    front = pareto_front(results_df)
+
+    if verbose:
+        elapsed = time_module.perf_counter() - t0
+        print("─" * 90)
+        print(f"   ⏱️ {elapsed:.1f}s ({len(grid) / max(elapsed, 1e-9):,.0f} "
+              f"پیکربندی/ثانیه) | 💾 {output_path}")
+        print(f"\n🏅 جبهه پارتو (بازده ↔ تعداد ریبالانس): {len(front)} نقطه")
+        print(f"{'بازه':^8} │ {'fee':^6} │ {'gas':^6} │ {'slip':^6} │ "
+              f"{'ریبالانس':^9} │ {'بازده':^10}")
+        print("─" * 60)
+        for _, row in front.iterrows():
+            print(f"  ±{row['range_percent']:5.1f}% │ "
+                  f"{row['fee_tier']:5.2f}% │ ${row['gas_cost_usd']:4.2f} │ "
+                  f"{row['slippage_pct']:4.2f}% │ "
+                  f"{int(row['rebalance_count']):8d} │ "
+                  f"{row['total_return']:+8.2f}%")
+        print("─" * 60)
+
+    return results_df, front
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-د: جستجوی تطبیقی بهترین بازه (bracketing + golden-section)
+# ═══════════════════════════════════════════════════════════
+
+def _backtest_cost_params(initial_capital=10000, fee_tier=0.25,
+                          gas_cost_usd=0.30, slippage_pct=0.1, **_):
+    """
+    پارامترهایی که نتیجه بک‌تست به آن‌ها وابسته است (پیش‌فرض‌ها همان
+    run_backtest_with_rebalance)؛ بقیه kwargs (engine، ...) نادیده گرفته
+    می‌شوند.
+    """
+    return (float(initial_capital), float(fee_tier), float(gas_cost_usd),
+            float(slippage_pct))
+
+
+class RangeObjective:
+    """
+    تابع هدف بر حسب range_percent با کش نقاط ارزیابی‌شده.
+
+    هر ارزیابی یک بک‌تست metrics_only است؛ کل dict معیارها کش می‌شود
+    تا چند هدف مختلف (total_return، vs_hodl، ...) از همان بک‌تست‌ها
+    استفاده کنند.
+
+    objective: نام کلید در نتایج (بیشینه می‌شود) یا تابع metrics → float
+    """
+
+    def __init__(self, price_data, initial_capital=10000, engine='vectorized',
+                 **backtest_kwargs):
+        self.price_data = price_data
+        self.initial_capital = initial_capital
+        self.engine = engine
+        self.backtest_kwargs = backtest_kwargs
+        self.cost_params = _backtest_cost_params(initial_capital,
+                                                 **backtest_kwargs)
+        self.cache = {}
+        self.backtests = 0
+        self.seeded = 0
+
+    @property
+    def evaluations(self):
+        """تعداد بک‌تست‌های واقعاً اجراشده (بدون نقاط seed)"""
+        return self.backtests
+
+    def seed(self, all_results, **cost_params):
+        """
+        افزودن نتایج موجود (مثلاً خروجی run_all_scenarios) به کش.
+
+        cost_params: initial_capital / fee_tier / gas_cost_usd /
+        slippage_pct که نتایج با آن‌ها ساخته شده‌اند (پیش‌فرض‌های
+        run_backtest_with_rebalance)؛ اگر با همین تابع هدف یکی نباشند
+        ValueError - نتیجه یک پیکربندی دیگر نباید جای این یکی بنشیند.
+        """
+        seed_params = _backtest_cost_params(**cost_params)
+        if seed_params != self.cost_params:
+            raise ValueError(
+                f"❌ نتایج seed با پارامترهای دیگری ساخته شده‌اند: "
+                f"{seed_params} ≠ {self.cost_params} "
+                f"(initial_capital, fee_tier, gas_cost_usd, slippage_pct)"
+            )
+        for range_pct, result in all_results.items():
+            key = round(float(range_pct), 6)
+            if key not in self.cache:
+                self.cache[key] = result
+                self.seeded += 1
+
+    def metrics(self, range_percent):
+        key = round(float(range_percent), 6)
+        if key not in self.cache:
+            self.cache[key] = run_backtest_with_rebalance(
+                self.price_data, key, self.initial_capital,
+                engine=self.engine, metrics_only=True, **self.backtest_kwargs
+            )
+            self.backtests += 1
+        return self.cache[key]
+
+    def value(self, range_percent, objective='total_return'):
+        metrics = self.metrics(range_percent)
+        return objective(metrics) if callable(objective) \
+            else metrics[objective]
+
+
+def _golden_section_max(f, a, b, tol):
+    """بیشینه f روی [a, b] با golden-section (فرض: تک‌قله‌ای در براکت)"""
+    inv_phi = (math.sqrt(5) - 1) / 2
+    c = b - inv_phi * (b - a)
+    d = a + inv_phi * (b - a)
+    fc, fd = f(c), f(d)
+    while b - a > tol:
+        if fc >= fd:
+            b, d, fd = d, c, fc
+            c = b - inv_phi * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + inv_phi * (b - a)
+            fd = f(d)
+    return a, b
+
+
+def optimize_range_width(price_data, objectives=('total_return',),
+                         coarse=None, low=0.5, high=50.0, tol=0.05,
+                         initial_capital=10000, seed_results=None,
+                         seed_params=None, range_objective=None,
+                         verbose=True, **backtest_kwargs):
+    """
+    یافتن بهترین range_percent با چند ده بک‌تست به جای جستجوی کامل.
+
+    1. براکت: ارزیابی روی شبکه درشت (پیش‌فرض ۱۲ نقطه لگاریتمی)
+    2. براکت [همسایه چپ، همسایه راست] بهترین نقطه درشت
+    3. golden-section داخل براکت تا عرض tol (درصد)
+
+    چون تابع هدف لزوماً تک‌قله‌ای نیست (تعداد ریبالانس پله‌ای است)،
+    بهترین نقطه از بین همه نقاط ارزیابی‌شده گزارش می‌شود.
+
+    seed_results: نتایج موجود (run_all_scenarios) → بدون بک‌تست مجدد
+    seed_params: پارامترهای هزینه‌ای که seed_results با آن‌ها ساخته شده
+                 (مثلاً {'initial_capital': 5000})؛ باید با همین جستجو
+                 یکی باشد (RangeObjective.seed)
+
+    Returns: {'objectives': {objective: {'range_percent', 'value',
+                                         'metrics', 'bracket',
+                                         'evaluations'}},
+              'backtests': تعداد بک‌تست‌های واقعاً اجراشده،
+              'seeded': تعداد نقاط seed}
+    """
+    if coarse is None:
+        coarse = np.geomspace(low, high, 12)
+    coarse = sorted({round(float(r), 6) for r in coarse})
+
+    if range_objective is None:
+        range_objective = RangeObjective(price_data, initial_capital,
+                                         **backtest_kwargs)
+    if seed_results:
+        range_objective.seed(seed_results, **(seed_params or {}))
+
+    report = {}
+    for objective in objectives:
+        name = getattr(objective, '__name__', objective)
+        before = range_objective.evaluations
+
+        def f(r):
+            return range_objective.value(r, objective)
+
+        coarse_values = [f(r) for r in coarse]
+        i = int(np.argmax(coarse_values))
+        a = coarse[max(i - 1, 0)]
+        b = coarse[min(i + 1, len(coarse) - 1)]
+        if b - a > tol:
+            _golden_section_max(f, a, b, tol)
+
+        candidates = [r for r in range_objective.cache if a <= r <= b] + \
+                     [coarse[i]]
+        best = max(candidates, key=f)
+        report[name] = {
+            'range_percent': best,
+            'value': f(best),
+            'metrics': range_objective.metrics(best),
+            'bracket': (a, b),
+            'evaluations': range_objective.evaluations - before,
+        }
+
+        if verbose:
+            print(f"   🎯 {name}: بهترین بازه ±{best:.2f}% "
+                  f"(مقدار: {f(best):+.2f}، براکت [{a:.2f}, {b:.2f}]، "
+                  f"{report[name]['evaluations']} بک‌تست جدید)")
+
+    if verbose:
+        print(f"   🔢 مجموع بک‌تست‌ها: {range_objective.evaluations} "
+              f"(+ {range_objective.seeded} نتیجه seed)")
+    return {'objectives': report, 'backtests': range_objective.evaluations,
+            'seeded': range_objective.seeded}
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ه: بک‌تست دسته‌ای چند استخر
+# ═══════════════════════════════════════════════════════════
+
+_WORKER_PAIR_DATA = None
+
+
+def _init_pair_worker(pair_data, metrics_enabled=False):
+    """initializer پروسس‌های worker: ذخیره داده همه استخرها در سطح ماژول"""
+    global _WORKER_PAIR_DATA
+    _WORKER_PAIR_DATA = pair_data
+    _init_worker_metrics(metrics_enabled)
+
+
+def _pair_scenario_worker(task):
+    """یک بک‌تست (استخر، بازه) روی داده مشترک worker → + زمان اجرا"""
+    pair_key, range_pct, backtest_kwargs = task
+    return _worker_result((pair_key, range_pct) + _timed_backtest(
+        _WORKER_PAIR_DATA[pair_key], range_pct, backtest_kwargs
+    ))
+
+
+def run_multi_pair_batch(pairs, scenarios=DEFAULT_SCENARIOS, target_days=365,
+                         initial_capital=10000, engine='vectorized',
+                         workers=None, gas_cost_usd=0.30, slippage_pct=0.1,
+                         pair_data=None, verbose=True, **data_kwargs):
+    """
+    جستجوی بازه برای چند استخر (مثلاً CAKE/BNB@0.25، ETH/BNB@0.05، ...).
+
+    - داده‌ها با load_pairs_data: هر leg مشترک (مثل BNBUSDT) یک بار
+    - همه بک‌تست‌های (استخر × بازه) در یک process pool زمان‌بندی
+      می‌شوند (تقسیم بار بهتر از یک pool به ازای هر استخر)؛
+      fee tier هر بک‌تست از خود استخر می‌آید
+    - metrics_only: فقط معیارهای خلاصه
+
+    pairs: لیست PoolPair یا رشته ('CAKE/BNB@0.25')
+    pair_data: {pair.key: DataFrame} آماده (بدون دانلود)
+
+    Returns: ({pair.key: {'pair', 'results', 'best_range', 'best'}},
+              DataFrame خلاصه - بهترین بازه هر استخر)
+    """
+    pairs = [PoolPair.parse(p) if isinstance(p, str) else p for p in pairs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if pair_data is None:
+        pair_data = load_pairs_data(pairs, target_days, verbose=verbose,
+                                    **data_kwargs)
+
+    tasks = [
+        (pair.key, range_pct, {
+            'initial_capital': initial_capital,
+            'fee_tier': pair.fee_tier,
+            'gas_cost_usd': gas_cost_usd,
+            'slippage_pct': slippage_pct,
+            'engine': engine,
+            'metrics_only': True,
+        })
+        for pair in pairs for range_pct in scenarios
+    ]
+
+    if verbose:
+        print("\n" + "═" * 90)
+        print(f"🚀 بک‌تست {len(pairs)} استخر × {len(scenarios)} بازه = "
+              f"{len(tasks)} بک‌تست ({workers} worker)")
+        print("═" * 90)
+
+    results = {pair.key: {} for pair in pairs}
+    t0 = time_module.perf_counter()
+    with METRICS.stage('backtest', engine):
+        if workers > 1 and len(tasks) > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=min(workers, len(tasks)),
+                mp_context=_get_pool_context(),
+                initializer=_init_pair_worker,
+                initargs=(pair_data, METRICS.enabled)
+            )
+            with executor:
+                # تکه‌های کوچک: بازه‌های باریک کندترند، پس ترتیب ثابت بار
+                # را نامتوازن می‌کند
+                timed_results = list(map(_merge_worker_result, executor.map(
+                    _pair_scenario_worker, tasks, chunksize=1
+                )))
+        else:
+            timed_results = [(pair_key, range_pct) + _timed_backtest(
+                                 pair_data[pair_key], range_pct, kwargs)
+                             for pair_key, range_pct, kwargs in tasks]
+        for pair_key, range_pct, metrics, elapsed in timed_results:
+            results[pair_key][range_pct] = metrics
+            METRICS.observe('backtest_scenario', elapsed,
+                            f'{pair_key}:{range_pct}')
+            METRICS.count('rebalances', metrics['rebalance_count'])
+            METRICS.count('rows_backtested', len(pair_data[pair_key]))
+
+    reports = {}
+    rows = []
+    for pair in pairs:
+        pair_results = results[pair.key]
+        best_range = max(pair_results,
+                         key=lambda r: pair_results[r]['total_return'])
+        best = pair_results[best_range]
+        reports[pair.key] = {
+            'pair': pair,
+            'results': pair_results,
+            'best_range': best_range,
+            'best': best,
+        }
+        rows.append({
+            'pair': pair.name,
+            'fee_tier': pair.fee_tier,
+            'best_range': best_range,
+            'days': best['days'],
+            'total_return': best['total_return'],
+            'fee_apr': best['fee_apr'],
+            'rebalance_count': best['rebalance_count'],
+            'vs_hodl': best['vs_hodl'],
+        })
+    overview = pd.DataFrame(rows)
+
+    if verbose:
+        elapsed = time_module.perf_counter() - t0
+        print(f"{'استخر':^16} │ {'fee':^6} │ {'بهترین':^8} │ "
+              f"{'ریبالانس':^9} │ {'APR':^8} │ {'بازده':^10}")
+        print("─" * 72)
+        for row in rows:
+            best_label = f"±{row['best_range']:g}%"
+            print(f"  {row['pair']:<14} │ {row['fee_tier']:5.2f}% │ "
+                  f"{best_label:^8} │ {row['rebalance_count']:8d} │ "
+                  f"{row['fee_apr']:6.1f}% │ {row['total_return']:+8.2f}%")
+        print("─" * 72)
+        print(f"   ⏱️ {elapsed:.1f}s")
+
+    return reports, overview
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-و: بک‌تست افزایشی (کندل به کندل)
+# ═══════════════════════════════════════════════════════════
+
+class StreamingBacktest:
+    """
+    بک‌تست حالت‌دار برای اجرای زنده: هر کندل جدید با update() و O(1).
+
+    منطق هر کندل دقیقاً همان حلقه run_backtest_with_rebalance است
+    (ریبالانس ۵۰/۵۰ حول قیمت فعلی، gas + slippage، کارمزد)؛ فقط
+    حالت (پوزیشن، جمع کارمزدها و هزینه‌ها، شمارنده‌ها) بین فراخوانی‌ها
+    نگه داشته می‌شود و هیچ تاریخچه‌ای ذخیره نمی‌شود.
+
+    update_block() یک تکه کامل (DataFrame یا PriceArrays) را با جستجوی
+    برداری خروج از بازه (مثل موتور vectorized) اعمال می‌کند؛ پایه
+    run_backtest_chunked برای سری‌های ۱ دقیقه‌ای. start()، rebalance() و
+    accrue() همان قدم‌ها جداگانه‌اند برای موتورهایی که زمان ریبالانس را
+    خودشان تعیین می‌کنند (run_backtest_intrabar).
+
+    سهم ما از حجم (our_share) در بک‌تست کامل از میانگین حجم کل بازه
+    به دست می‌آید؛ اینجا یک بار از avg_volume (میانگین حجم هر کندل)
+    ثابت می‌شود (from_history → میانگین همان تاریخچه، پس نتایج با
+    بک‌تست کامل روی همان داده یکی است).
+
+    snapshot()/restore() → حالت به صورت dict قابل JSON؛ save()/load()
+    روی دیسک. کندل‌های تکراری یا قدیمی‌تر از آخرین کندل نادیده گرفته
+    می‌شوند، پس پس از restart می‌توان از هر جای نزدیک دوباره خواند.
+    """
+
+    __slots__ = ('range_percent', 'initial_capital', 'fee_tier',
+                 'gas_cost_usd', 'slippage_pct', 'periods_per_day',
+                 'our_share', 'position', 'entry_price', 'hodl_cake_amount',
+                 'hodl_bnb_amount', 'total_fees_usd', 'total_gas_costs',
+                 'total_slippage_costs', 'rebalance_count',
+                 'periods_in_range', 'periods_out_of_range',
+                 'last_timestamp', 'last_rebalance_timestamp', 'last_prices')
+
+    # فیلدهای عددی که عیناً در snapshot ذخیره می‌شوند
+    _STATE_FIELDS = ('range_percent', 'initial_capital', 'fee_tier',
+                     'gas_cost_usd', 'slippage_pct', 'periods_per_day',
+                     'our_share', 'entry_price', 'hodl_cake_amount',
+                     'hodl_bnb_amount', 'total_fees_usd', 'total_gas_costs',
+                     'total_slippage_costs', 'rebalance_count',
+                     'periods_in_range', 'periods_out_of_range')
+
+    def __init__(self, range_percent, initial_capital=10000, fee_tier=0.25,
+                 gas_cost_usd=0.30, slippage_pct=0.1, avg_volume=None,
+                 our_share=None, periods_per_day=24):
+        self.range_percent = range_percent
+        self.initial_capital = initial_capital
+        self.fee_tier = fee_tier
+        self.gas_cost_usd = gas_cost_usd
+        self.slippage_pct = slippage_pct
+        self.periods_per_day = periods_per_day
+        if our_share is None and avg_volume is not None:
+            # همان تخمین run_backtest_with_rebalance
+            estimated_tvl = avg_volume * periods_per_day * 5
+            our_share = min(initial_capital / estimated_tvl, 0.1)
+        self.our_share = our_share
+        self.position = None
+        self.entry_price = None
+        self.hodl_cake_amount = None
+        self.hodl_bnb_amount = None
+        self.total_fees_usd = 0
+        self.total_gas_costs = 0
+        self.total_slippage_costs = 0
+        self.rebalance_count = 0
+        self.periods_in_range = 0
+        self.periods_out_of_range = 0
+        self.last_timestamp = None
+        self.last_rebalance_timestamp = None
+        self.last_prices = None
+
+    @classmethod
+    def from_history(cls, price_data, range_percent, **kwargs):
+        """ساخت و گرم کردن با تاریخچه (our_share از میانگین حجم تاریخچه)"""
+        kwargs.setdefault('avg_volume', price_data['quote_volume'].mean())
+        kwargs.setdefault('periods_per_day', infer_periods_per_day(price_data))
+        backtest = cls(range_percent, **kwargs)
+        backtest.update_block(price_data)
+        return backtest
+
+    def update_many(self, price_data):
+        """اعمال چند کندل (DataFrame با ستون‌های price_data) تک‌به‌تک"""
+        for candle in price_data.itertuples(index=False):
+            self.update(candle._asdict())
+        return self
+
+    def update(self, candle):
+        """
+        اعمال یک کندل بسته‌شده.
+
+        candle: dict/Series با timestamp، close، cake_usdt، bnb_usdt،
+                quote_volume
+        Returns: dict وضعیت فعلی (in_range، rebalanced، fee، pool_value،
+                 total_value) یا None اگر کندل تکراری/قدیمی باشد
+        """
+        timestamp = pd.Timestamp(candle['timestamp'])
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            return None
+
+        price_cake_bnb = candle['close']
+        cake_usdt = candle['cake_usdt']
+        bnb_usdt = candle['bnb_usdt']
+        volume = candle['quote_volume']
+
+        position = self.start(price_cake_bnb, cake_usdt, bnb_usdt, volume)
+        in_range = position.is_in_range(price_cake_bnb)
+        rebalanced = not in_range
+        if rebalanced:
+            self.rebalance(price_cake_bnb, cake_usdt, bnb_usdt, timestamp)
+            in_range = position.is_in_range(price_cake_bnb)
+
+        # ─── کارمزد ───
+        fee = 0
+        if in_range:
+            self.periods_in_range += 1
+            fee_rate = self.fee_tier / 100
+            concentration_factor = 100 / self.range_percent
+            fee = volume * fee_rate * self.our_share * concentration_factor
+            fee = min(fee, volume * fee_rate * 0.5)
+            self.total_fees_usd += fee
+        else:
+            self.periods_out_of_range += 1
+
+        self.last_timestamp = timestamp
+        self.last_prices = (price_cake_bnb, cake_usdt, bnb_usdt)
+
+        pool_value = position.get_value_usd(price_cake_bnb, cake_usdt, bnb_usdt)
+        return {
+            'timestamp': timestamp,
+            'in_range': in_range,
+            'rebalanced': rebalanced,
+            'fee': fee,
+            'price_lower': position.price_lower,
+            'price_upper': position.price_upper,
+            'pool_value': pool_value,
+            'total_value': pool_value + self.total_fees_usd,
+        }
+
+    def update_block(self, block):
+        """
+        اعمال یک تکه کندل (DataFrame یا PriceArrays) به صورت برداری.
+
+        حالت پوزیشن از تکه قبلی ادامه می‌یابد؛ کندل‌های تکراری/قدیمی‌تر
+        از آخرین کندل حذف می‌شوند. Returns: تعداد کندل اعمال‌شده
+        """
+        arrays = block if isinstance(block, PriceArrays) \
+            else PriceArrays.from_frame(block)
+        if self.last_timestamp is not None and len(arrays):
+            fresh = arrays.timestamps.to_numpy() > \
+                self.last_timestamp.to_datetime64()
+            first = int(np.argmax(fresh)) if fresh.any() else len(arrays)
+            arrays = arrays.slice(first, len(arrays))
+        n = len(arrays)
+        if n == 0:
+            return 0
+
+        close = arrays.close
+        cake_usdt = arrays.cake_usdt
+        bnb_usdt = arrays.bnb_usdt
+        position = self.start(close[0], cake_usdt[0], bnb_usdt[0],
+                              arrays.volume[0])
+
+        active = np.zeros(n, dtype=bool)
+        start = 0
+        while start < n:
+            price = close[start]
+            if not position.is_in_range(price):
+                self.rebalance(price, cake_usdt[start], bnb_usdt[start],
+                               arrays.timestamps.iloc[start])
+            in_range = position.is_in_range(price)
+            end = _find_range_exit(close, start + 1, position.price_lower,
+                                   position.price_upper) if in_range \
+                else start + 1
+            active[start:end] = in_range
+            start = end
+
+        self.accrue(arrays, active)
+        return n
+
+    def accrue(self, arrays, active):
+        """
+        کارمزد و شمارنده‌های یک تکه کندل (PriceArrays) با ماسک فعال بودن
+        هر کندل؛ پوزیشن دست نمی‌خورد. آخرین کندل تکه = آخرین کندل اعمال‌شده.
+
+        برای موتورهایی که ریبالانس‌ها را خودشان با rebalance() انجام
+        می‌دهند (مثل run_backtest_intrabar).
+        """
+        n = len(arrays)
+        close = arrays.close
+        fee_volume = arrays.fee_volume(self.fee_tier)
+        concentration_factor = 100 / self.range_percent
+        fee_if_active = np.minimum(
+            fee_volume * self.our_share * concentration_factor,
+            fee_volume * 0.5
+        )
+        # جمع ترتیبی ادامه‌دار (همان ترتیب cumsum کل سری در موتور vectorized)
+        fees = np.where(active, fee_if_active, 0.0)
+        fees[0] += self.total_fees_usd
+        self.total_fees_usd = float(np.cumsum(fees)[-1])
+        periods_in_range = int(active.sum())
+        self.periods_in_range += periods_in_range
+        self.periods_out_of_range += n - periods_in_range
+
+        self.last_timestamp = pd.Timestamp(arrays.timestamps.iloc[-1])
+        self.last_prices = (close[-1], arrays.cake_usdt[-1],
+                            arrays.bnb_usdt[-1])
+
+    def start(self, price_cake_bnb, cake_usdt, bnb_usdt, volume):
+        """
+        پوزیشن و HODL اولیه روی اولین کندل (اگر هنوز باز نشده).
+        Returns: پوزیشن فعلی
+        """
+        if self.position is not None:
+            return self.position
+        if self.our_share is None:
+            # بدون تاریخچه: تخمین از حجم اولین کندل
+            estimated_tvl = volume * self.periods_per_day * 5
+            self.our_share = min(self.initial_capital / estimated_tvl, 0.1)
+        self.hodl_cake_amount = (self.initial_capital / 2) / cake_usdt
+        self.hodl_bnb_amount = (self.initial_capital / 2) / bnb_usdt
+        self.entry_price = price_cake_bnb
+        self.position = LiquidityPositionV3()
+        self.position.open_position(
+            self.initial_capital, price_cake_bnb, self.range_percent,
+            cake_usdt, bnb_usdt
+        )
+        return self.position
+
+    def rebalance(self, price_cake_bnb, cake_usdt, bnb_usdt, timestamp):
+        """
+        ریبالانس ۵۰/۵۰ حول قیمت داده‌شده (همان منطق حلقه مرجع)؛ قیمت
+        می‌تواند داخل یک کندل باشد (کارمزد و شمارنده‌ها با accrue)
+        """
+        position = self.position
+        current_pool_value = position.get_value_usd(
+            price_cake_bnb, cake_usdt, bnb_usdt
+        )
+        swap_value_usd = current_pool_value / 2
+        gas = self.gas_cost_usd
+        slippage = swap_value_usd * (self.slippage_pct / 100)
+        self.total_gas_costs += gas
+        self.total_slippage_costs += slippage
+
+        rebalance_capital = current_pool_value - gas - slippage
+        position.open_position(
+            max(rebalance_capital, 0), price_cake_bnb,
+            self.range_percent, cake_usdt, bnb_usdt
+        )
+        self.rebalance_count += 1
+        self.last_rebalance_timestamp = pd.Timestamp(timestamp)
+
+    def metrics(self):
+        """معیارهای خلاصه تا آخرین کندل (همان کلیدهای metrics_only)"""
+        if self.position is None:
+            raise ValueError("❌ هنوز هیچ کندلی اعمال نشده است")
+        return _summarize_backtest(
+            self.range_percent, self.entry_price, self.position,
+            self.initial_capital,
+            final_prices=self.last_prices,
+            hodl_amounts=(self.hodl_cake_amount, self.hodl_bnb_amount),
+            total_fees_usd=self.total_fees_usd,
+            total_gas_costs=self.total_gas_costs,
+            total_slippage_costs=self.total_slippage_costs,
+            rebalance_count=self.rebalance_count,
+            periods_in_range=self.periods_in_range,
+            periods_out_of_range=self.periods_out_of_range,
+            periods_per_day=self.periods_per_day,
+        )
+
+    # ─── snapshot / restore ───
+
+    def snapshot(self):
+        """حالت کامل به صورت dict قابل JSON (float ها دقیق حفظ می‌شوند)"""
+        state = {name: _to_builtin(getattr(self, name))
+                 for name in self._STATE_FIELDS}
+        state['position'] = None if self.position is None else {
+            name: _to_builtin(getattr(self.position, name))
+            for name in LiquidityPositionV3.__slots__
+        }
+        state['last_prices'] = None if self.last_prices is None else \
+            [_to_builtin(p) for p in self.last_prices]
+        for name in ('last_timestamp', 'last_rebalance_timestamp'):
+            value = getattr(self, name)
+            state[name] = None if value is None else value.isoformat()
+        return state
+
+    @classmethod
+    def restore(cls, state):
+        """ساخت دوباره از خروجی snapshot()"""
+        backtest = cls(state['range_percent'])
+        for name in cls._STATE_FIELDS:
+            setattr(backtest, name, state[name])
+        if state['position'] is not None:
+            backtest.position = LiquidityPositionV3()
+            for name, value in state['position'].items():
+                setattr(backtest.position, name, value)
+        if state['last_prices'] is not None:
+            backtest.last_prices = tuple(state['last_prices'])
+        for name in ('last_timestamp', 'last_rebalance_timestamp'):
+            if state[name] is not None:
+                setattr(backtest, name, pd.Timestamp(state[name]))
+        return backtest
+
+    def save(self, path):
+        """ذخیره snapshot روی دیسک (نوشتن اتمیک)"""
+        payload = json.dumps(self.snapshot()).encode('utf-8')
+        KlineCache._atomic_write(path, lambda f: f.write(payload))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls.restore(json.load(f))
+
+
+class CachedPairChunks:
+    """
+    تکه‌های هم‌تراز یک جفت‌ارز مستقیماً از KlineCache (mmap).
+
+    فقط timestamp های دو leg برای هم‌ترازی خوانده می‌شوند؛ قیمت و حجم
+    هر تکه جداگانه از فایل map شده کپی می‌شود، پس حافظه با chunk_rows
+    محدود است (نه با طول سری). قابل پیمایش چندباره است.
+    """
+
+    __slots__ = ('symbol0', 'symbol1', 'interval', 'chunk_rows', 'cache_dir',
+                 'start_time', 'end_time')
+
+    def __init__(self, symbol0='CAKEUSDT', symbol1='BNBUSDT', interval='1m',
+                 chunk_rows=100_000, cache_dir=KLINE_CACHE_DIR,
+                 start_time=None, end_time=None):
+        self.symbol0 = symbol0
+        self.symbol1 = symbol1
+        self.interval = interval
+        self.chunk_rows = chunk_rows
+        self.cache_dir = cache_dir
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def _aligned_positions(self, leg0, leg1):
+        ts0 = leg0['timestamp']
+        ts1 = leg1['timestamp']
+        lo = -np.inf if self.start_time is None else self.start_time
+        hi = np.inf if self.end_time is None else self.end_time
+        _, pos0, pos1 = np.intersect1d(ts0, ts1, assume_unique=True,
+                                       return_indices=True)
+        keep = (ts0[pos0] >= lo) & (ts0[pos0] <= hi)
+        return pos0[keep], pos1[keep]
+
+    def __iter__(self):
+        cache = KlineCache(self.cache_dir)
+        leg0 = cache.load(self.symbol0, self.interval, mmap=True)
+        leg1 = cache.load(self.symbol1, self.interval, mmap=True)
+        pos0, pos1 = self._aligned_positions(leg0, leg1)
+        per_day = periods_per_day(self.interval)
+        for lo in range(0, len(pos0), self.chunk_rows):
+            rows0 = leg0[pos0[lo:lo + self.chunk_rows]]
+            rows1 = leg1[pos1[lo:lo + self.chunk_rows]]
+            cake_usdt = rows0['close'].astype(np.float64)
+            bnb_usdt = rows1['close'].astype(np.float64)
+            yield PriceArrays(
+                cake_usdt / bnb_usdt, cake_usdt, bnb_usdt,
+                (rows0['quote_volume'] + rows1['quote_volume']) / 2,
+                pd.Series(pd.to_datetime(rows0['timestamp'], unit='ms')),
+                per_day,
+            )
+
+
+def run_backtest_chunked(chunks, range_percent, initial_capital=10000,
+                         fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1,
+                         chunk_rows=100_000, avg_volume=None,
+                         periods_per_day=None):
+    """
+    بک‌تست با حافظه محدود روی سری‌های بلند (مثلاً ۵۲۵ هزار کندل ۱ دقیقه‌ای).
+
+    سری تکه به تکه به StreamingBacktest.update_block داده می‌شود و
+    پوزیشن، کارمزدها و هزینه‌ها از مرز تکه‌ها عبور می‌کنند؛ هیچ تاریخچه
+    کاملی ساخته نمی‌شود. روی DataFrame همان معیارهای metrics_only
+    موتور vectorized را می‌دهد.
+
+    chunks: DataFrame (تکه‌های chunk_rows ردیفی)، CachedPairChunks یا هر
+            iterable چندباره از DataFrame / PriceArrays
+    avg_volume: میانگین حجم هر کندل برای our_share؛ None → یک گذر اضافه
+                روی تکه‌ها (فقط ستون حجم)
+
+    Returns: dict معیارهای خلاصه (مثل metrics_only)
+    """
+    if isinstance(chunks, pd.DataFrame):
+        arrays = PriceArrays.from_frame(chunks)
+        if avg_volume is None:
+            avg_volume = arrays.volume.mean()
+        chunks = [arrays.slice(lo, lo + chunk_rows)
+                  for lo in range(0, len(arrays), chunk_rows)]
+    elif avg_volume is None:
+        if iter(chunks) is chunks:
+            raise ValueError("❌ برای iterator یک‌باره avg_volume لازم است")
+        total, count = 0.0, 0
+        for chunk in chunks:
+            volume = chunk.volume if isinstance(chunk, PriceArrays) \
+                else chunk['quote_volume'].to_numpy(dtype=np.float64)
+            total += volume.sum()
+            count += len(volume)
+        avg_volume = total / max(count, 1)
+
+    backtest = None
+    for chunk in chunks:
+        if backtest is None:
+            if periods_per_day is None:
+                periods_per_day = infer_periods_per_day(chunk)
+            backtest = StreamingBacktest(
+                range_percent, initial_capital, fee_tier, gas_cost_usd,
+                slippage_pct, avg_volume=avg_volume,
+                periods_per_day=periods_per_day
+            )
+        backtest.update_block(chunk)
+    if backtest is None:
+        raise ValueError("❌ داده‌ای برای بک‌تست وجود ندارد")
+    return backtest.metrics()
+
+
+def _to_builtin(value):
+    """np.float64 / np.int64 → float / int برای JSON"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ز: ارزیابی walk-forward (بهینه‌سازی روی گذشته، تست روی آینده)
+# ═══════════════════════════════════════════════════════════
+
+def build_walk_forward_windows(n_rows, train_periods, test_periods,
+                               step_periods=None):
+    """
+    پنجره‌های غلتان: [train_lo, train_hi) برای انتخاب بازه و
+    [train_hi, test_hi) برای تست. پیش‌فرض گام = طول تست.
+
+    Returns: لیست (train_lo, train_hi, test_hi)
+    """
+    step_periods = step_periods or test_periods
+    windows = []
+    lo = 0
+    while lo + train_periods + test_periods <= n_rows:
+        windows.append((lo, lo + train_periods,
+                        lo + train_periods + test_periods))
+        lo += step_periods
+    return windows
+
+
+def _run_walk_forward_window(arrays, window, scenarios, initial_capital,
+                             objective, backtest_kwargs):
+    """یک پنجره (engine='vectorized'): بک‌تست همه بازه‌ها روی train و test"""
+    train_lo, train_hi, test_hi = window
+    train = arrays.slice(train_lo, train_hi)
+    test = arrays.slice(train_hi, test_hi)
+
+    def run(data, range_pct):
+        return run_backtest_with_rebalance(
+            data, range_pct, initial_capital, engine='vectorized',
+            metrics_only=True, **backtest_kwargs
+        )
+
+    return _walk_forward_row(arrays, window, objective,
+                             {r: run(train, r) for r in scenarios},
+                             {r: run(test, r) for r in scenarios})
+
+
+def _walk_forward_scenario(arrays, range_pct, windows, initial_capital,
+                           backtest_kwargs):
+    """
+    یک بازه در همه پنجره‌ها (engine='index'): BacktestWindowIndex یک بار
+    روی کل سری (sqrt قیمت‌ها، خروج‌ها و jump ها)، هر train/test یک query
+
+    Returns: لیست (معیارهای train، معیارهای test) به ترتیب windows
+    """
+    index = BacktestWindowIndex(arrays, range_pct, **backtest_kwargs)
+    return [(index.query_rows(train_lo, train_hi - 1, initial_capital),
+             index.query_rows(train_hi, test_hi - 1, initial_capital))
+            for train_lo, train_hi, test_hi in windows]
+
+
+def _walk_forward_row(arrays, window, objective, train_results,
+                      test_results):
+    """بهترین بازه روی train، نتیجه همان بازه روی test → ردیف گزارش"""
+    train_lo, train_hi, test_hi = window
+    chosen = max(train_results, key=lambda r: train_results[r][objective])
+    best_test = max(test_results, key=lambda r: test_results[r][objective])
+    chosen_test = test_results[chosen]
+
+    timestamps = arrays.timestamps
+    return {
+        'train_start': timestamps.iloc[train_lo],
+        'test_start': timestamps.iloc[train_hi],
+        'test_end': timestamps.iloc[test_hi - 1],
+        'chosen_range': chosen,
+        'train_return': train_results[chosen]['total_return'],
+        'test_return': chosen_test['total_return'],
+        'test_vs_hodl': chosen_test['vs_hodl'],
+        'test_rebalances': chosen_test['rebalance_count'],
+        'test_best_range': best_test,
+        'test_best_return': test_results[best_test]['total_return'],
+    }
+
+
+def _walk_forward_worker(task):
+    """worker walk-forward روی PriceArrays مشترک (_init_scenario_worker)"""
+    window, scenarios, initial_capital, objective, backtest_kwargs = task
+    return _worker_result(_run_walk_forward_window(
+        _WORKER_PRICE_DATA, window, scenarios, initial_capital, objective,
+        backtest_kwargs
+    ))
+
+
+def _walk_forward_scenario_worker(task):
+    """worker walk-forward با ایندکس: یک بازه در همه پنجره‌ها"""
+    return _worker_result(_walk_forward_scenario(_WORKER_PRICE_DATA, *task))
+
+
+def run_walk_forward(price_data, scenarios=DEFAULT_SCENARIOS, train_days=90,
+                     test_days=30, step_days=None, initial_capital=10000,
+                     objective='total_return', workers=None, verbose=True,
+                     engine='index', **backtest_kwargs):
+    """
+    walk-forward: انتخاب بازه روی train_days روز، تست روی test_days روز
+    بعدی، غلتاندن به جلو و تکرار در کل سری.
+
+    - ستون‌ها یک بار به PriceArrays تبدیل می‌شوند؛ هر پنجره فقط view
+      است و حجم × نرخ کارمزد بین همه پنجره‌ها مشترک است
+    - engine='index' (پیش‌فرض): برای هر بازه یک BacktestWindowIndex روی
+      کل سری ساخته می‌شود و هر پنجره train/test فقط یک query است (کار
+      مشترک پنجره‌های هم‌پوشان تکرار نمی‌شود)؛ بازه‌ها بین worker ها
+      پخش می‌شوند. نتیجه تا حد خطای گرد کردن همان vectorized است
+    - engine='vectorized': بک‌تست metrics_only هر بازه روی برش هر پنجره؛
+      پنجره‌ها بین worker ها پخش می‌شوند
+    - آرایه‌ها با fork / initializer یک بار به هر worker می‌رسند
+
+    backtest_kwargs: fee_tier، gas_cost_usd، slippage_pct
+
+    Returns: DataFrame - یک ردیف برای هر پنجره (بازه انتخاب‌شده، بازده
+             داخل نمونه و خارج نمونه، بهترین بازه واقعی دوره تست)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    per_day = round(arrays.periods_per_day)
+    windows = build_walk_forward_windows(
+        len(arrays), train_days * per_day, test_days * per_day,
+        step_days * per_day if step_days else None
+    )
+    if not windows:
+        raise ValueError(f"❌ داده کافی برای walk-forward نیست "
+                         f"({len(arrays)} کندل < {train_days + test_days} روز)")
+
+    if engine not in ('index', 'vectorized'):
+        raise ValueError(f"❌ موتور ناشناخته: {engine!r} "
+                         f"(مجاز: 'index' یا 'vectorized')")
+    scenarios = list(scenarios)
+    if engine == 'index':
+        worker, tasks = _walk_forward_scenario_worker, [
+            (range_pct, windows, initial_capital, backtest_kwargs)
+            for range_pct in scenarios
+        ]
+    else:
+        worker, tasks = _walk_forward_worker, [
+            (window, scenarios, initial_capital, objective, backtest_kwargs)
+            for window in windows
+        ]
+
+    if verbose:
+        print("\n" + "═" * 90)
+        print(f"🔁 walk-forward: {len(windows)} پنجره "
+              f"(train {train_days} روز → test {test_days} روز، "
+              f"{len(scenarios)} بازه، {workers} worker، {engine})")
+        print("═" * 90)
+
+    if workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(tasks)),
+            mp_context=_get_pool_context(),
+            initializer=_init_scenario_worker,
+            initargs=(arrays, METRICS.enabled)
+        )
+        with executor:
+            results = list(map(_merge_worker_result,
+                               executor.map(worker, tasks)))
+    elif engine == 'index':
+        results = [_walk_forward_scenario(arrays, *task) for task in tasks]
+    else:
+        results = [_run_walk_forward_window(arrays, *task) for task in tasks]
+
+    if engine == 'index':
+        # results[بازه][پنجره] = (train، test) → یک ردیف برای هر پنجره
+        rows = [_walk_forward_row(
+                    arrays, window, objective,
+                    {r: per_window[w][0]
+                     for r, per_window in zip(scenarios, results)},
+                    {r: per_window[w][1]
+                     for r, per_window in zip(scenarios, results)})
+                for w, window in enumerate(windows)]
+    else:
+        rows = results
+
+    report = pd.DataFrame(rows)
+    report.insert(0, 'window', range(len(report)))
+
+    if verbose:
+        print(f"{'#':^4} │ {'شروع تست':^12} │ {'انتخاب':^8} │ "
+              f"{'train':^10} │ {'test':^10} │ {'بهترین test':^12}")
+        print("─" * 72)
+        for _, row in report.iterrows():
+            chosen = f"±{row['chosen_range']:g}%"
+            best = f"±{row['test_best_range']:g}%"
+            print(f"{row['window']:^4} │ "
+                  f"{row['test_start'].strftime('%Y-%m-%d'):^12} │ "
+                  f"{chosen:^8} │ {row['train_return']:+9.2f}% │ "
+                  f"{row['test_return']:+9.2f}% │ {best:^12}")
+        print("─" * 72)
+        stable = (report['chosen_range'] ==
+                  report['chosen_range'].mode().iloc[0]).mean() * 100
+        print(f"   📈 میانگین بازده خارج نمونه: "
+              f"{report['test_return'].mean():+.2f}% | "
+              f"پایداری انتخاب: {stable:.0f}% پنجره‌ها "
+              f"±{report['chosen_range'].mode().iloc[0]:g}%")
+
+    return report
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ح: شبیه‌سازی مونت‌کارلو (مسیرهای مصنوعی × همه بازه‌ها)
+# ═══════════════════════════════════════════════════════════
+
+def simulate_price_paths(price_data, n_paths, n_steps=None, method='bootstrap',
+                         block_size=24, seed=None):
+    """
+    مسیرهای مصنوعی CAKE/USDT و BNB/USDT (و نسبت CAKE/BNB).
+
+    method:
+        'bootstrap' → block bootstrap دایره‌ای بازده‌های لگاریتمی ساعتی
+                      (بلوک‌های block_size کندلی؛ بازده دو leg و حجم با
+                      همان اندیس‌ها → همبستگی و خوشه‌ای بودن نوسان حفظ می‌شود)
+        'gbm'       → حرکت براونی هندسی دو متغیره با میانگین و کوواریانس
+                      بازده‌های تاریخی؛ حجم با block bootstrap
+
+    همه مسیرها از قیمت‌های اولین کندل price_data شروع می‌شوند (سری
+    تاریخی خود یک نمونه از همین توزیع است).
+
+    Returns: dict با close، cake_usdt، bnb_usdt، quote_volume - هر کدام
+             ماتریس (n_paths, n_steps) - و periods_per_day سری مبدأ
+    """
+    rng = np.random.default_rng(seed)
+    cake = price_data['cake_usdt'].to_numpy(dtype=np.float64)
+    bnb = price_data['bnb_usdt'].to_numpy(dtype=np.float64)
+    volume = price_data['quote_volume'].to_numpy(dtype=np.float64)
+    if n_steps is None:
+        n_steps = len(cake)
+
+    returns = np.column_stack([np.diff(np.log(cake)), np.diff(np.log(bnb))])
+    m = len(returns)
+
+    # اندیس‌های block bootstrap دایره‌ای: (n_paths, n_steps - 1)
+    n_blocks = -(-(n_steps - 1) // block_size)
+    starts = rng.integers(0, m, size=(n_paths, n_blocks, 1))
+    idx = ((starts + np.arange(block_size)) % m).reshape(n_paths, -1)
+    idx = idx[:, :n_steps - 1]
+
+    if method == 'bootstrap':
+        step_returns = returns[idx]
+    elif method == 'gbm':
+        mean = returns.mean(axis=0)
+        chol = np.linalg.cholesky(np.cov(returns, rowvar=False))
+        shocks = rng.standard_normal((n_paths, n_steps - 1, 2))
+        step_returns = mean + shocks @ chol.T
+    else:
+        raise ValueError(f"❌ روش ناشناخته: {method!r} "
+                         f"(مجاز: 'bootstrap' یا 'gbm')")
+
+    log_paths = np.zeros((n_paths, n_steps, 2))
+    np.cumsum(step_returns, axis=1, out=log_paths[:, 1:])
+    cake_paths = cake[0] * np.exp(log_paths[..., 0])
+    bnb_paths = bnb[0] * np.exp(log_paths[..., 1])
+
+    volume_paths = np.empty((n_paths, n_steps))
+    volume_paths[:, 0] = volume[0]
+    volume_paths[:, 1:] = volume[1:][idx]
+
+    return {
+        'close': cake_paths / bnb_paths,
+        'cake_usdt': cake_paths,
+        'bnb_usdt': bnb_paths,
+        'quote_volume': volume_paths,
+        'periods_per_day': infer_periods_per_day(price_data),
+    }
+
+
+def _open_positions_vec(capital, price, range_percent, cake_usdt, bnb_usdt):
+    """
+    LiquidityPositionV3.open_position برای آرایه‌ای از پوزیشن‌ها
+    (همان فرمول‌ها، عنصر به عنصر با broadcasting).
+
+    Returns: (L, price_lower, price_upper, sqrt_lower, sqrt_upper)
+    """
+    price_lower = price * (1 - range_percent / 100)
+    price_upper = price * (1 + range_percent / 100)
+    sqrt_pa = np.sqrt(np.maximum(price_lower, 1e-18))
+    sqrt_pb = np.sqrt(np.maximum(price_upper, 1e-18))
+
+    usd_per_side = capital / 2
+    amount0 = usd_per_side / cake_usdt
+    amount1 = usd_per_side / bnb_usdt
+    sqrt_p = np.sqrt(price)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        L0 = np.where(sqrt_pb - sqrt_p > 1e-15,
+                      amount0 * (sqrt_p * sqrt_pb) / (sqrt_pb - sqrt_p), 0.0)
+        L1 = np.where(sqrt_p - sqrt_pa > 1e-15,
+                      amount1 / (sqrt_p - sqrt_pa), 0.0)
+    L = np.where((L0 > 0) & (L1 > 0), np.minimum(L0, L1), np.maximum(L0, L1))
+    return L, price_lower, price_upper, sqrt_pa, sqrt_pb
+
+
+def _position_values_vec(price, L, price_lower, price_upper, sqrt_pa, sqrt_pb,
+                         cake_usdt, bnb_usdt):
+    """LiquidityPositionV3.get_value_usd عنصر به عنصر (همان شاخه‌ها)"""
+    sqrt_p = np.sqrt(np.maximum(price, 1e-18))
+    below = price <= price_lower
+    above = ~below & (price >= price_upper)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = sqrt_p * sqrt_pb
+        amount0 = np.where(denom > 1e-18, L * (sqrt_pb - sqrt_p) / denom, 0.0)
+        denom_low = sqrt_pa * sqrt_pb
+        amount0_low = np.where(denom_low > 1e-18,
+                               L * (sqrt_pb - sqrt_pa) / denom_low, 0.0)
+    amount1 = L * (sqrt_p - sqrt_pa)
+
+    amount0 = np.where(below, amount0_low, np.where(above, 0.0, amount0))
+    amount1 = np.where(below, 0.0,
+                       np.where(above, L * (sqrt_pb - sqrt_pa), amount1))
+    return np.maximum(amount0, 0) * cake_usdt + \
+        np.maximum(amount1, 0) * bnb_usdt
+
+
+def _backtest_paths(paths, range_percents, initial_capital=10000,
+                    fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1):
+    """
+    بک‌تست ریبالانس روی همه مسیرها × همه بازه‌ها به صورت یکجا.
+
+    حالت پوزیشن‌ها آرایه‌های (بازه، مسیر) هستند و فقط روی زمان حلقه
+    زده می‌شود؛ هر گام چند عمل برداری روی کل ماتریس است. منطق هر گام
+    همان موتور حلقه‌ای run_backtest_with_rebalance است.
+
+    Returns: dict معیار → ماتریس (بازه، مسیر)
+    """
+    close = paths['close']
+    cake_usdt = paths['cake_usdt']
+    bnb_usdt = paths['bnb_usdt']
+    volume = paths['quote_volume']
+    per_day = paths.get('periods_per_day', 24)
+    n_paths, n_steps = close.shape
+    widths = np.asarray(range_percents, dtype=np.float64)[:, None]
+    shape = (len(widths), n_paths)
+
+    # سهم از حجم به ازای هر مسیر (مثل بک‌تست روی همان مسیر)
+    estimated_tvl = volume.mean(axis=1) * per_day * 5
+    our_share = np.minimum(initial_capital / estimated_tvl, 0.1)
+    fee_volume = volume * (fee_tier / 100)
+    concentration_factor = 100 / widths
+
+    L, lower, upper, sqrt_pa, sqrt_pb = _open_positions_vec(
+        np.full(shape, float(initial_capital)), close[:, 0], widths,
+        cake_usdt[:, 0], bnb_usdt[:, 0]
+    )
+    total_fees = np.zeros(shape)
+    total_gas = np.zeros(shape)
+    total_slippage = np.zeros(shape)
+    rebalances = np.zeros(shape, dtype=np.int64)
+    periods_in_range = np.zeros(shape, dtype=np.int64)
+
+    for t in range(n_steps):
+        price = close[:, t]
+        in_range = (price >= lower) & (price <= upper)
+
+        if not in_range.all():
+            wi, pi = np.nonzero(~in_range)
+            p = price[pi]
+            cake_t = cake_usdt[pi, t]
+            bnb_t = bnb_usdt[pi, t]
+            value = _position_values_vec(
+                p, L[wi, pi], lower[wi, pi], upper[wi, pi],
+                sqrt_pa[wi, pi], sqrt_pb[wi, pi], cake_t, bnb_t
+            )
+            slippage = (value / 2) * (slippage_pct / 100)
+            total_gas[wi, pi] += gas_cost_usd
+            total_slippage[wi, pi] += slippage
+            capital = np.maximum(value - gas_cost_usd - slippage, 0)
+            (L[wi, pi], lower[wi, pi], upper[wi, pi],
+             sqrt_pa[wi, pi], sqrt_pb[wi, pi]) = _open_positions_vec(
+                capital, p, widths[wi, 0], cake_t, bnb_t
+            )
+            rebalances[wi, pi] += 1
+            in_range = (price >= lower) & (price <= upper)
+
+        fee_t = fee_volume[:, t]
+        fee = np.minimum(fee_t * our_share * concentration_factor,
+                         fee_t * 0.5)
+        total_fees += np.where(in_range, fee, 0.0)
+        periods_in_range += in_range
+
+    # ─── معیارها (همان _summarize_backtest) ───
+    final_pool = _position_values_vec(
+        close[:, -1], L, lower, upper, sqrt_pa, sqrt_pb,
+        cake_usdt[:, -1], bnb_usdt[:, -1]
+    )
+    hodl_final = (initial_capital / 2) / cake_usdt[:, 0] * cake_usdt[:, -1] + \
+        (initial_capital / 2) / bnb_usdt[:, 0] * bnb_usdt[:, -1]
+    net_fees = total_fees - total_gas - total_slippage
+    final_total = final_pool + net_fees
+    days = n_steps / per_day
+
+    return {
+        'total_return': (final_total - initial_capital) / initial_capital * 100,
+        'vs_hodl': (final_total - hodl_final) / hodl_final * 100,
+        'impermanent_loss': (final_pool / hodl_final - 1) * 100,
+        'fee_apr': net_fees / initial_capital * (365 / max(days, 1)) * 100,
+        'rebalance_count': rebalances,
+        'active_percent': periods_in_range / n_steps * 100,
+    }
+
+
+def _monte_carlo_batch(price_data, range_percents, n_paths, seed,
+                       path_kwargs, backtest_kwargs):
+    paths = simulate_price_paths(price_data, n_paths, seed=seed, **path_kwargs)
+    return _backtest_paths(paths, range_percents, **backtest_kwargs)
+
+
+def _monte_carlo_worker(task):
+    """worker مونت‌کارلو روی price_data مشترک (_init_scenario_worker)"""
+    return _worker_result(_monte_carlo_batch(_WORKER_PRICE_DATA, *task))
+
+
+def run_monte_carlo(price_data, scenarios=DEFAULT_SCENARIOS, n_paths=1000,
+                    method='bootstrap', block_size=24, n_steps=None,
+                    initial_capital=10000, fee_tier=0.25, gas_cost_usd=0.30,
+                    slippage_pct=0.1, batch_size=500, workers=None, seed=42,
+                    var_level=5, verbose=True):
+    """
+    توزیع نتایج استراتژی ریبالانس روی n_paths مسیر مصنوعی.
+
+    - مسیرها در دسته‌های batch_size ساخته و بک‌تست می‌شوند (حافظه
+      محدود)؛ هر دسته همه بازه‌ها را روی همان مسیرها اجرا می‌کند
+      (مقایسه بازه‌ها با اعداد تصادفی مشترک)
+    - دسته‌ها در process pool اجرا می‌شوند؛ بذر هر دسته از seed مشتق
+      می‌شود، پس نتیجه به تعداد worker بستگی ندارد
+    - VaR / CVaR در سطح var_level درصد روی بازده کل (درصد سرمایه)
+
+    Returns: (DataFrame خلاصه - یک ردیف برای هر بازه،
+              {range_percent: {معیار: آرایه n_paths}})
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    path_kwargs = {'n_steps': n_steps, 'method': method,
+                   'block_size': block_size}
+    backtest_kwargs = {'initial_capital': initial_capital,
+                       'fee_tier': fee_tier, 'gas_cost_usd': gas_cost_usd,
+                       'slippage_pct': slippage_pct}
+    sizes = [min(batch_size, n_paths - lo) for lo in range(0, n_paths, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(list(scenarios), size, batch_seed, path_kwargs, backtest_kwargs)
+             for size, batch_seed in zip(sizes, seeds)]
+
+    if verbose:
+        print("\n" + "═" * 90)
+        print(f"🎲 مونت‌کارلو ({method}): {n_paths:,} مسیر × "
+              f"{len(scenarios)} بازه در {len(tasks)} دسته ({workers} worker)")
+        print("═" * 90)
+
+    t0 = time_module.perf_counter()
+    if workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(tasks)),
+            mp_context=_get_pool_context(),
+            initializer=_init_scenario_worker,
+            initargs=(price_data, METRICS.enabled)
+        )
+        with executor:
+            batches = list(map(_merge_worker_result,
+                               executor.map(_monte_carlo_worker, tasks)))
+    else:
+        batches = [_monte_carlo_batch(price_data, *task) for task in tasks]
+
+    distributions = {}
+    rows = []
+    for w, range_pct in enumerate(scenarios):
+        dist = {key: np.concatenate([batch[key][w] for batch in batches])
+                for key in batches[0]}
+        distributions[range_pct] = dist
+        returns = dist['total_return']
+        var_cut = np.percentile(returns, var_level)
+        rebalance_pct = np.percentile(dist['rebalance_count'], [5, 50, 95])
+        rows.append({
+            'range_percent': range_pct,
+            'mean_return': returns.mean(),
+            'median_return': np.median(returns),
+            'std_return': returns.std(),
+            'p5_return': np.percentile(returns, 5),
+            'p95_return': np.percentile(returns, 95),
+            'var': -var_cut,
+            'cvar': -returns[returns <= var_cut].mean(),
+            'prob_loss': (returns < 0).mean() * 100,
+            'mean_vs_hodl': dist['vs_hodl'].mean(),
+            'mean_fee_apr': dist['fee_apr'].mean(),
+            'rebalances_p5': rebalance_pct[0],
+            'rebalances_p50': rebalance_pct[1],
+            'rebalances_p95': rebalance_pct[2],
+        })
+    summary = pd.DataFrame(rows)
+
+    if verbose:
+        elapsed = time_module.perf_counter() - t0
+        print(f"{'بازه':^8} │ {'میانگین':^9} │ {'میانه':^9} │ "
+              f"{f'VaR {100 - var_level}%':^9} │ {'P(زیان)':^8} │ "
+              f"{'ریبالانس p5/p50/p95':^22}")
+        print("─" * 80)
+        for row in rows:
+            print(f"  ±{row['range_percent']:2g}%   │ "
+                  f"{row['mean_return']:+8.2f}% │ "
+                  f"{row['median_return']:+8.2f}% │ {row['var']:8.2f}% │ "
+                  f"{row['prob_loss']:6.1f}% │ "
+                  f"{row['rebalances_p5']:6.0f} / {row['rebalances_p50']:6.0f}"
+                  f" / {row['rebalances_p95']:6.0f}")
+        print("─" * 80)
+        print(f"   ⏱️ {elapsed:.1f}s "
+              f"({n_paths * len(scenarios) / max(elapsed, 1e-9):,.0f} "
+              f"بک‌تست/ثانیه)")
+
+    return summary, distributions
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ط: خروج از بازه داخل کندل (high/low + پالایش تنبل)
+# ═══════════════════════════════════════════════════════════
+
+class FrameCandleSource:
+    """
+    منبع کندل ریز از یک DataFrame آماده (مثلاً price_data یک دقیقه‌ای)
+    با ستون‌های timestamp، cake_usdt، bnb_usdt.
+    """
+
+    __slots__ = ('timestamps', 'cake_usdt', 'bnb_usdt', 'requests')
+
+    def __init__(self, fine_data):
+        self.timestamps = fine_data['timestamp'].to_numpy(
+            dtype='datetime64[ms]').astype(np.int64)
+        self.cake_usdt = fine_data['cake_usdt'].to_numpy(dtype=np.float64)
+        self.bnb_usdt = fine_data['bnb_usdt'].to_numpy(dtype=np.float64)
+        self.requests = 0
+
+    def candles(self, start_ms, end_ms):
+        """کندل‌های ریز [start_ms, end_ms) → (cake_usdt، bnb_usdt)"""
+        lo, hi = np.searchsorted(self.timestamps, (start_ms, end_ms))
+        return self.cake_usdt[lo:hi], self.bnb_usdt[lo:hi]
+
+    def flush(self):
+        pass
+
+
+class FineCandleSource:
+    """
+    کندل‌های ریز (پیش‌فرض ۱ دقیقه) فقط برای کندل‌های علامت‌خورده.
+
+    اول از KlineCache (mmap) خوانده می‌شود؛ فقط بازه‌های کم پنجره
+    (missing_ranges) دانلود می‌شوند. readahead > 1 → پنجره‌های هم‌تراز
+    چند کندلی (درخواست کمتر وقتی علامت‌ها پشت سر هم‌اند).
+
+    سوراخ‌هایی که بعد از دانلود هنوز خالی‌اند (توقف صرافی) مثل
+    load_klines_cached در known_gaps ثبت می‌شوند تا اجرای بعد دوباره
+    درخواست نشوند. دانلودها هر merge_rows ردیف (و در flush()) در کش
+    ادغام می‌شوند - هر ادغام کل فایل را بازنویسی می‌کند، پس نه برای هر
+    پنجره.
+    """
+
+    __slots__ = ('symbols', 'interval', 'cache', 'offline', 'readahead',
+                 'merge_rows', 'download_kwargs', 'requests', '_window_key',
+                 '_window', '_pending')
+
+    def __init__(self, symbols=('CAKEUSDT', 'BNBUSDT'), interval='1m',
+                 cache_dir=KLINE_CACHE_DIR, offline=False, readahead=1,
+                 merge_rows=50_000, **download_kwargs):
+        self.symbols = tuple(symbols)
+        self.interval = interval
+        self.cache = KlineCache(cache_dir)
+        self.offline = offline
+        self.readahead = readahead
+        self.merge_rows = merge_rows
+        self.download_kwargs = download_kwargs
+        self.requests = 0
+        self._window_key = None
+        self._window = None
+        self._pending = {symbol: [] for symbol in self.symbols}
+
+    def _load_window(self, lo, hi):
+        interval_ms = INTERVAL_MS[self.interval]
+        last = hi - interval_ms
+        legs = {}
+        missing = {}
+        for symbol in self.symbols:
+            cached = self.cache.load(symbol, self.interval, mmap=True)
+            a, b = np.searchsorted(cached['timestamp'], (lo, hi))
+            legs[symbol] = np.array(cached[a:b])
+            ranges = self.cache.missing_ranges(symbol, self.interval, lo, last)
+            if ranges:
+                missing[symbol] = ranges
+        if missing and not self.offline:
+            kwargs = dict(self.download_kwargs)
+            window_ms = kwargs.get('limit', 1000) * interval_ms
+            windows = {symbol: _split_range_windows(ranges, window_ms)
+                       for symbol, ranges in missing.items()}
+            kwargs.setdefault('max_workers', len(windows))
+            fetched = _download_windows(windows, interval=self.interval,
+                                        verbose=False, **kwargs)
+            self.requests += sum(len(w) for w in windows.values())
+            # کندل‌های بیش از یک روز پیش دیگر نمی‌آیند (بدون تأخیر صرافی)
+            settled = int(datetime.now().timestamp() * 1000) - DAY_MS
+            for symbol, arr in fetched.items():
+                legs[symbol] = np.unique(np.concatenate([legs[symbol], arr]))
+                ts = legs[symbol]['timestamp']
+                horizon = max(int(ts[-1]) if len(ts) else lo, settled)
+                self.cache.add_known_gaps(symbol, self.interval, [
+                    (a, b) for a, b in _missing_timestamp_ranges(
+                        ts, lo, last, interval_ms)
+                    if b < horizon
+                ])
+                self._stash(symbol, arr)
+        return [legs[symbol] for symbol in self.symbols]
+
+    def _stash(self, symbol, rows):
+        """نگه داشتن کندل‌های دانلودشده؛ ادغام در کش هر merge_rows ردیف"""
+        pending = self._pending[symbol]
+        pending.append(rows)
+        if sum(len(arr) for arr in pending) >= self.merge_rows:
+            self.cache.merge(symbol, self.interval, np.concatenate(pending))
+            pending.clear()
+
+    def candles(self, start_ms, end_ms):
+        """کندل‌های ریز [start_ms, end_ms) → (cake_usdt، bnb_usdt) هم‌تراز"""
+        window_ms = self.readahead * (end_ms - start_ms)
+        key = start_ms // window_ms * window_ms
+        if key != self._window_key:
+            self._window_key = key
+            self._window = self._load_window(key, key + window_ms)
+        leg0, leg1 = (leg[(leg['timestamp'] >= start_ms) &
+                          (leg['timestamp'] < end_ms)] for leg in self._window)
+        _, pos0, pos1 = np.intersect1d(leg0['timestamp'], leg1['timestamp'],
+                                       assume_unique=True, return_indices=True)
+        return leg0['close'][pos0], leg1['close'][pos1]
+
+    def flush(self):
+        """ادغام کندل‌های دانلودشده در کش محلی"""
+        for symbol, arrays in self._pending.items():
+            if arrays:
+                self.cache.merge(symbol, self.interval, np.concatenate(arrays))
+            arrays.clear()
+
+
+def run_backtest_intrabar(price_data, range_percent, initial_capital=10000,
+                          fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1,
+                          fine_source=None):
+    """
+    بک‌تست با تشخیص خروج داخل کندل.
+
+    - هر کندل با پوش [ratio_low, ratio_high] (از high/low دو leg) بررسی
+      می‌شود؛ کندلی که به مرز بازه رسیده «علامت» می‌خورد
+    - فقط کندل‌های علامت‌خورده با fine_source پالایش می‌شوند: قیمت‌های
+      کندل‌های ریز به ترتیب اجرا و در اولین خروج واقعی، ریبالانس (همان
+      منطق موتور مرجع) با قیمت همان لحظه انجام می‌شود
+    - کندل بدون علامت قطعاً داخل بازه مانده (پوش شامل همه قیمت‌های
+      داخل کندل است) و مثل موتور vectorized یکجا حساب می‌شود
+    - بدون fine_source یا داده ریز → همان رفتار قیمت close
+
+    کارمزد هر کندل مثل موتورهای دیگر به «در بازه بودن در close» بستگی دارد.
+    price_data بدون ستون‌های ratio_low/ratio_high → هیچ علامتی (= close).
+
+    Returns: معیارهای metrics_only + flagged_candles، refined_candles،
+             intra_candle_rebalances، fine_requests
+    """
+    arrays = PriceArrays.from_frame(price_data)
+    close = arrays.close
+    cake_usdt = arrays.cake_usdt
+    bnb_usdt = arrays.bnb_usdt
+    n = len(close)
+    if 'ratio_low' in price_data and 'ratio_high' in price_data:
+        ratio_low = price_data['ratio_low'].to_numpy(dtype=np.float64)
+        ratio_high = price_data['ratio_high'].to_numpy(dtype=np.float64)
+    else:
+        ratio_low = ratio_high = close
+    open_ms = arrays.timestamps.to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    candle_ms = int(round(DAY_MS / arrays.periods_per_day))
+
+    backtest = StreamingBacktest(
+        range_percent, initial_capital, fee_tier, gas_cost_usd, slippage_pct,
+        avg_volume=arrays.volume.mean(), periods_per_day=arrays.periods_per_day
+    )
+    position = backtest.start(close[0], cake_usdt[0], bnb_usdt[0],
+                              arrays.volume[0])
+
+    active = np.zeros(n, dtype=bool)
+    flagged = refined = intra_rebalances = 0
+    start = 0
+    while start < n:
+        # کندل‌های start..touch-1 کاملاً داخل بازه‌اند
+        touch = _find_range_exit(ratio_low, start, position.price_lower,
+                                 position.price_upper, highs=ratio_high)
+        active[start:touch] = True
+        if touch >= n:
+            break
+
+        flagged += 1
+        if fine_source is not None:
+            fine_cake, fine_bnb = fine_source.candles(
+                open_ms[touch], open_ms[touch] + candle_ms
+            )
+            if len(fine_cake):
+                refined += 1
+                fine_close = fine_cake / fine_bnb
+                k = 0
+                while k < len(fine_close):
+                    k = _find_range_exit(fine_close, k, position.price_lower,
+                                         position.price_upper)
+                    if k >= len(fine_close):
+                        break
+                    backtest.rebalance(fine_close[k], fine_cake[k],
+                                       fine_bnb[k], open_ms[touch] * 1_000_000)
+                    intra_rebalances += 1
+                    k += 1
+
+        # close خود کندل (مثل موتور مرجع)
+        price = close[touch]
+        if not position.is_in_range(price):
+            backtest.rebalance(price, cake_usdt[touch], bnb_usdt[touch],
+                               arrays.timestamps.iloc[touch])
+        active[touch] = position.is_in_range(price)
+        start = touch + 1
+
+    if fine_source is not None:
+        fine_source.flush()
+
+    backtest.accrue(arrays, active)
+    results = backtest.metrics()
+    results.update({
+        'flagged_candles': flagged,
+        'refined_candles': refined,
+        'intra_candle_rebalances': intra_rebalances,
+        'fine_requests': getattr(fine_source, 'requests', 0),
+    })
+    return results
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ی: هسته تک‌گذر همه بازه‌ها (محور سناریو)
+# ═══════════════════════════════════════════════════════════
+
+def _range_history_from_starts(close, starts, range_percent, n_rows):
+    """RangeHistory از اندیس باز شدن پوزیشن‌ها (مرکز = قیمت همان کندل)"""
+    centers = close[np.asarray(starts, dtype=np.int64)]
+    return RangeHistory(starts, centers * (1 - range_percent / 100),
+                        centers * (1 + range_percent / 100), centers, n_rows)
+
+
+def _block_range_exits(prices, block_start, block_stop, cursor, price_lower,
+                       price_upper):
+    """
+    اولین خروج هر بازه داخل بلوک [block_start, block_stop) از کندل
+    cursor[w] به بعد (شرط معکوس تا NaN هم خروج حساب شود).
+
+    ماسک فقط (کندل‌های بلوک × بازه‌های داده‌شده) است.
+    Returns: (hit، اندیس خروج) - اندیس فقط برای hit معتبر است
+    """
+    base = int(cursor.min())
+    seg = prices[base:block_stop, None]
+    outside = ~((seg >= price_lower) & (seg <= price_upper))
+    outside &= np.arange(base, block_stop)[:, None] >= cursor
+    hit = outside.any(axis=0)
+    return hit, base + outside.argmax(axis=0)
+
+
+def backtest_all_widths(price_data, range_percents, initial_capital=10000,
+                        fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1,
+                        record_history=True, metrics_only=False,
+                        block_rows=None, scalar_widths=32):
+    """
+    بک‌تست همه بازه‌ها در یک گذر روی سری قیمت.
+
+    حالت پوزیشن همه بازه‌ها (L، مرزها، √مرزها، هزینه‌ها) آرایه‌هایی روی
+    محور بازه است. سری در بلوک‌های block_rows کندلی جلو می‌رود؛ در هر
+    بلوک، خروج بعدی همه بازه‌های فعال با یک ماسک (کندل × بازه) پیدا
+    می‌شود و همه بازه‌هایی که خارج شده‌اند با هم ریبالانس می‌شوند
+    (_position_values_vec / _open_positions_vec - همان فرمول‌های پوزیشن
+    اسکالر)؛ تا وقتی در بلوک خروجی مانده تکرار می‌شود.
+
+    کارمزد هم بلوک به بلوک حساب و با جمع ترتیبی (cumsum از مقدار حمل‌شده،
+    همان ترتیب جمع موتور برداری) انباشته می‌شود؛ پس حافظه کاری
+    O(block_rows × بازه‌ها) است، نه O(کندل × بازه‌ها). فقط با
+    record_history آرایه‌های تاریخچه (خروجی) به طول کامل ساخته می‌شوند.
+
+    وقتی در یک بلوک فقط چند بازه (scalar_widths) هنوز خروج دارند - معمولاً
+    باریک‌ترین‌ها - سربار هر فراخوانی NumPy از کار مفید بیشتر می‌شود؛
+    بقیه بلوک آن‌ها با همان پوزیشن اسکالر موتورهای دیگر جلو می‌رود.
+
+    block_rows: پیش‌فرض حدود یک میلیون خانه ماسک (۶۴ تا ۵۱۲ کندل)
+
+    Returns: لیست dict نتایج به ترتیب range_percents - همان خروجی
+             run_backtest_with_rebalance برای هر بازه
+    """
+    if metrics_only:
+        record_history = False
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    close = arrays.close
+    cake_usdt = arrays.cake_usdt
+    bnb_usdt = arrays.bnb_usdt
+    n = len(close)
+    range_percents = list(range_percents)
+    widths = np.asarray(range_percents, dtype=np.float64)
+    n_widths = len(widths)
+    if block_rows is None:
+        block_rows = min(512, max(64, 1_000_000 // max(n_widths, 1)))
+
+    # ─── حالت پوزیشن‌ها روی محور بازه ───
+    L, lower, upper, sqrt_pa, sqrt_pb = _open_positions_vec(
+        np.full(n_widths, float(initial_capital)), close[0], widths,
+        cake_usdt[0], bnb_usdt[0]
+    )
+    total_gas = np.zeros(n_widths)
+    total_slippage = np.zeros(n_widths)
+    rebalance_count = np.zeros(n_widths, dtype=np.int64)
+    periods_out = np.zeros(n_widths, dtype=np.int64)
+    # کندل بعدی که هر بازه از آن بررسی می‌شود (کندل ۰ = باز شدن)
+    cursor = np.ones(n_widths, dtype=np.int64)
+    events = []  # (بازه‌ها، کندل‌ها، حالت جدید) هر ریبالانس گروهی
+
+    estimated_tvl = arrays.volume.mean() * arrays.periods_per_day * 5
+    our_share = min(initial_capital / estimated_tvl, 0.1)
+    fee_volume = arrays.fee_volume(fee_tier)
+    # مشترک بین همه بازه‌ها؛ ترتیب ضرب همان موتور برداری است
+    # (fee_volume * our_share) * concentration_factor
+    fee_share = fee_volume * our_share
+    fee_cap = fee_volume * 0.5
+    concentration = 100 / widths
+    fee_carry = np.zeros(n_widths)
+    if record_history:
+        fee_history = np.empty((n_widths, n))
+        cum_fee_history = np.empty((n_widths, n))
+
+    position = LiquidityPositionV3()
+
+    def advance_scalar(w, block_start, block_stop, block_close, inactive,
+                       scalar_events):
+        """بقیه بلوک یک بازه با پوزیشن اسکالر (حالت از/به آرایه‌ها)"""
+        position.L = float(L[w])
+        position.price_lower = lo = float(lower[w])
+        position.price_upper = up = float(upper[w])
+        position.sqrt_lower = float(sqrt_pa[w])
+        position.sqrt_upper = float(sqrt_pb[w])
+        range_percent = range_percents[w]
+        for t in range(int(cursor[w]), block_stop):
+            price = block_close[t - block_start]
+            if lo <= price <= up:
+                continue
+            cake, bnb = float(cake_usdt[t]), float(bnb_usdt[t])
+            current_pool_value = position.get_value_usd(price, cake, bnb)
+            slippage = (current_pool_value / 2) * (slippage_pct / 100)
+            total_gas[w] += gas_cost_usd
+            total_slippage[w] += slippage
+            position.open_position(
+                max(current_pool_value - gas_cost_usd - slippage, 0), price,
+                range_percent, cake, bnb
+            )
+            lo, up = position.price_lower, position.price_upper
+            rebalance_count[w] += 1
+            if not metrics_only:
+                scalar_events.append((w, t, position.L, lo, up,
+                                      position.sqrt_lower,
+                                      position.sqrt_upper))
+            if not position.is_in_range(price):
+                print(f"   ⚠️ هشدار: بعد از ریبالانس هنوز خارج بازه! "
+                      f"idx={t}, price={price:.6f}, "
+                      f"range=[{lo:.6f}, {up:.6f}]")
+                inactive.append((t, w))
+        L[w], lower[w], upper[w] = position.L, lo, up
+        sqrt_pa[w], sqrt_pb[w] = position.sqrt_lower, position.sqrt_upper
+        cursor[w] = block_stop
+
+    for block_start in range(0, n, block_rows):
+        block_stop = min(block_start + block_rows, n)
+        inactive = []
+        pending = np.flatnonzero(cursor < block_stop)
+        while len(pending) > scalar_widths:
+            hit, exits = _block_range_exits(
+                close, block_start, block_stop, cursor[pending],
+                lower[pending], upper[pending]
+            )
+            cursor[pending[~hit]] = block_stop
+            idx = pending[hit]
+            if not idx.size:
+                break
+            t = exits[hit]
+            price = close[t]
+            cake, bnb = cake_usdt[t], bnb_usdt[t]
+
+            current_pool_value = _position_values_vec(
+                price, L[idx], lower[idx], upper[idx], sqrt_pa[idx],
+                sqrt_pb[idx], cake, bnb
+            )
+            slippage = (current_pool_value / 2) * (slippage_pct / 100)
+            total_gas[idx] += gas_cost_usd
+            total_slippage[idx] += slippage
+            state = _open_positions_vec(
+                np.maximum(current_pool_value - gas_cost_usd - slippage, 0),
+                price, widths[idx], cake, bnb
+            )
+            L[idx], lower[idx], upper[idx], sqrt_pa[idx], sqrt_pb[idx] = \
+                state
+            rebalance_count[idx] += 1
+            if not metrics_only:
+                events.append((idx, t, state if record_history else None))
+
+            # شرط معکوس is_in_range: NaN هم «خارج بازه» است
+            outside = ~((state[1] <= price) & (price <= state[2]))
+            for k in np.flatnonzero(outside):
+                print(f"   ⚠️ هشدار: بعد از ریبالانس هنوز خارج بازه! "
+                      f"idx={t[k]}, price={price[k]:.6f}, "
+                      f"range=[{state[1][k]:.6f}, {state[2][k]:.6f}]")
+                inactive.append((t[k], idx[k]))
+            cursor[idx] = t + 1
+            pending = idx[t + 1 < block_stop]
+
+        if len(pending):
+            block_close = close[block_start:block_stop].tolist()
+            scalar_events = []
+            for w in pending.tolist():
+                advance_scalar(w, block_start, block_stop, block_close,
+                               inactive, scalar_events)
+            if scalar_events:
+                columns = list(zip(*scalar_events))
+                events.append((
+                    np.array(columns[0], dtype=np.int64),
+                    np.array(columns[1], dtype=np.int64),
+                    tuple(np.array(c, dtype=np.float64) for c in columns[2:])
+                    if record_history else None
+                ))
+
+        # ─── کارمزد بلوک (بلوک × بازه) با جمع ترتیبی از مقدار حمل‌شده ───
+        fees = np.minimum(
+            fee_share[block_start:block_stop, None] * concentration,
+            fee_cap[block_start:block_stop, None]
+        )
+        for t_out, w in inactive:
+            fees[t_out - block_start, w] = 0.0
+            periods_out[w] += 1
+        if record_history:
+            fee_history[:, block_start:block_stop] = fees.T
+        fees[0] += fee_carry
+        cum_fees = np.cumsum(fees, axis=0)
+        fee_carry = cum_fees[-1]
+        if record_history:
+            cum_fee_history[:, block_start:block_stop] = cum_fees.T
+
+    # ─── اندیس ریبالانس‌ها (و حالت هر بخش) به تفکیک بازه ───
+    if events:
+        event_widths = np.concatenate([e[0] for e in events])
+        event_times = np.concatenate([e[1] for e in events])
+        order = np.argsort(event_widths, kind='stable')
+        bounds = np.searchsorted(event_widths[order],
+                                 np.arange(n_widths + 1))
+        if record_history:
+            event_states = [np.concatenate([e[2][j] for e in events])[order]
+                            for j in range(5)]
+        event_times = event_times[order]
+
+    hodl_cake_amount = (initial_capital / 2) / cake_usdt[0]
+    hodl_bnb_amount = (initial_capital / 2) / bnb_usdt[0]
+    if record_history:
+        hodl_history = hodl_cake_amount * cake_usdt + \
+            hodl_bnb_amount * bnb_usdt
+        initial_states = _open_positions_vec(
+            np.full(n_widths, float(initial_capital)), close[0], widths,
+            cake_usdt[0], bnb_usdt[0]
+        )
+
+    results = []
+    for w, range_percent in enumerate(range_percents):
+        position = LiquidityPositionV3()
+        position.center_price = close[0]
+        position.range_percent = range_percent
+        position.L, position.price_lower, position.price_upper, \
+            position.sqrt_lower, position.sqrt_upper = \
+            L[w], lower[w], upper[w], sqrt_pa[w], sqrt_pb[w]
+        out_count = int(periods_out[w])
+        result = _summarize_backtest(
+            range_percent, close[0], position, initial_capital,
+            final_prices=(close[-1], cake_usdt[-1], bnb_usdt[-1]),
+            hodl_amounts=(hodl_cake_amount, hodl_bnb_amount),
+            total_fees_usd=float(fee_carry[w]) if n else 0,
+            total_gas_costs=float(total_gas[w]),
+            total_slippage_costs=float(total_slippage[w]),
+            rebalance_count=int(rebalance_count[w]),
+            periods_in_range=n - out_count,
+            periods_out_of_range=out_count,
+            periods_per_day=arrays.periods_per_day,
+        )
+        if not metrics_only:
+            span = slice(bounds[w], bounds[w + 1]) if events else slice(0, 0)
+            starts = event_times[span].tolist() if events else []
+            result['rebalance_timestamps'] = \
+                arrays.timestamps.iloc[starts].tolist()
+            if record_history:
+                starts = [0] + starts
+                lengths = np.diff(starts + [n])
+                segment_states = [
+                    np.concatenate(([initial_states[j][w]],
+                                    event_states[j][span] if events
+                                    else []))
+                    for j in range(5)
+                ]
+                pool_value_history = _position_values_vec(
+                    close,
+                    *(np.repeat(values, lengths) for values in segment_states),
+                    cake_usdt, bnb_usdt
+                )
+                result.update({
+                    'fee_history': fee_history[w],
+                    'pool_value_history': pool_value_history,
+                    'hodl_value_history': hodl_history,
+                    'total_value_history': pool_value_history +
+                    cum_fee_history[w],
+                    'range_history': _range_history_from_starts(
+                        close, starts, range_percent, n
+                    ),
+                })
+            else:
+                result.update(dict.fromkeys(_HISTORY_KEYS))
+        results.append(result)
+    return results
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ک: ایندکس prefix-sum برای بک‌تست پنجره‌های زمانی
+# ═══════════════════════════════════════════════════════════
+
+# نگاشت سرمایه یک دنباله از ریبالانس‌ها: (a, b, p, q)
+#   سرمایه بعد = a × سرمایه قبل + b
+#   جمع ارزش پوزیشن در لحظه ریبالانس‌ها = p × سرمایه قبل + q
+def _compose_cost_maps(first, second):
+    """نگاشت «اول first بعد second»"""
+    a1, b1, p1, q1 = first
+    a2, b2, p2, q2 = second
+    return (a2 * a1, a2 * b1 + b2, p1 + p2 * a1, q1 + p2 * b1 + q2)
+
+
+def _next_range_exits(close, range_percent):
+    """
+    برای هر ردیف t: اولین ردیف s > t که قیمت خارج بازه پوزیشنِ باز شده
+    در t است (همان _find_range_exit، NaN = خارج). بدون خروج → len(close).
+    قیمت t خودش خارج بازه‌اش باشد (NaN) → t + 1.
+
+    جدول sparse کمینه/بیشینه (O(n log n) حافظه موقت) و جستجوی
+    دودویی برداری برای همه t با هم.
+    """
+    n = len(close)
+    price_lower = close * (1 - range_percent / 100)
+    price_upper = close * (1 + range_percent / 100)
+    mins = [np.where(np.isnan(close), -np.inf, close)]
+    maxs = [np.where(np.isnan(close), np.inf, close)]
+    width = 1
+    while 2 * width <= n:
+        mins.append(np.minimum(mins[-1][:-width], mins[-1][width:]))
+        maxs.append(np.maximum(maxs[-1][:-width], maxs[-1][width:]))
+        width *= 2
+
+    exits = np.arange(1, n + 1, dtype=np.int64)
+    for level in range(len(mins) - 1, -1, -1):
+        width = 1 << level
+        fits = exits + width <= n
+        at = np.where(fits, exits, 0)
+        with np.errstate(invalid='ignore'):
+            inside = fits & (mins[level][at] >= price_lower) & \
+                (maxs[level][at] <= price_upper)
+        exits += np.where(inside, width, 0)
+    return exits
+
+
+class BacktestWindowIndex:
+    """
+    ایندکس یک (داده، بازه، هزینه‌ها) برای بک‌تست هر پنجره [start, end]
+    بدون اجرای دوباره کل بک‌تست روی برش داده.
+
+    مرز بازه فقط به قیمت باز شدن بستگی دارد، پس ریبالانس بعدی پوزیشنی
+    که در ردیف t باز شده فقط تابع t است (parent[t]). زمان‌بندی هر
+    پنجره که از x شروع شود مسیر x → parent[x] → ... در این جنگل است؛
+    پنجره‌ای که با زمان‌بندی کل سری هم‌تراز نیست هم مسیر خودش را دارد.
+
+    ساخت (یک بار):
+        - parent همه ردیف‌ها (_next_range_exits، O(n log n))
+        - رشد ارزش پوزیشن واحد از t تا parent[t] = نگاشت سرمایه یک قدم
+        - jump pointer های skew-binary (Myers) با نگاشت ترکیبی تا jump،
+          عمق و جمع تجمعی کندل‌های غیرفعال تا ریشه (O(n) حافظه؛ یک
+          حلقه پایتون روی n ردیف)
+        - prefix-sum حجم و حجم کارمزد
+
+    پرس‌وجو (query): start/end با جستجوی دودویی، بعد بالا رفتن از x تا
+    آخرین ریبالانس ≤ end با jump ها - بدترین حالت O(log n)، مستقل از
+    طول پنجره و هم‌ترازی با کل سری. کارمزد از prefix-sum ها (سهم ما به
+    میانگین حجم پنجره بستگی دارد).
+
+    نتیجه همان dict معیارهای run_backtest_with_rebalance(..., metrics_only)
+    روی برش [start, end] است (تا حد خطای گرد کردن، چون ارزش‌ها به جای
+    پیمایش ترتیبی از ضرب رشد قدم‌ها به دست می‌آیند).
+    """
+
+    __slots__ = ('arrays', 'range_percent', 'fee_tier', 'gas_cost_usd',
+                 'slippage_pct', 'timestamps_ms', '_parent', '_depth',
+                 '_jump', '_jump_maps', '_growth', '_cum_inactive',
+                 '_cum_inactive_fee', '_cum_volume', '_cum_fee_volume')
+
+    def __init__(self, price_data, range_percent, fee_tier=0.25,
+                 gas_cost_usd=0.30, slippage_pct=0.1):
+        arrays = price_data if isinstance(price_data, PriceArrays) \
+            else PriceArrays.from_frame(price_data)
+        self.arrays = arrays
+        self.range_percent = range_percent
+        self.fee_tier = fee_tier
+        self.gas_cost_usd = gas_cost_usd
+        self.slippage_pct = slippage_pct
+        self.timestamps_ms = arrays.timestamps.to_numpy(
+            dtype='datetime64[ms]').astype(np.int64)
+
+        close, cake_usdt, bnb_usdt = arrays.close, arrays.cake_usdt, \
+            arrays.bnb_usdt
+        n = len(close)
+        parent = _next_range_exits(close, range_percent)
+
+        # ─── رشد پوزیشن واحد از باز شدن در t تا ریبالانس در parent[t] ───
+        unit = _open_positions_vec(1.0, close, range_percent,
+                                   cake_usdt, bnb_usdt)
+        growth = np.zeros(n)
+        exits = np.flatnonzero(parent < n)
+        targets = parent[exits]
+        growth[exits] = _position_values_vec(
+            close[targets], *(values[exits] for values in unit),
+            cake_usdt[targets], bnb_usdt[targets]
+        )
+        with np.errstate(invalid='ignore'):
+            inactive = ~((unit[1] <= close) & (close <= unit[2]))
+        fee_volume = arrays.fee_volume(fee_tier)
+
+        # ─── jump pointer ها (ردیف n = ریشه مجازی؛ parent[t] > t) ───
+        keep = 1 - slippage_pct / 200
+        parent_list = parent.tolist() + [n]
+        growth_list = growth.tolist()
+        inactive_list = inactive.tolist()
+        inactive_fee_list = np.where(inactive, fee_volume, 0.0).tolist()
+        depth = [0] * (n + 1)
+        jump = [n] * (n + 1)
+        jump_maps = [(1.0, 0.0, 0.0, 0.0)] * (n + 1)
+        cum_inactive = [0] * (n + 1)
+        cum_inactive_fee = [0.0] * (n + 1)
+        for t in range(n - 1, -1, -1):
+            p = parent_list[t]
+            g = growth_list[t]
+            step = (g * keep, -gas_cost_usd, g, 0.0)
+            depth[t] = depth[p] + 1
+            cum_inactive[t] = cum_inactive[p] + inactive_list[t]
+            cum_inactive_fee[t] = cum_inactive_fee[p] + inactive_fee_list[t]
+            jp = jump[p]
+            if p < n and depth[p] - depth[jp] == depth[jp] - depth[jump[jp]]:
+                jump[t] = jump[jp]
+                jump_maps[t] = _compose_cost_maps(
+                    step, _compose_cost_maps(jump_maps[p], jump_maps[jp])
+                )
+            else:
+                jump[t] = p
+                jump_maps[t] = step
+
+        self._parent = parent
+        self._depth = np.asarray(depth, dtype=np.int64)
+        self._jump = np.asarray(jump, dtype=np.int64)
+        self._jump_maps = np.asarray(jump_maps)
+        self._growth = growth
+        self._cum_inactive = np.asarray(cum_inactive, dtype=np.int64)
+        self._cum_inactive_fee = np.asarray(cum_inactive_fee)
 
-    # ─── نتایج ───
-    final_cake_bnb = price_data['close'].iloc[-1]
-    final_cake_usdt = price_data['cake_usdt'].iloc[-1]
-    final_bnb_usdt = price_data['bnb_usdt'].iloc[-1]
+        # ─── prefix-sum ها ───
+        self._cum_volume = np.concatenate(([0.0], np.cumsum(arrays.volume)))
+        self._cum_fee_volume = np.concatenate(([0.0], np.cumsum(fee_volume)))
 
-    final_pool_value = position.get_value_usd(
-        final_cake_bnb, final_cake_usdt, final_bnb_usdt
-    )
-    final_hodl_value = hodl_cake_amount * final_cake_usdt + \
-                       hodl_bnb_amount * final_bnb_usdt
+    def __len__(self):
+        return len(self.timestamps_ms)
 
-    net_fees = total_fees_usd - total_gas_costs - total_slippage_costs
-    final_total_value = final_pool_value + net_fees
+    def _climb(self, t, last, capital):
+        """
+        سرمایه را از پوزیشن باز شده در t تا آخرین ریبالانس ≤ last جلو
+        می‌برد (جستجوی skew-binary: jump اگر مجاز، وگرنه parent).
+
+        سرمایه منفی نمی‌شود (max(·, 0) موتور)؛ چون b = -gas ≤ 0 و a ≥ 0،
+        وقتی سرمایه بدون clamp به ≤ 0 برسد همانجا می‌ماند، پس شرط
+        «سرمایه مثبت می‌ماند» روی مسیر یکنواست و همان جستجو قدمی را که
+        سرمایه را صفر می‌کند پیدا می‌کند؛ بعد از آن فقط ردیف پیدا می‌شود.
+        Returns: (ردیف آخرین پوزیشن، سرمایه، جمع ارزش پوزیشن در ریبالانس‌ها)
+        """
+        jump, jump_maps, parent = self._jump, self._jump_maps, self._parent
+        keep = 1 - self.slippage_pct / 200
+        value_sum = 0.0
+        while capital > 0:
+            target = jump[t]
+            if target <= last:
+                a, b, p, q = jump_maps[t]
+                if a * capital + b > 0:
+                    value_sum += p * capital + q
+                    capital = a * capital + b
+                    t = target
+                    continue
+            target = parent[t]
+            if target > last:
+                return t, capital, value_sum
+            value = self._growth[t] * capital
+            value_sum += value
+            capital = max(value * keep - self.gas_cost_usd, 0.0)
+            t = target
+
+        capital = 0.0
+        while True:
+            if jump[t] <= last:
+                t = jump[t]
+            elif parent[t] <= last:
+                t = parent[t]
+            else:
+                return t, capital, value_sum
 
-    # IL
-    il_percent = (final_pool_value / final_hodl_value - 1) * 100 \
-        if final_hodl_value > 0 else 0
+    def _row(self, when, side):
+        ts = pd.Timestamp(when).value // 1_000_000
+        return int(np.searchsorted(self.timestamps_ms, ts, side=side))
 
-    total_periods = len(price_data)
-    active_percent = (periods_in_range / total_periods) * 100
-    days = total_periods / 24
+    def query(self, start=None, end=None, initial_capital=10000):
+        """
+        معیارهای بک‌تست روی کندل‌های start ≤ timestamp ≤ end
+        (None → ابتدای/انتهای داده) با سرمایه initial_capital.
+        """
+        x = 0 if start is None else self._row(start, 'left')
+        y = len(self) - 1 if end is None else self._row(end, 'right') - 1
+        if not 0 <= x <= y < len(self):
+            raise ValueError(f"❌ پنجره خالی: {start} → {end}")
+        return self.query_rows(x, y, initial_capital)
+
+    def query_rows(self, x, y, initial_capital=10000):
+        """همان query روی ردیف‌های x تا y (هر دو شامل)"""
+        arrays = self.arrays
+        close, cake_usdt, bnb_usdt = arrays.close, arrays.cake_usdt, \
+            arrays.bnb_usdt
+        range_percent = self.range_percent
+
+        z, capital, value_sum = self._climb(x, y, initial_capital)
+        rebalance_count = int(self._depth[x] - self._depth[z])
+        position = LiquidityPositionV3()
+        position.open_position(capital, close[z], range_percent,
+                               cake_usdt[z], bnb_usdt[z])
+        beyond = self._parent[z]
+        inactive = int(self._cum_inactive[x] - self._cum_inactive[beyond])
+        inactive_fee = float(self._cum_inactive_fee[x] -
+                             self._cum_inactive_fee[beyond])
+
+        # ─── کارمزد از prefix-sum ها ───
+        n = y - x + 1
+        estimated_tvl = (self._cum_volume[y + 1] - self._cum_volume[x]) / n \
+            * arrays.periods_per_day * 5
+        our_share = min(initial_capital / estimated_tvl, 0.1)
+        rate = min(our_share * (100 / range_percent), 0.5)
+        active_fee_volume = float(self._cum_fee_volume[y + 1] -
+                                  self._cum_fee_volume[x]) - inactive_fee
+
+        return _summarize_backtest(
+            range_percent, close[x], position, initial_capital,
+            final_prices=(close[y], cake_usdt[y], bnb_usdt[y]),
+            hodl_amounts=((initial_capital / 2) / cake_usdt[x],
+                          (initial_capital / 2) / bnb_usdt[x]),
+            total_fees_usd=active_fee_volume * rate,
+            total_gas_costs=self.gas_cost_usd * rebalance_count,
+            total_slippage_costs=value_sum * (self.slippage_pct / 200),
+            rebalance_count=rebalance_count,
+            periods_in_range=n - inactive,
+            periods_out_of_range=inactive,
+            periods_per_day=arrays.periods_per_day,
+        )
 
-    total_return = ((final_total_value - initial_capital) / initial_capital) * 100
-    fee_apr = (net_fees / initial_capital) * (365 / max(days, 1)) * 100
-    vs_hodl = ((final_total_value - final_hodl_value) / final_hodl_value) * 100 \
-        if final_hodl_value > 0 else 0
 
-    results = {
-        'range_percent': range_percent,
-        'entry_price': entry_price,
-        'price_lower': position.price_lower,
-        'price_upper': position.price_upper,
-        'active_percent': active_percent,
-        'periods_in_range': periods_in_range,
-        'periods_out_of_range': periods_out_of_range,
-        'rebalance_count': rebalance_count,
-        'total_gas_costs': total_gas_costs,
-        'total_slippage_costs': total_slippage_costs,
-        'rebalance_timestamps': rebalance_timestamps,
-        'total_fees_gross': total_fees_usd,
-        'total_fees_net': net_fees,
-        'fee_apr': fee_apr,
-        'final_pool_value': final_pool_value,
-        'final_hodl_value': final_hodl_value,
-        'final_total_value': final_total_value,
-        'impermanent_loss': il_percent,
-        'total_return': total_return,
-        'vs_hodl': vs_hodl,
-        'fee_history': fee_history,
-        'pool_value_history': pool_value_history,
-        'hodl_value_history': hodl_value_history,
-        'total_value_history': total_value_history,
-        'range_history': range_history,
-        'days': days,
-    }
+def build_window_indexes(price_data, scenarios=DEFAULT_SCENARIOS, **costs):
+    """
+    یک BacktestWindowIndex برای هر بازه (تبدیل به آرایه یک بار).
 
-    return results
+    costs: fee_tier، gas_cost_usd، slippage_pct
+    Returns: {range_percent: BacktestWindowIndex}
+    """
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    return {range_pct: BacktestWindowIndex(arrays, range_pct, **costs)
+            for range_pct in scenarios}
 
 
-def run_all_scenarios(price_data, scenarios, initial_capital=10000):
-    """اجرای بک‌تست برای همه بازه‌ها"""
-    days = len(price_data) / 24
-    print("\n" + "═" * 90)
-    print(f"🚀 شروع بک‌تست - PancakeSwap V3 - CAKE/BNB ({days:.0f} روز)")
-    print("═" * 90)
-    print(f"{'بازه':^8} │ {'فعال%':^8} │ {'ریبالانس':^10} │ "
-          f"{'کارمزد خالص':^14} │ {'APR':^8} │ {'بازده':^10}")
-    print("─" * 90)
+# ═══════════════════════════════════════════════════════════
+# بخش ۳-ل: کش نتایج بک‌تست (حافظه + دیسک)
+# ═══════════════════════════════════════════════════════════
 
-    all_results = {}
-    for range_pct in scenarios:
-        result = run_backtest_with_rebalance(
-            price_data, range_pct, initial_capital
-        )
-        all_results[range_pct] = result
+BACKTEST_CACHE_DIR = '.backtest_cache'
 
-        status = "✅" if result['total_return'] > 0 else "❌"
-        print(f"  ±{range_pct:2d}%   │ {result['active_percent']:6.1f}% │ "
-              f"{result['rebalance_count']:8d}  │ "
-              f"${result['total_fees_net']:10.0f}   │ "
-              f"{result['fee_apr']:6.1f}% │ "
-              f"{result['total_return']:+8.2f}% {status}")
 
-    print("─" * 90)
-    return all_results
+def dataset_fingerprint(price_data):
+    """
+    hash محتوای price_data (قیمت‌ها، حجم و timestamp ها) - هر تغییر در
+    داده (مثلاً افزودن کندل‌های جدید) fingerprint جدید می‌دهد.
+    """
+    arrays = price_data if isinstance(price_data, PriceArrays) \
+        else PriceArrays.from_frame(price_data)
+    digest = hashlib.blake2b(digest_size=16)
+    for values in (arrays.close, arrays.cake_usdt, arrays.bnb_usdt,
+                   arrays.volume):
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).data)
+    digest.update(np.ascontiguousarray(
+        arrays.timestamps.to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    ).data)
+    if _is_segmented(price_data):
+        # همان کندل‌ها با بخش‌بندی split نتیجه دیگری دارند
+        digest.update(np.ascontiguousarray(
+            price_data['segment'].to_numpy(dtype=np.int64)).data)
+    return digest.hexdigest()
+
+
+class BacktestCache:
+    """
+    کش نتایج run_backtest_with_rebalance.
+
+    کلید = fingerprint داده + (بازه، سرمایه، fee، gas، slippage، حالت خروجی)؛
+    موتور جزو کلید نیست چون همه موتورها نتیجه یکسان می‌دهند.
+
+    - لایه حافظه: LRU با حداکثر max_entries نتیجه
+    - لایه دیسک: یک فایل pickle برای هر نتیجه در cache_dir؛ اگر حجم کل
+      از max_disk_bytes بیشتر شود قدیمی‌ترین‌ها (آخرین استفاده) حذف می‌شوند
+      و فایل‌هایی که max_age_days استفاده نشده‌اند هم (هنگام ساخت و هر put).
+      فهرست فایل‌ها (ترتیب استفاده + حجم) در حافظه نگه داشته می‌شود و
+      فقط هنگام ساخت از روی دیسک خوانده می‌شود؛ put پوشه را اسکن نمی‌کند.
+      disk_dir=None → فقط حافظه
+    - track(dataset, price_data): fingerprint فعلی هر مجموعه داده (مثلاً
+      'CAKEUSDT/BNBUSDT@1h') در datasets.json نگه داشته می‌شود؛ وقتی داده
+      به‌روز شود (کندل‌های جدید merge شده) نتایج نسخه قبلی خودکار حذف
+      می‌شوند. run(..., dataset=...) و run_all_scenarios(dataset=...)
+      همین را صدا می‌زنند
+    - invalidate(price_data) همه نتایج یک نسخه داده را حذف می‌کند؛
+      clear() همه چیز را
+    - stats(): شمارنده‌های hit (حافظه/دیسک)، miss و eviction
+
+    نتیجه برگشتی یک کپی سطحی dict است؛ آرایه‌های تاریخچه بین فراخوانی‌ها
+    مشترک‌اند و نباید تغییر داده شوند.
+    """
+
+    def __init__(self, max_entries=256, disk_dir=BACKTEST_CACHE_DIR,
+                 max_disk_bytes=512 * 2 ** 20, max_age_days=30):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age_days = max_age_days
+        self._memory = OrderedDict()
+        # فهرست دیسک: key → [آخرین استفاده، حجم]، به ترتیب استفاده
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._datasets = {}
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            path = self._datasets_path()
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    self._datasets = json.load(f)
+            self._scan_disk()
+            self._evict_disk()
+
+    def _datasets_path(self):
+        return os.path.join(self.disk_dir, 'datasets.json')
+
+    def track(self, dataset, price_data=None, fingerprint=None):
+        """
+        ثبت fingerprint فعلی dataset؛ اگر با نسخه ثبت‌شده قبلی فرق کند،
+        نتایج نسخه قبلی (حافظه و دیسک) حذف می‌شوند.
+        Returns: fingerprint فعلی
+        """
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(price_data)
+        with self._lock:
+            previous = self._datasets.get(dataset)
+            if previous == fingerprint:
+                return fingerprint
+            self._datasets[dataset] = fingerprint
+            snapshot = dict(self._datasets)
+        if previous is not None and previous not in snapshot.values():
+            self.invalidate(fingerprint=previous)
+            with self._lock:
+                self.invalidations += 1
+            METRICS.count('backtest_cache_invalidations')
+        if self.disk_dir:
+            KlineCache._atomic_write(
+                self._datasets_path(),
+                lambda f: f.write(json.dumps(snapshot).encode())
+            )
+        return fingerprint
+
+    @staticmethod
+    def make_key(fingerprint, range_percent, initial_capital=10000,
+                 fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1,
+                 record_history=True, metrics_only=False):
+        """کلید: '<fingerprint>_<hash پارامترها>' (پیشوند برای invalidate)"""
+        mode = 'metrics' if metrics_only else \
+            'full' if record_history else 'no_history'
+        params = repr((float(range_percent), float(initial_capital),
+                       float(fee_tier), float(gas_cost_usd),
+                       float(slippage_pct), mode))
+        digest = hashlib.blake2b(params.encode(), digest_size=12).hexdigest()
+        return f'{fingerprint}_{digest}'
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.pkl')
+
+    def _scan_disk(self):
+        """ساخت فهرست دیسک از فایل‌های موجود (فقط هنگام ساخت)"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        with self._lock:
+            self._disk = OrderedDict((key, [mtime, size])
+                                     for mtime, key, size in sorted(entries))
+            self._disk_bytes = sum(size for _, _, size in entries)
+
+    def _index_disk(self, key, size=None):
+        """ثبت استفاده از فایل key در فهرست (size=None → حجم قبلی)"""
+        with self._lock:
+            entry = self._disk.get(key)
+            if entry is None:
+                entry = self._disk[key] = [0.0, 0]
+            if size is not None:
+                self._disk_bytes += size - entry[1]
+                entry[1] = size
+            entry[0] = time_module.time()
+            self._disk.move_to_end(key)
+
+    def _unindex_disk(self, key):
+        with self._lock:
+            entry = self._disk.pop(key, None)
+            if entry is not None:
+                self._disk_bytes -= entry[1]
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """نتیجه کش‌شده یا None (شمارنده‌ها به‌روز می‌شوند)"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                METRICS.count('backtest_cache_hits_memory')
+                return dict(self._memory[key])
+        if self.disk_dir:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    result = pickle.load(f)
+                    size = os.fstat(f.fileno()).st_size
+                os.utime(path)  # زمان آخرین استفاده برای eviction
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                result = None
+            if result is not None:
+                self._index_disk(key, size)
+                with self._lock:
+                    self.hits_disk += 1
+                    self._remember(key, result)
+                METRICS.count('backtest_cache_hits_disk')
+                return dict(result)
+        with self._lock:
+            self.misses += 1
+        METRICS.count('backtest_cache_misses')
+        return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._remember(key, result)
+        if self.disk_dir:
+            path = self._path(key)
+            KlineCache._atomic_write(
+                path,
+                lambda f: pickle.dump(result, f,
+                                      protocol=pickle.HIGHEST_PROTOCOL)
+            )
+            self._index_disk(key, os.path.getsize(path))
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """
+        حذف قدیمی‌ترین فایل‌ها (ابتدای فهرست) تا حجم کل زیر max_disk_bytes
+        برسد، و همه فایل‌هایی که بیش از max_age_days استفاده نشده‌اند
+        """
+        expire_before = -math.inf if self.max_age_days is None else \
+            time_module.time() - self.max_age_days * 86400
+        while True:
+            with self._lock:
+                if not self._disk:
+                    return
+                key, (last_used, size) = next(iter(self._disk.items()))
+                if self._disk_bytes <= self.max_disk_bytes and \
+                        last_used >= expire_before:
+                    return
+                del self._disk[key]
+                self._disk_bytes -= size
+                self.evictions += 1
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(key))
+            METRICS.count('backtest_cache_evictions')
+
+    def run(self, price_data, range_percent, initial_capital=10000,
+            fee_tier=0.25, gas_cost_usd=0.30, slippage_pct=0.1,
+            engine='vectorized', record_history=True, metrics_only=False,
+            fingerprint=None, dataset=None):
+        """
+        run_backtest_with_rebalance با کش. fingerprint از قبل محاسبه‌شده
+        (dataset_fingerprint) hash کردن دوباره داده را حذف می‌کند.
+        dataset: برچسب داده → track (نتایج نسخه قبلی همان داده حذف می‌شوند)
+        """
+        if dataset is not None:
+            fingerprint = self.track(dataset, price_data, fingerprint)
+        elif fingerprint is None:
+            fingerprint = dataset_fingerprint(price_data)
+        key = self.make_key(fingerprint, range_percent, initial_capital,
+                            fee_tier, gas_cost_usd, slippage_pct,
+                            record_history, metrics_only)
+        result = self.get(key)
+        if result is None:
+            result = run_backtest_with_rebalance(
+                price_data, range_percent, initial_capital,
+                fee_tier=fee_tier, gas_cost_usd=gas_cost_usd,
+                slippage_pct=slippage_pct, engine=engine,
+                record_history=record_history, metrics_only=metrics_only
+            )
+            self.put(key, result)
+            result = dict(result)
+        return result
+
+    def invalidate(self, price_data=None, fingerprint=None):
+        """
+        حذف همه نتایج یک نسخه داده (price_data یا fingerprint آن).
+        Returns: تعداد نتایج حذف‌شده (حافظه + دیسک)
+        """
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(price_data)
+        prefix = f'{fingerprint}_'
+        removed = 0
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(prefix)]:
+                del self._memory[key]
+                removed += 1
+        if self.disk_dir:
+            # اسکن پوشه (نه فهرست): فایل‌های پروسس‌های دیگر هم حذف شوند
+            for entry in os.scandir(self.disk_dir):
+                if entry.name.startswith(prefix):
+                    self._unindex_disk(entry.name[:-4])
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
+                        removed += 1
+        return removed
+
+    def clear(self):
+        """حذف کامل کش (حافظه، دیسک و fingerprint مجموعه داده‌ها)"""
+        with self._lock:
+            self._memory.clear()
+            self._datasets = {}
+            self._disk.clear()
+            self._disk_bytes = 0
+        if self.disk_dir:
+            for entry in os.scandir(self.disk_dir):
+                if entry.name.endswith('.pkl') or \
+                        entry.path == self._datasets_path():
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
+
+    def stats(self):
+        hits = self.hits_memory + self.hits_disk
+        lookups = hits + self.misses
+        return {
+            'hits_memory': self.hits_memory,
+            'hits_disk': self.hits_disk,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+            'disk_entries': len(self._disk),
+            'disk_bytes': self._disk_bytes,
+        }
 
 
 # ═══════════════════════════════════════════════════════════
 # بخش ۴: نمودارها - اصلاح‌شده با بازه ۱ ساله
 # ═══════════════════════════════════════════════════════════
 
-def create_all_charts(all_results, price_data, initial_capital=10000):
-    """ساخت همه نمودارها"""
+def _decimate_minmax(x, y, n_columns):
+    """
+    کاهش نقاط سری زمانی به وضوح پیکسل.
 
-    ranges = sorted(all_results.keys())
-    sorted_results = sorted(
-        all_results.items(),
-        key=lambda x: x[1]['total_return'], reverse=True
-    )
-    top3 = [r[0] for r in sorted_results[:3]]
-    days = len(price_data) / 24
+    سری به n_columns ستون تقسیم و در هر ستون فقط نقطه کمینه و بیشینه
+    نگه داشته می‌شود؛ پوش بصری (نوسان‌ها) دقیقاً حفظ می‌شود ولی
+    تعداد نقاط رسم‌شده حداکثر 2 × n_columns است.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= 2 * n_columns:
+        return x, y
+
+    bucket = -(-n // n_columns)
+    n_buckets = -(-n // bucket)
+    padded = np.empty(n_buckets * bucket, dtype=np.float64)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    blocks = padded.reshape(n_buckets, bucket)
+    offsets = np.arange(n_buckets) * bucket
+
+    idx = np.concatenate([offsets + blocks.argmin(axis=1),
+                          offsets + blocks.argmax(axis=1), [0, n - 1]])
+    idx = np.unique(np.minimum(idx, n - 1))
+    return x[idx], y[idx]
+
+
+def _axes_pixel_columns(ax, dpi):
+    """
+    عرض ناحیه رسم یک subplot بر حسب پیکسل در dpi خروجی (نه عرض کل
+    شکل؛ در شبکه 2×3 هر ستون حدود یک‌چهارم آن است)
+    """
+    width = ax.get_position().width * ax.figure.get_figwidth() * dpi
+    return max(int(width), 1)
 
-    # ═══════════════════════════════════════════════════════════
-    # نمودار ۱: بهینه‌سازی کلی
-    # ═══════════════════════════════════════════════════════════
-    print("\n📊 ساخت نمودار ۱: بهینه‌سازی کلی...")
+
+def _chart_optimization(all_results, price_data, initial_capital, top3,
+                        dpi, fmt):
+    """نمودار ۱: بهینه‌سازی کلی"""
+    ranges = sorted(all_results.keys())
+    days = len(price_data) / infer_periods_per_day(price_data)
 
     fig1, axes1 = plt.subplots(2, 3, figsize=(20, 13))
     fig1.suptitle(
@@ -598,7 +4878,8 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
 
     # 1-1: قیمت CAKE/BNB
     ax = axes1[0, 0]
-    ax.plot(price_data['timestamp'], price_data['close'],
+    ax.plot(*_decimate_minmax(price_data['timestamp'], price_data['close'],
+                              _axes_pixel_columns(ax, dpi)),
             color='#F0B90B', linewidth=0.8)
     ax.set_title('CAKE/BNB Price', fontsize=11, fontweight='bold')
     ax.set_ylabel('CAKE/BNB')
@@ -680,15 +4961,17 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
     plt.colorbar(scatter, ax=ax, label='Range Width (%)')
 
     plt.tight_layout()
-    plt.savefig('pancakeswap_optimization_v3.png', dpi=300,
+    filename = f'pancakeswap_optimization_v3.{fmt}'
+    plt.savefig(filename, dpi=dpi,
                 bbox_inches='tight', facecolor='white')
-    print("   ✅ ذخیره شد: pancakeswap_optimization_v3.png")
     plt.close(fig1)
+    return filename
 
-    # ═══════════════════════════════════════════════════════════
-    # نمودار ۲: مقایسه ۳ بازه برتر
-    # ═══════════════════════════════════════════════════════════
-    print("📊 ساخت نمودار ۲: مقایسه ۳ برتر...")
+
+def _chart_top3(all_results, price_data, initial_capital, top3,
+                dpi, fmt):
+    """نمودار ۲: مقایسه ۳ بازه برتر"""
+    days = len(price_data) / infer_periods_per_day(price_data)
 
     fig2, axes2 = plt.subplots(2, 2, figsize=(16, 12))
     fig2.suptitle(
@@ -697,6 +4980,8 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
         fontsize=15, fontweight='bold'
     )
 
+    timestamps = price_data['timestamp']
+
     colors_top3 = {}
     palette = ['#27ae60', '#3498db', '#f39c12']
     for i, r in enumerate(top3):
@@ -704,13 +4989,16 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
 
     # 2-1: ارزش کل
     ax = axes2[0, 0]
+    pixel_columns = _axes_pixel_columns(ax, dpi)
     for r in top3:
         result = all_results[r]
-        ax.plot(price_data['timestamp'], result['total_value_history'],
+        ax.plot(*_decimate_minmax(timestamps, result['total_value_history'],
+                                  pixel_columns),
                 label=f'±{r}% (rebal: {result["rebalance_count"]}x)',
                 color=colors_top3[r], linewidth=1.5)
-    ax.plot(price_data['timestamp'],
-            all_results[top3[0]]['hodl_value_history'],
+    ax.plot(*_decimate_minmax(timestamps,
+                              all_results[top3[0]]['hodl_value_history'],
+                              pixel_columns),
             label='HODL', color='gray', linewidth=2, linestyle='--')
     ax.axhline(y=initial_capital, color='red', linestyle=':',
                alpha=0.5, label=f'Initial: ${initial_capital:,}')
@@ -722,10 +5010,11 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
 
     # 2-2: تجمعی کارمزد
     ax = axes2[0, 1]
+    pixel_columns = _axes_pixel_columns(ax, dpi)
     for r in top3:
         result = all_results[r]
         cum_fees = np.cumsum(result['fee_history'])
-        ax.plot(price_data['timestamp'], cum_fees,
+        ax.plot(*_decimate_minmax(timestamps, cum_fees, pixel_columns),
                 label=f'±{r}% (${result["total_fees_gross"]:,.0f})',
                 color=colors_top3[r], linewidth=1.5)
     ax.set_title('Cumulative Fees (Gross)', fontsize=10, fontweight='bold')
@@ -806,15 +5095,18 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
     ax.set_title('Top 3 Summary', fontsize=11, fontweight='bold', pad=20)
 
     plt.tight_layout()
-    plt.savefig('pancakeswap_top3_v3.png', dpi=300,
+    filename = f'pancakeswap_top3_v3.{fmt}'
+    plt.savefig(filename, dpi=dpi,
                 bbox_inches='tight', facecolor='white')
-    print("   ✅ ذخیره شد: pancakeswap_top3_v3.png")
     plt.close(fig2)
+    return filename
+
 
-    # ═══════════════════════════════════════════════════════════
-    # نمودار ۳: تحلیل ریبالانسینگ
-    # ═══════════════════════════════════════════════════════════
-    print("📊 ساخت نمودار ۳: تحلیل ریبالانسینگ...")
+def _chart_rebalancing(all_results, price_data, initial_capital, top3,
+                       dpi, fmt):
+    """نمودار ۳: تحلیل ریبالانسینگ"""
+    ranges = sorted(all_results.keys())
+    days = len(price_data) / infer_periods_per_day(price_data)
 
     fig3, axes3 = plt.subplots(2, 2, figsize=(16, 12))
     fig3.suptitle(
@@ -881,15 +5173,17 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
     plt.colorbar(scatter, ax=ax, label='Range %')
 
     plt.tight_layout()
-    plt.savefig('pancakeswap_rebalancing_v3.png', dpi=300,
+    filename = f'pancakeswap_rebalancing_v3.{fmt}'
+    plt.savefig(filename, dpi=dpi,
                 bbox_inches='tight', facecolor='white')
-    print("   ✅ ذخیره شد: pancakeswap_rebalancing_v3.png")
     plt.close(fig3)
+    return filename
+
 
-    # ═══════════════════════════════════════════════════════════
-    # نمودار ۴: نمایش بصری ریبالانسینگ بهترین بازه
-    # ═══════════════════════════════════════════════════════════
-    print("📊 ساخت نمودار ۴: نمایش بصری ریبالانسینگ...")
+def _chart_rebalance_visual(all_results, price_data, initial_capital, top3,
+                            dpi, fmt):
+    """نمودار ۴: نمایش بصری ریبالانسینگ بهترین بازه"""
+    days = len(price_data) / infer_periods_per_day(price_data)
 
     best_range = top3[0]
     best_result = all_results[best_range]
@@ -903,26 +5197,42 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
         fontsize=14, fontweight='bold'
     )
 
-    timestamps = price_data['timestamp']
+    timestamps = price_data['timestamp'].to_numpy()
     prices = price_data['close']
+    # هر سه subplot هم‌عرض‌اند (یک ستون)
+    pixel_columns = _axes_pixel_columns(axes4[0], dpi)
 
     # 4-1: قیمت با بازه‌ها
     ax = axes4[0]
-    ax.plot(timestamps, prices, color='#2c3e50', linewidth=0.8,
-            label='CAKE/BNB', zorder=3)
+    ax.plot(*_decimate_minmax(timestamps, prices, pixel_columns),
+            color='#2c3e50', linewidth=0.8, label='CAKE/BNB', zorder=3)
 
-    range_lowers = [rh['lower'] for rh in best_result['range_history']]
-    range_uppers = [rh['upper'] for rh in best_result['range_history']]
+    # بازه‌ها پله‌ای‌اند → فقط نقاط تغییر رسم می‌شوند (step='post')
+    range_history = best_result['range_history']
+    step_x = np.append(timestamps[range_history.starts], timestamps[-1])
+    step_lowers = np.append(range_history.lower, range_history.lower[-1])
+    step_uppers = np.append(range_history.upper, range_history.upper[-1])
 
-    ax.fill_between(timestamps, range_lowers, range_uppers,
+    ax.fill_between(step_x, step_lowers, step_uppers, step='post',
                     alpha=0.15, color='green', label='Active Range')
-    ax.plot(timestamps, range_lowers, color='green', linewidth=0.5, alpha=0.5)
-    ax.plot(timestamps, range_uppers, color='green', linewidth=0.5, alpha=0.5)
-
-    # نقاط ریبالانس (حداکثر ۱۰۰ خط)
-    max_lines = min(100, len(best_result['rebalance_timestamps']))
-    for ts in best_result['rebalance_timestamps'][:max_lines]:
-        ax.axvline(x=ts, color='red', alpha=0.2, linewidth=0.5)
+    ax.step(step_x, step_lowers, where='post',
+            color='green', linewidth=0.5, alpha=0.5)
+    ax.step(step_x, step_uppers, where='post',
+            color='green', linewidth=0.5, alpha=0.5)
+
+    # نقاط ریبالانس - همه در یک LineCollection (به جای یک axvline برای هر کدام)
+    rebalance_x = mdates.date2num(
+        pd.to_datetime(best_result['rebalance_timestamps'])
+    )
+    if len(rebalance_x):
+        segments = np.stack([
+            np.column_stack([rebalance_x, np.zeros(len(rebalance_x))]),
+            np.column_stack([rebalance_x, np.ones(len(rebalance_x))]),
+        ], axis=1)
+        ax.add_collection(LineCollection(
+            segments, transform=ax.get_xaxis_transform(),
+            colors='red', alpha=0.2, linewidths=0.5
+        ))
 
     ax.set_title(
         f'Price with Dynamic Range ±{best_range}%\n'
@@ -935,11 +5245,13 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
 
     # 4-2: مقایسه ارزش
     ax = axes4[1]
-    ax.plot(timestamps, best_result['total_value_history'],
+    ax.plot(*_decimate_minmax(timestamps, best_result['total_value_history'],
+                              pixel_columns),
             color='#27ae60', linewidth=1.5,
             label=f'LP (±{best_range}%): '
                   f'${best_result["final_total_value"]:,.0f}')
-    ax.plot(timestamps, best_result['hodl_value_history'],
+    ax.plot(*_decimate_minmax(timestamps, best_result['hodl_value_history'],
+                              pixel_columns),
             color='#95a5a6', linewidth=1.5, linestyle='--',
             label=f'HODL: ${best_result["final_hodl_value"]:,.0f}')
     ax.axhline(y=initial_capital, color='red', linestyle=':',
@@ -952,7 +5264,8 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
     # 4-3: کارمزد تجمعی
     ax = axes4[2]
     cum_fees = np.cumsum(best_result['fee_history'])
-    ax.plot(timestamps, cum_fees, color='#F0B90B', linewidth=1.5,
+    ax.plot(*_decimate_minmax(timestamps, cum_fees, pixel_columns),
+            color='#F0B90B', linewidth=1.5,
             label=f'Cumulative Fees: ${best_result["total_fees_gross"]:,.0f}')
     total_costs = best_result['total_gas_costs'] + \
                   best_result['total_slippage_costs']
@@ -965,12 +5278,86 @@ def create_all_charts(all_results, price_data, initial_capital=10000):
     ax.grid(True, alpha=0.3)
 
     plt.tight_layout()
-    plt.savefig('pancakeswap_rebalance_visual_v3.png', dpi=300,
+    filename = f'pancakeswap_rebalance_visual_v3.{fmt}'
+    plt.savefig(filename, dpi=dpi,
                 bbox_inches='tight', facecolor='white')
-    print("   ✅ ذخیره شد: pancakeswap_rebalance_visual_v3.png")
     plt.close(fig4)
+    return filename
+
+
+# ترتیب نمودارها = ترتیب فایل‌ها
+_CHART_RENDERERS = (_chart_optimization, _chart_top3,
+                    _chart_rebalancing, _chart_rebalance_visual)
+
+# آرگومان‌های مشترک نمودارها در پروسس‌های worker
+_CHART_CONTEXT = None
+
+
+def _init_chart_worker(context, metrics_enabled=False):
+    """initializer پروسس‌های رسم: backend غیرتعاملی Agg + داده مشترک"""
+    global _CHART_CONTEXT
+    plt.switch_backend('Agg')
+    _CHART_CONTEXT = context
+    _init_worker_metrics(metrics_enabled)
+
+
+def _render_chart(render, context):
+    """رسم یک نمودار → (نام فایل، زمان رسم و savefig به ثانیه)"""
+    started = time_module.perf_counter()
+    filename = render(*context)
+    return filename, time_module.perf_counter() - started
+
+
+def _chart_worker(index):
+    return _worker_result(_render_chart(_CHART_RENDERERS[index],
+                                        _CHART_CONTEXT))
+
+
+def create_all_charts(all_results, price_data, initial_capital=10000,
+                      dpi=300, fmt='png', workers=None, verbose=True):
+    """
+    ساخت همه نمودارها
+
+    - هر نمودار در یک پروسس جدا (backend Agg) رسم و ذخیره می‌شود
+    - سری‌های زمانی متراکم به وضوح پیکسل کاهش می‌یابند (min/max)
+    - dpi و fmt (png، svg، pdf، ...) قابل تنظیم‌اند
+    - workers=1 → رسم ترتیبی در همین پروسس
+    """
+    log = print if verbose else _silent
+    sorted_results = sorted(
+        all_results.items(),
+        key=lambda x: x[1]['total_return'], reverse=True
+    )
+    top3 = [r[0] for r in sorted_results[:3]]
+    context = (all_results, price_data, initial_capital, top3, dpi, fmt)
+
+    if workers is None:
+        workers = min(len(_CHART_RENDERERS), os.cpu_count() or 1)
+
+    log(f"\n📊 ساخت {len(_CHART_RENDERERS)} نمودار "
+        f"({workers} worker، {dpi} dpi، {fmt})...")
 
-    print("\n✅ همه نمودارها ساخته شدند!")
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=_get_pool_context(),
+            initializer=_init_chart_worker,
+            initargs=(context, METRICS.enabled)
+        )
+        with executor:
+            futures = {executor.submit(_chart_worker, i): render.__name__
+                       for i, render in enumerate(_CHART_RENDERERS)}
+            for future in as_completed(futures):
+                filename, elapsed = _merge_worker_result(future.result())
+                METRICS.observe('chart', elapsed, futures[future])
+                log(f"   ✅ ذخیره شد: {filename}")
+    else:
+        for render in _CHART_RENDERERS:
+            filename, elapsed = _render_chart(render, context)
+            METRICS.observe('chart', elapsed, render.__name__)
+            log(f"   ✅ ذخیره شد: {filename}")
+
+    log("\n✅ همه نمودارها ساخته شدند!")
     return top3
 
 
@@ -1000,7 +5387,7 @@ def print_results(all_results):
         medal = ["🥇", "🥈", "🥉"][i] if i < 3 else "  "
         costs = r['total_gas_costs'] + r['total_slippage_costs']
         print(
-            f"{medal} ±{range_pct:2d}%  │ "
+            f"{medal} ±{range_pct:2g}%  │ "
             f"{r['active_percent']:5.1f}% │ "
             f"{r['rebalance_count']:7d}  │ "
             f"${r['total_fees_gross']:10.0f}   │ "
@@ -1048,12 +5435,643 @@ def print_results(all_results):
     return sorted_results
 
 
+# ═══════════════════════════════════════════════════════════
+# بخش ۵-ب: بنچمارک مراحل خط لوله (بدون شبکه)
+# ═══════════════════════════════════════════════════════════
+
+# فایل baseline بنچمارک (برای مقایسه بین نسخه‌ها)
+BENCHMARK_BASELINE = 'benchmark_baseline.json'
+
+BENCHMARK_STAGES = ('load_data', 'get_amounts', 'get_amounts_scalar',
+                    'backtest', 'run_all_scenarios', 'charts')
+
+
+def write_kline_fixture(price_data, cache_dir, interval='1h', end_time=None):
+    """
+    ضبط یک سری جفت‌ارز به شکل کش کندل (CAKEUSDT و BNBUSDT در
+    KlineCache) تا get_pancakeswap_pair_data(offline=True، cache_dir)
+    بدون شبکه همان داده را بخواند.
+
+    آخرین کندل روی آخرین کندل بسته‌شده قبل از end_time (پیش‌فرض اکنون)
+    قرار می‌گیرد؛ high/low برابر close (سری مصنوعی دامنه ندارد).
+    """
+    interval_ms = INTERVAL_MS[interval]
+    if end_time is None:
+        end_time = int(datetime.now().timestamp() * 1000)
+    last_open = (end_time // interval_ms) * interval_ms - interval_ms
+    n_rows = len(price_data)
+    timestamps = last_open - np.arange(n_rows - 1, -1, -1,
+                                       dtype=np.int64) * interval_ms
+
+    cache = KlineCache(cache_dir)
+    for symbol, price_col, volume_col in (
+            ('CAKEUSDT', 'cake_usdt', 'cake_volume'),
+            ('BNBUSDT', 'bnb_usdt', 'bnb_volume')):
+        arr = np.empty(n_rows, dtype=KLINE_DTYPE)
+        arr['timestamp'] = timestamps
+        arr['close'] = price_data[price_col].to_numpy(dtype=np.float64)
+        arr['high'] = arr['close']
+        arr['low'] = arr['close']
+        arr['quote_volume'] = price_data[volume_col].to_numpy(dtype=np.float64)
+        cache.merge(symbol, interval, arr)
+    return cache_dir
+
+
+def _measure_stage(fn, repeats=3, memory=True):
+    """
+    اجرای fn و اندازه‌گیری: بهترین زمان از repeats بار + حافظه اوج
+    (tracemalloc، در یک اجرای جدا تا سربار ردیابی در زمان نیاید).
+
+    fn باید تعداد واحد پردازش‌شده (ردیف، سناریو، نمودار) را برگرداند.
+    Returns: (ثانیه، واحدها، حافظه اوج بر حسب MB یا None)
+    """
+    best = float('inf')
+    units = 0
+    for _ in range(max(repeats, 1)):
+        t0 = time_module.perf_counter()
+        units = fn()
+        best = min(best, time_module.perf_counter() - t0)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return best, units, peak_mb
+
+
+def _benchmark_environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_benchmark(results, baseline, tolerance=0.20):
+    """
+    مقایسه نتایج با baseline (هم‌کلید: stage + rows).
+
+    ratio = زمان فعلی / زمان baseline؛ regression یعنی ratio بیشتر از
+    1 + tolerance. مراحلی که در baseline نیستند ratio ندارند.
+    """
+    base = {(r['stage'], r['rows']): r for r in baseline.get('results', [])}
+    rows = []
+    for r in results:
+        ref = base.get((r['stage'], r['rows']))
+        ratio = r['seconds'] / ref['seconds'] \
+            if ref and ref['seconds'] > 0 else None
+        rows.append({
+            'stage': r['stage'],
+            'rows': r['rows'],
+            'seconds': r['seconds'],
+            'baseline_seconds': ref['seconds'] if ref else None,
+            'ratio': ratio,
+            'regression': ratio is not None and ratio > 1 + tolerance,
+        })
+    return pd.DataFrame(rows)
+
+
+def run_benchmark_suite(sizes=(8760,), stages=BENCHMARK_STAGES, repeats=3,
+                        interval='1h', engine='vectorized', workers=1,
+                        scenarios=DEFAULT_SCENARIOS, initial_capital=10000,
+                        chart_dpi=100, memory=True, baseline_path=BENCHMARK_BASELINE,
+                        update_baseline=False, tolerance=0.20, seed=42,
+                        verbose=True):
+    """
+    بنچمارک مراحل main() روی سری مصنوعی با طول‌های sizes (کندل):
+
+        load_data          get_pancakeswap_pair_data از fixture کش
+                           (write_kline_fixture، offline → بدون شبکه)
+        get_amounts        LiquidityPositionV3.get_amounts روی آرایه قیمت
+        get_amounts_scalar همان، یک قیمت در هر فراخوانی (حداکثر ۱۰ هزار)
+        backtest           run_backtest_with_rebalance (±5%، تاریخچه کامل)
+        run_all_scenarios  همه سناریوها با تاریخچه (مثل main)
+        charts             create_all_charts در پوشه موقت (workers=1)
+
+    برای هر مرحله: زمان (بهترین از repeats)، throughput (ردیف/ثانیه،
+    سناریو/ثانیه یا نمودار/ثانیه) و حافظه اوج (tracemalloc).
+
+    baseline_path: اگر فایل نباشد یا update_baseline=True نتایج به‌عنوان
+    baseline ذخیره می‌شوند، وگرنه با آن مقایسه (compare_benchmark).
+    اعداد به ماشین وابسته‌اند؛ baseline را روی همان ماشین بسازید.
+
+    Returns: (DataFrame نتایج، DataFrame مقایسه یا None)
+    """
+    log = print if verbose else _silent
+    unknown = set(stages) - set(BENCHMARK_STAGES)
+    if unknown:
+        raise ValueError(f"❌ مرحله ناشناخته: {', '.join(sorted(unknown))} "
+                         f"(مجاز: {', '.join(BENCHMARK_STAGES)})")
+    per_day = periods_per_day(interval)
+    freq = pd.Timedelta(milliseconds=INTERVAL_MS[interval])
+
+    log("\n" + "═" * 75)
+    log(f"⏱️ بنچمارک مراحل ({', '.join(f'{n:,}' for n in sizes)} کندل "
+        f"{interval}، {repeats} تکرار)")
+    log("═" * 75)
+
+    results = []
+    for n_rows in sizes:
+        price_data = generate_synthetic_pair_data(n_rows, seed, freq=freq)
+        work_dir = tempfile.mkdtemp(prefix='pcs_bench_')
+        all_results = {}
+
+        def load_data():
+            df = get_pancakeswap_pair_data(
+                target_days=max(n_rows // per_day, 1), interval=interval,
+                cache_dir=os.path.join(work_dir, 'klines'), offline=True,
+                verbose=False
+            )
+            return len(df)
+
+        position = LiquidityPositionV3()
+        prices = price_data['close'].to_numpy()
+        position.open_position(initial_capital, prices[0], 5,
+                               price_data['cake_usdt'].iloc[0],
+                               price_data['bnb_usdt'].iloc[0])
+        scalar_prices = prices[:10_000].tolist()
+
+        def get_amounts():
+            position.get_amounts(prices)
+            return len(prices)
+
+        def get_amounts_scalar():
+            for price in scalar_prices:
+                position.get_amounts(price)
+            return len(scalar_prices)
+
+        def backtest():
+            run_backtest_with_rebalance(price_data, 5, initial_capital,
+                                        engine=engine)
+            return n_rows
+
+        def scenarios_stage():
+            all_results.clear()
+            all_results.update(run_all_scenarios(
+                price_data, scenarios, initial_capital, engine=engine,
+                workers=workers, verbose=False
+            ))
+            return len(scenarios)
+
+        def charts():
+            if not all_results:
+                scenarios_stage()
+            cwd = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                create_all_charts(all_results, price_data, initial_capital,
+                                  dpi=chart_dpi, workers=1, verbose=False)
+            finally:
+                os.chdir(cwd)
+            return len(_CHART_RENDERERS)
+
+        stage_fns = {
+            'load_data': (load_data, 'rows/s'),
+            'get_amounts': (get_amounts, 'rows/s'),
+            'get_amounts_scalar': (get_amounts_scalar, 'calls/s'),
+            'backtest': (backtest, 'rows/s'),
+            'run_all_scenarios': (scenarios_stage, 'scenarios/s'),
+            'charts': (charts, 'charts/s'),
+        }
+
+        try:
+            if 'load_data' in stages:
+                write_kline_fixture(price_data, os.path.join(work_dir, 'klines'),
+                                    interval)
+            for stage in BENCHMARK_STAGES:
+                if stage not in stages:
+                    continue
+                fn, unit = stage_fns[stage]
+                seconds, units, peak_mb = _measure_stage(fn, repeats, memory)
+                row = {
+                    'stage': stage,
+                    'rows': n_rows,
+                    'seconds': seconds,
+                    'throughput': units / max(seconds, 1e-12),
+                    'unit': unit,
+                    'peak_mb': peak_mb,
+                }
+                results.append(row)
+                log(f"  {stage:<19} │ {n_rows:>9,} │ {seconds:9.4f}s │ "
+                    f"{row['throughput']:>13,.1f} {unit:<11} │ "
+                    + (f"{peak_mb:8.1f} MB" if peak_mb is not None else ""))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    log("─" * 75)
+
+    comparison = None
+    if baseline_path:
+        if update_baseline or not os.path.exists(baseline_path):
+            payload = {
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'environment': _benchmark_environment(),
+                'settings': {'interval': interval, 'engine': engine,
+                             'workers': workers, 'repeats': repeats,
+                             'chart_dpi': chart_dpi},
+                'results': results,
+            }
+            KlineCache._atomic_write(
+                baseline_path,
+                lambda f: f.write(json.dumps(payload, indent=2).encode())
+            )
+            log(f"   💾 baseline ذخیره شد: {baseline_path}")
+        else:
+            with open(baseline_path, encoding='utf-8') as f:
+                baseline = json.load(f)
+            comparison = compare_benchmark(results, baseline, tolerance)
+            for _, row in comparison.iterrows():
+                if row['ratio'] is None or pd.isna(row['ratio']):
+                    continue
+                log(f"  {row['stage']:<19} │ {row['rows']:>9,} │ "
+                    f"x{row['ratio']:5.2f} نسبت به baseline "
+                    f"{'⚠️ کندتر' if row['regression'] else '✅'}")
+            regressions = int(comparison['regression'].sum())
+            log(f"   {'⚠️' if regressions else '✅'} {regressions} مرحله "
+                f"کندتر از baseline (آستانه +{tolerance:.0%})")
+
+    return pd.DataFrame(results), comparison
+
+
+# ═══════════════════════════════════════════════════════════
+# بخش ۵-ج: ابزارگذاری مراحل خط لوله (زمان‌سنج + شمارنده، JSON / Prometheus)
+# ═══════════════════════════════════════════════════════════
+
+# پیشوند نام معیارها در خروجی Prometheus
+METRICS_PREFIX = 'pancakeswap'
+
+
+class _StageTimer:
+    """context manager زمان‌سنج یک مرحله (فقط وقتی ابزارگذاری فعال است)"""
+
+    __slots__ = ('metrics', 'stage', 'item', 'started')
+
+    def __init__(self, metrics, stage, item):
+        self.metrics = metrics
+        self.stage = stage
+        self.item = item
+
+    def __enter__(self):
+        self.started = time_module.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage,
+                             time_module.perf_counter() - self.started,
+                             self.item, failed=exc_type is not None)
+        return False
+
+
+class PipelineMetrics:
+    """
+    زمان‌سنج‌های هر مرحله + شمارنده‌های رویداد - thread-safe.
+
+    - stage(name, item=None): context manager؛ item برچسب اختیاری
+      (مثلاً بازه یا نام نمودار) که جداگانه هم جمع زده می‌شود
+    - observe(name, seconds, item): ثبت زمانی که جای دیگر اندازه گرفته شده
+      (مثلاً داخل پروسس worker)
+    - count(name, n): شمارنده (ردیف‌ها، ریبالانس‌ها، hit کش، retry، ...)
+    - drain() / merge(delta): انتقال ثبت‌های پروسس worker به والد؛ هر
+      worker در initializer از صفر شروع می‌کند، تغییرات هر task را
+      همراه نتیجه برمی‌گرداند (_worker_result) و والد آن را ادغام می‌کند
+
+    غیرفعال (پیش‌فرض) → stage یک context خالی مشترک برمی‌گرداند و
+    observe/count بلافاصله برمی‌گردند؛ هزینه فقط یک بررسی enabled است.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (stage, item) → [count, sum, min, max, failures]
+            self.timers = {}
+            self.counters = {}
+            self.started_at = time_module.time()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def stage(self, name, item=None):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageTimer(self, name, item)
+
+    def observe(self, name, seconds, item=None, failed=False):
+        if not self.enabled:
+            return
+        key = (name, None if item is None else str(item))
+        with self._lock:
+            entry = self.timers.get(key)
+            if entry is None:
+                self.timers[key] = [1, seconds, seconds, seconds, int(failed)]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = min(entry[2], seconds)
+                entry[3] = max(entry[3], seconds)
+                entry[4] += int(failed)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drain(self):
+        """ثبت‌های بعد از drain قبلی → delta (و پاک کردن)؛ غیرفعال → None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            delta = (self.timers, self.counters)
+            self.timers, self.counters = {}, {}
+        return delta
+
+    def merge(self, delta):
+        """ادغام delta حاصل از drain (مثلاً از پروسس worker)"""
+        if not self.enabled or not delta:
+            return
+        timers, counters = delta
+        with self._lock:
+            for key, (n, total, low, high, failed) in timers.items():
+                entry = self.timers.get(key)
+                if entry is None:
+                    self.timers[key] = [n, total, low, high, failed]
+                else:
+                    entry[0] += n
+                    entry[1] += total
+                    entry[2] = min(entry[2], low)
+                    entry[3] = max(entry[3], high)
+                    entry[4] += failed
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        خلاصه قابل JSON: زمان‌سنج‌ها بر حسب مرحله (جمع کل + تفکیک item)
+        و شمارنده‌ها
+        """
+        with self._lock:
+            timers = {k: list(v) for k, v in self.timers.items()}
+            counters = dict(self.counters)
+        stages = {}
+        for (name, item), (n, total, low, high, failed) in sorted(
+                timers.items(), key=lambda kv: (kv[0][0], kv[0][1] or '')):
+            stat = {'count': n, 'total_s': total, 'mean_s': total / n,
+                    'min_s': low, 'max_s': high, 'failures': failed}
+            stage = stages.setdefault(name, {'count': 0, 'total_s': 0.0,
+                                             'min_s': math.inf,
+                                             'max_s': 0.0, 'failures': 0,
+                                             'items': {}})
+            stage['count'] += n
+            stage['total_s'] += total
+            stage['min_s'] = min(stage['min_s'], low)
+            stage['max_s'] = max(stage['max_s'], high)
+            stage['failures'] += failed
+            if item is not None:
+                stage['items'][item] = stat
+        for stage in stages.values():
+            stage['mean_s'] = stage['total_s'] / stage['count']
+        return {
+            'started_at': self.started_at,
+            'elapsed_s': time_module.time() - self.started_at,
+            'stages': stages,
+            'counters': counters,
+        }
+
+    def to_json(self, path=None):
+        """خروجی JSON (path داده شود → نوشتن اتمیک در فایل)"""
+        text = json.dumps(self.snapshot(), indent=2, ensure_ascii=False,
+                          default=_to_builtin)
+        if path:
+            KlineCache._atomic_write(path, lambda f: f.write(text.encode()))
+        return text
+
+    def to_prometheus(self, path=None, prefix=METRICS_PREFIX):
+        """
+        خروجی متنی Prometheus (مناسب textfile collector در node_exporter):
+        <prefix>_stage_seconds_{sum,count,max}{stage,item}،
+        <prefix>_stage_failures_total و <prefix>_events_total{event}
+
+        هر سری یک (stage, item) است - بدون سری جمع کل، تا sum by (stage)
+        دوبار شمرده نشود.
+        """
+        with self._lock:
+            timers = sorted(self.timers.items(),
+                            key=lambda kv: (kv[0][0], kv[0][1] or ''))
+            counters = sorted(self.counters.items())
+
+        def labels(stage, item):
+            text = f'stage="{_prom_escape(stage)}"'
+            if item is not None:
+                text += f',item="{_prom_escape(item)}"'
+            return '{' + text + '}'
+
+        rows = [(labels(name, item),
+                 {'count': n, 'total_s': total, 'max_s': high,
+                  'failures': failed})
+                for (name, item), (n, total, _, high, failed) in timers]
+
+        lines = [f'# HELP {prefix}_stage_seconds Wall time per pipeline stage.',
+                 f'# TYPE {prefix}_stage_seconds summary']
+        for label, stat in rows:
+            lines.append(f'{prefix}_stage_seconds_sum{label} '
+                         f'{stat["total_s"]!r}')
+            lines.append(f'{prefix}_stage_seconds_count{label} '
+                         f'{stat["count"]}')
+        lines += [f'# HELP {prefix}_stage_seconds_max Slowest call per stage.',
+                  f'# TYPE {prefix}_stage_seconds_max gauge']
+        lines += [f'{prefix}_stage_seconds_max{label} {stat["max_s"]!r}'
+                  for label, stat in rows]
+        lines += [f'# HELP {prefix}_stage_failures_total Calls that raised.',
+                  f'# TYPE {prefix}_stage_failures_total counter']
+        lines += [f'{prefix}_stage_failures_total{label} {stat["failures"]}'
+                  for label, stat in rows]
+        lines += [f'# HELP {prefix}_events_total Pipeline event counters.',
+                  f'# TYPE {prefix}_events_total counter']
+        lines += [f'{prefix}_events_total{{event="{_prom_escape(name)}"}} '
+                  f'{value}'
+                  for name, value in counters]
+        lines += [f'# HELP {prefix}_run_seconds Wall time since reset.',
+                  f'# TYPE {prefix}_run_seconds gauge',
+                  f'{prefix}_run_seconds '
+                  f'{time_module.time() - self.started_at!r}']
+        text = '\n'.join(lines) + '\n'
+        if path:
+            KlineCache._atomic_write(path, lambda f: f.write(text.encode()))
+        return text
+
+
+def _prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# نمونه سراسری؛ با METRICS.enable() (یا سوئیچ --metrics-json/--metrics-prom)
+# روشن می‌شود
+METRICS = PipelineMetrics()
+
+
+def export_metrics(json_path=None, prom_path=None, metrics=None):
+    """نوشتن معیارها در فایل JSON و/یا Prometheus → لیست فایل‌ها"""
+    metrics = metrics or METRICS
+    files = []
+    if json_path:
+        metrics.to_json(json_path)
+        files.append(json_path)
+    if prom_path:
+        metrics.to_prometheus(prom_path)
+        files.append(prom_path)
+    return files
+
+
 # ═══════════════════════════════════════════════════════════
 # بخش ۶: تابع اصلی
 # ═══════════════════════════════════════════════════════════
 
 initial_capital = 10000
 
+RESULTS_CSV = 'pancakeswap_results_v3.csv'
+
+
+def compute_market_stats(price_data, initial_capital=10000):
+    """آمار بازار و معیار HODL (داده، نه متن فرمت‌شده)"""
+    close = price_data['close']
+    cake = price_data['cake_usdt']
+    bnb = price_data['bnb_usdt']
+
+    hodl_cake_amount = (initial_capital / 2) / cake.iloc[0]
+    hodl_bnb_amount = (initial_capital / 2) / bnb.iloc[0]
+    hodl_final = (hodl_cake_amount * cake.iloc[-1] +
+                  hodl_bnb_amount * bnb.iloc[-1])
+
+    per_day = infer_periods_per_day(price_data)
+    return {
+        'days': len(price_data) / per_day,
+        'price_change': ((close.iloc[-1] / close.iloc[0]) - 1) * 100,
+        'cake_change': ((cake.iloc[-1] / cake.iloc[0]) - 1) * 100,
+        'bnb_change': ((bnb.iloc[-1] / bnb.iloc[0]) - 1) * 100,
+        'volatility': close.pct_change().std() *
+                      np.sqrt(per_day * 365) * 100,
+        'hodl_cake_amount': hodl_cake_amount,
+        'hodl_bnb_amount': hodl_bnb_amount,
+        'hodl_final': hodl_final,
+        'hodl_return': ((hodl_final / initial_capital) - 1) * 100,
+    }
+
+
+def summarize_results(all_results):
+    """جدول عددی نتایج - یک ردیف برای هر بازه، بدون تاریخچه‌ها"""
+    skip = set(_HISTORY_KEYS) | {'rebalance_timestamps', 'segments'}
+    return pd.DataFrame([
+        {k: v for k, v in res.items() if k not in skip}
+        for _, res in sorted(all_results.items())
+    ])
+
+
+def write_results_csv(all_results, path=RESULTS_CSV):
+    """ذخیره جدول نتایج (فرمت‌شده برای خواندن) در CSV"""
+    rows = []
+    for r in sorted(all_results.keys()):
+        res = all_results[r]
+        costs = res['total_gas_costs'] + res['total_slippage_costs']
+        rows.append({
+            'Range': f'±{r}%',
+            'Days': f"{res['days']:.0f}",
+            'Active %': f"{res['active_percent']:.1f}%",
+            'Rebalances': res['rebalance_count'],
+            'Gross Fees ($)': f"${res['total_fees_gross']:,.0f}",
+            'Gas+Slippage ($)': f"${costs:,.0f}",
+            'Net Fees ($)': f"${res['total_fees_net']:,.0f}",
+            'Fee APR': f"{res['fee_apr']:.1f}%",
+            'IL (%)': f"{res['impermanent_loss']:.2f}%",
+            'Pool Value ($)': f"${res['final_pool_value']:,.0f}",
+            'Total Value ($)': f"${res['final_total_value']:,.0f}",
+            'HODL Value ($)': f"${res['final_hodl_value']:,.0f}",
+            'Total Return': f"{res['total_return']:+.2f}%",
+            'vs HODL': f"{res['vs_hodl']:+.2f}%"
+        })
+
+    with METRICS.stage('csv_write', os.path.basename(path)):
+        results_df = pd.DataFrame(rows)
+        results_df.to_csv(path, index=False, encoding='utf-8-sig')
+    return path
+
+
+def run_batch(target_days=365, scenarios=DEFAULT_SCENARIOS,
+              initial_capital=10000, engine='vectorized', workers=None,
+              verbose=False, charts=False, csv_path=None, price_data=None,
+              chart_kwargs=None, cache=None, **data_kwargs):
+    """
+    اجرای بدون رابط (برای job های زمان‌بندی‌شده).
+
+    همان مسیر main() (get_pancakeswap_pair_data → run_all_scenarios)
+    ولی بدون جدول‌ها، کادر نتیجه و نمودار، مگر با سوئیچ‌ها:
+        verbose  → چاپ گزارش دانلود و جدول بک‌تست
+        charts   → ساخت نمودارها (در غیر این صورت metrics_only)
+        csv_path → ذخیره CSV نتایج
+
+    data_kwargs['gap_policy'] = 'split' → هر بخش پیوسته جدا بک‌تست
+    می‌شود (run_backtest_segmented)؛ با charts سازگار نیست.
+
+    price_data: داده آماده (بدون دانلود)؛ data_kwargs به
+    get_pancakeswap_pair_data می‌رود (cache_dir، offline، ...)
+    cache: BacktestCache - نتایج با برچسب (نمادها، interval، روز) ثبت
+    می‌شوند، پس بعد از دریافت کندل‌های جدید نتایج قبلی حذف می‌شوند
+
+    Returns: dict با price_data، market، results، summary (DataFrame عددی)،
+             best_range، best و files
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    dataset = None
+    if price_data is None:
+        price_data = get_pancakeswap_pair_data(
+            target_days=target_days, verbose=verbose, **data_kwargs
+        )
+        dataset = (f"CAKEUSDT/BNBUSDT@{data_kwargs.get('interval', '1h')}"
+                   f"/{target_days}d")
+
+    all_results = run_all_scenarios(
+        price_data, scenarios, initial_capital, engine=engine,
+        workers=workers, metrics_only=not charts, cache=cache,
+        dataset=dataset, verbose=verbose
+    )
+    summary = summarize_results(all_results)
+    best_range = max(all_results, key=lambda r: all_results[r]['total_return'])
+
+    files = []
+    if csv_path:
+        files.append(write_results_csv(all_results, csv_path))
+    if charts:
+        create_all_charts(all_results, price_data, initial_capital,
+                          verbose=verbose, **(chart_kwargs or {}))
+
+    return {
+        'price_data': price_data,
+        'market': compute_market_stats(price_data, initial_capital),
+        'results': all_results,
+        'summary': summary,
+        'best_range': best_range,
+        'best': all_results[best_range],
+        'files': files,
+    }
+
 
 def main():
     global initial_capital
@@ -1066,10 +6084,15 @@ def main():
 
     INITIAL_CAPITAL = initial_capital
     FEE_TIER = 0.25
-    SCENARIOS = [2, 3, 4, 5, 7, 10, 15, 20, 25, 30, 40, 50]
+    SCENARIOS = DEFAULT_SCENARIOS
     GAS_COST = 0.30
     SLIPPAGE = 0.1
     TARGET_DAYS = 365
+    INTERVAL = '1h'
+    ENGINE = 'vectorized'
+    WORKERS = os.cpu_count() or 1
+    CHARTS = True
+    REFINE_OPTIMUM = True
 
     print(f"\n⚙️ Settings:")
     print(f"   • DEX: PancakeSwap V3")
@@ -1079,8 +6102,9 @@ def main():
     print(f"   • Fee Tier: {FEE_TIER}%")
     print(f"   • Gas Cost: ${GAS_COST}/rebalance")
     print(f"   • Slippage: {SLIPPAGE}% on swapped portion")
-    print(f"   • Target Period: {TARGET_DAYS} days")
+    print(f"   • Target Period: {TARGET_DAYS} days ({INTERVAL} candles)")
     print(f"   • Ranges: {SCENARIOS}")
+    print(f"   • Engine: {ENGINE} ({WORKERS} workers)")
     print(f"\n   🔄 Rebalance Strategy:")
     print(f"      When price exits range:")
     print(f"      1. Calculate current USD value")
@@ -1093,45 +6117,35 @@ def main():
     print("\n" + "─" * 65)
     print("📥 Step 1: Fetching 1 Year CAKE/BNB Data")
     print("─" * 65)
-    price_data = get_pancakeswap_pair_data(target_days=TARGET_DAYS)
+    price_data = get_pancakeswap_pair_data(target_days=TARGET_DAYS,
+                                           interval=INTERVAL)
 
     # آمار
-    days = len(price_data) / 24
-    price_change = (
-        (price_data['close'].iloc[-1] / price_data['close'].iloc[0]) - 1
-    ) * 100
-    volatility = price_data['close'].pct_change().std() * \
-                 np.sqrt(24 * 365) * 100
-    cake_change = (
-        (price_data['cake_usdt'].iloc[-1] / price_data['cake_usdt'].iloc[0]) - 1
-    ) * 100
-    bnb_change = (
-        (price_data['bnb_usdt'].iloc[-1] / price_data['bnb_usdt'].iloc[0]) - 1
-    ) * 100
+    stats = compute_market_stats(price_data, INITIAL_CAPITAL)
+    days = stats['days']
 
     print(f"\n📊 Market Stats ({days:.0f} days):")
-    print(f"   • CAKE/BNB Change: {price_change:+.2f}%")
-    print(f"   • CAKE/USD Change: {cake_change:+.2f}%")
-    print(f"   • BNB/USD Change:  {bnb_change:+.2f}%")
-    print(f"   • Volatility (Annual): {volatility:.1f}%")
-
-    hodl_cake_amt = (INITIAL_CAPITAL / 2) / price_data['cake_usdt'].iloc[0]
-    hodl_bnb_amt = (INITIAL_CAPITAL / 2) / price_data['bnb_usdt'].iloc[0]
-    hodl_final = (hodl_cake_amt * price_data['cake_usdt'].iloc[-1] +
-                  hodl_bnb_amt * price_data['bnb_usdt'].iloc[-1])
+    print(f"   • CAKE/BNB Change: {stats['price_change']:+.2f}%")
+    print(f"   • CAKE/USD Change: {stats['cake_change']:+.2f}%")
+    print(f"   • BNB/USD Change:  {stats['bnb_change']:+.2f}%")
+    print(f"   • Volatility (Annual): {stats['volatility']:.1f}%")
+
     print(f"\n💰 HODL Benchmark:")
-    print(f"   • CAKE bought: {hodl_cake_amt:.2f} @ "
+    print(f"   • CAKE bought: {stats['hodl_cake_amount']:.2f} @ "
           f"${price_data['cake_usdt'].iloc[0]:.2f}")
-    print(f"   • BNB bought:  {hodl_bnb_amt:.4f} @ "
+    print(f"   • BNB bought:  {stats['hodl_bnb_amount']:.4f} @ "
           f"${price_data['bnb_usdt'].iloc[0]:.2f}")
-    print(f"   • Final HODL: ${hodl_final:,.2f} "
-          f"({((hodl_final / INITIAL_CAPITAL) - 1) * 100:+.2f}%)")
+    print(f"   • Final HODL: ${stats['hodl_final']:,.2f} "
+          f"({stats['hodl_return']:+.2f}%)")
 
     # بک‌تست
     print("\n" + "─" * 65)
     print("🔬 Step 2: Running Backtest")
     print("─" * 65)
-    all_results = run_all_scenarios(price_data, SCENARIOS, INITIAL_CAPITAL)
+    # بدون نمودار، تاریخچه‌ها لازم نیست → مسیر سریع metrics_only
+    all_results = run_all_scenarios(price_data, SCENARIOS, INITIAL_CAPITAL,
+                                    engine=ENGINE, workers=WORKERS,
+                                    metrics_only=not CHARTS)
 
     # نتایج
     print("\n" + "─" * 65)
@@ -1139,37 +6153,27 @@ def main():
     print("─" * 65)
     sorted_results = print_results(all_results)
 
+    # جستجوی دقیق‌تر حول بهترین بازه شبکه ۱۲ نقطه‌ای
+    refined = None
+    if REFINE_OPTIMUM:
+        print("\n🔍 جستجوی تطبیقی بهترین بازه (golden-section):")
+        refined = optimize_range_width(
+            price_data, coarse=SCENARIOS, initial_capital=INITIAL_CAPITAL,
+            seed_results=all_results,
+            seed_params={'initial_capital': INITIAL_CAPITAL}, engine=ENGINE
+        )['objectives']['total_return']
+
     # نمودارها
     print("\n" + "─" * 65)
     print("📈 Step 4: Charts")
     print("─" * 65)
-    top3 = create_all_charts(all_results, price_data, INITIAL_CAPITAL)
+    if CHARTS:
+        top3 = create_all_charts(all_results, price_data, INITIAL_CAPITAL)
+    else:
+        print("   ⏭️ نمودارها غیرفعال است")
 
     # CSV
-    rows = []
-    for r in sorted(all_results.keys()):
-        res = all_results[r]
-        costs = res['total_gas_costs'] + res['total_slippage_costs']
-        rows.append({
-            'Range': f'±{r}%',
-            'Days': f"{res['days']:.0f}",
-            'Active %': f"{res['active_percent']:.1f}%",
-            'Rebalances': res['rebalance_count'],
-            'Gross Fees ($)': f"${res['total_fees_gross']:,.0f}",
-            'Gas+Slippage ($)': f"${costs:,.0f}",
-            'Net Fees ($)': f"${res['total_fees_net']:,.0f}",
-            'Fee APR': f"{res['fee_apr']:.1f}%",
-            'IL (%)': f"{res['impermanent_loss']:.2f}%",
-            'Pool Value ($)': f"${res['final_pool_value']:,.0f}",
-            'Total Value ($)': f"${res['final_total_value']:,.0f}",
-            'HODL Value ($)': f"${res['final_hodl_value']:,.0f}",
-            'Total Return': f"{res['total_return']:+.2f}%",
-            'vs HODL': f"{res['vs_hodl']:+.2f}%"
-        })
-
-    results_df = pd.DataFrame(rows)
-    results_df.to_csv('pancakeswap_results_v3.csv',
-                      index=False, encoding='utf-8-sig')
+    write_results_csv(all_results, RESULTS_CSV)
     print(f"\n💾 CSV saved: pancakeswap_results_v3.csv")
 
     # نتیجه
@@ -1209,9 +6213,97 @@ def main():
        • pancakeswap_results_v3.csv
     """)
 
+    if refined is not None:
+        print(f"    🔍 Refined optimum: ±{refined['range_percent']:.2f}% → "
+              f"{refined['value']:+.2f}% "
+              f"(grid best ±{best[0]}% → {best[1]['total_return']:+.2f}%)\n")
+
     print("✅ Analysis Complete!")
     return all_results, price_data
 
 
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='PancakeSwap V3 CAKE/BNB range optimizer'
+    )
+    parser.add_argument('--batch', action='store_true',
+                        help='headless run (no tables/box/charts by default)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='batch: print download/backtest progress')
+    parser.add_argument('--charts', action='store_true',
+                        help='batch: render the charts')
+    parser.add_argument('--csv', metavar='PATH', default=None,
+                        help='batch: write the results CSV to PATH')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--interval', default='1h', choices=sorted(INTERVAL_MS),
+                        help='batch: candle interval (1m ... 1d)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--offline', action='store_true',
+                        help='use only the local kline cache')
+    parser.add_argument('--gap-policy', default='drop', choices=GAP_POLICIES,
+                        help='batch: how candles missing on one leg are '
+                             'handled; split backtests each gap-free '
+                             'segment separately (no --charts)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='run the stage benchmark suite on synthetic '
+                             'data (no network) and compare with the '
+                             'JSON baseline')
+    parser.add_argument('--bench-rows', default='8760',
+                        help='benchmark: comma-separated series lengths')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='benchmark: overwrite the baseline file')
+    parser.add_argument('--pairs', default=None,
+                        help='batch: comma-separated pools, e.g. '
+                             'CAKE/BNB@0.25,ETH/BNB@0.05,BNB/USDT@0.01')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='batch: reuse backtest results from '
+                             f'{BACKTEST_CACHE_DIR}/ while the data is '
+                             'unchanged')
+    parser.add_argument('--metrics-json', metavar='PATH', default=None,
+                        help='record per-stage timers and counters and '
+                             'write them to PATH as JSON')
+    parser.add_argument('--metrics-prom', metavar='PATH', default=None,
+                        help='same, in Prometheus text format (e.g. for the '
+                             'node_exporter textfile collector)')
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    results, data = main()
\ No newline at end of file
+    args = _parse_args()
+    if args.metrics_json or args.metrics_prom:
+        METRICS.enable()
+    try:
+        if args.benchmark:
+            bench, comparison = run_benchmark_suite(
+                sizes=[int(n) for n in args.bench_rows.split(',')],
+                interval=args.interval, workers=args.workers or 1,
+                update_baseline=args.update_baseline
+            )
+            print(bench.to_json(orient='records'))
+        elif args.batch and args.pairs:
+            reports, overview = run_multi_pair_batch(
+                args.pairs.split(','), target_days=args.days,
+                workers=args.workers, verbose=args.verbose,
+                offline=args.offline, interval=args.interval,
+                gap_policy=args.gap_policy
+            )
+            print(overview.to_json(orient='records'))
+        elif args.batch:
+            batch = run_batch(target_days=args.days, workers=args.workers,
+                              verbose=args.verbose, charts=args.charts,
+                              csv_path=args.csv, offline=args.offline,
+                              interval=args.interval,
+                              gap_policy=args.gap_policy,
+                              cache=BacktestCache() if args.result_cache
+                              else None)
+            print(json.dumps({
+                'best_range': batch['best_range'],
+                'total_return': batch['best']['total_return'],
+                'rebalance_count': batch['best']['rebalance_count'],
+                'days': batch['market']['days'],
+            }))
+        else:
+            results, data = main()
+    finally:
+        # حتی اگر اجرا شکست بخورد، معیارها (و failures) نوشته می‌شوند
+        export_metrics(args.metrics_json, args.metrics_prom)
@@ -0,0 +1,940 @@
+"""
+تست‌های main.py روی داده مصنوعی و stub ها (بدون شبکه)، بخش به بخش.
+
+هم‌ارزی موتورها: loop (مرجع) == vectorized == kernel == streaming ==
+chunked == BacktestWindowIndex.query؛ موتورهای دسته‌ای بیت به بیت، مسیرهای
+افزایشی و ایندکس با خطای نسبی ناچیز (ترتیب جمع کارمزدها فرق دارد).
+
+اجرا: python -m pytest -q
+"""
+
+import json
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main as m
+
+WIDTHS = [0.7, 2, 3.5, 10, 50]
+
+# معیارهای شمارشی باید دقیقاً برابر باشند؛ بقیه با rel_tol
+COUNT_KEYS = ('rebalance_count', 'periods_in_range', 'periods_out_of_range')
+REL_TOL = 1e-9
+
+
+@pytest.fixture(scope='module')
+def price_data():
+    return m.generate_synthetic_pair_data(2000, seed=7)
+
+
+def assert_metrics_close(actual, expected, rel=REL_TOL):
+    for key in COUNT_KEYS:
+        assert actual[key] == expected[key], key
+    for key, value in expected.items():
+        if key in COUNT_KEYS or not isinstance(value, (int, float)):
+            continue
+        assert actual[key] == pytest.approx(value, rel=rel, abs=1e-9), key
+
+
+# ─── هم‌ارزی موتورهای بک‌تست ───
+
+@pytest.mark.parametrize('range_percent', WIDTHS)
+def test_vectorized_matches_loop(price_data, range_percent):
+    loop = m.run_backtest_with_rebalance(price_data, range_percent,
+                                         engine='loop')
+    vectorized = m.run_backtest_with_rebalance(price_data, range_percent,
+                                               engine='vectorized')
+    for key, value in loop.items():
+        if isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(vectorized[key], value, key)
+        elif key == 'range_history':
+            np.testing.assert_array_equal(vectorized[key].starts,
+                                          value.starts)
+        else:
+            assert vectorized[key] == value, key
+
+
+def test_kernel_matches_vectorized(price_data):
+    kernel = m.backtest_all_widths(price_data, WIDTHS)
+    for range_percent, result in zip(WIDTHS, kernel):
+        expected = m.run_backtest_with_rebalance(price_data, range_percent,
+                                                 engine='vectorized')
+        assert result['rebalance_timestamps'] == \
+            expected['rebalance_timestamps']
+        for key in ('fee_history', 'pool_value_history',
+                    'total_value_history'):
+            np.testing.assert_array_equal(result[key], expected[key], key)
+        for key in ('total_return', 'total_fees_gross', 'final_pool_value',
+                    'total_gas_costs', 'total_slippage_costs') + COUNT_KEYS:
+            assert result[key] == expected[key], key
+
+
+def test_kernel_small_blocks_and_scalar_tail(price_data):
+    # بلوک‌های کوچک (حمل کارمزد بین بلوک‌ها) و هر دو مسیر ریبالانس
+    expected = m.backtest_all_widths(price_data, WIDTHS, metrics_only=True)
+    for scalar_widths in (0, len(WIDTHS)):
+        result = m.backtest_all_widths(price_data, WIDTHS, metrics_only=True,
+                                       block_rows=37,
+                                       scalar_widths=scalar_widths)
+        assert result == expected
+
+
+@pytest.mark.parametrize('engine,workers', [('vectorized', 2),
+                                            ('kernel', 1), ('kernel', 2)])
+def test_run_all_scenarios_engines(price_data, engine, workers):
+    expected = m.run_all_scenarios(price_data, WIDTHS, engine='loop',
+                                   metrics_only=True, verbose=False)
+    result = m.run_all_scenarios(price_data, WIDTHS, engine=engine,
+                                 workers=workers, metrics_only=True,
+                                 verbose=False)
+    assert result == expected
+
+
+@pytest.mark.parametrize('range_percent', [2, 10])
+def test_streaming_matches_batch(price_data, range_percent):
+    expected = m.run_backtest_with_rebalance(price_data, range_percent,
+                                             engine='vectorized',
+                                             metrics_only=True)
+    block = m.StreamingBacktest.from_history(price_data, range_percent)
+    assert_metrics_close(block.metrics(), expected)
+
+    # نیمه اول بلوکی، snapshot/restore، نیمه دوم کندل به کندل
+    half = len(price_data) // 2
+    stream = m.StreamingBacktest.from_history(
+        price_data.iloc[:half], range_percent,
+        avg_volume=price_data['quote_volume'].mean()
+    )
+    restored = m.StreamingBacktest.restore(stream.snapshot())
+    restored.update_many(price_data.iloc[half:])
+    assert_metrics_close(restored.metrics(), expected)
+
+
+@pytest.mark.parametrize('chunk_rows', [173, 1000])
+def test_chunked_matches_batch(price_data, chunk_rows):
+    expected = m.run_backtest_with_rebalance(price_data, 3.5,
+                                             engine='vectorized',
+                                             metrics_only=True)
+    result = m.run_backtest_chunked(price_data, 3.5, chunk_rows=chunk_rows)
+    assert_metrics_close(result, expected)
+
+
+@pytest.mark.parametrize('range_percent,gas_cost_usd',
+                         [(2, 0.3), (10, 0.3), (30, 0.3), (2, 400)])
+def test_window_index_matches_sliced_backtest(price_data, range_percent,
+                                              gas_cost_usd):
+    # ±30%: زمان‌بندی پنجره‌ها تقریباً هیچ‌وقت با کل سری هم‌تراز نیست؛
+    # gas=400: سرمایه وسط پنجره صفر می‌شود
+    index = m.BacktestWindowIndex(price_data, range_percent,
+                                  gas_cost_usd=gas_cost_usd)
+    timestamps = price_data['timestamp']
+    rng = np.random.default_rng(3)
+    for _ in range(10):
+        lo, hi = sorted(rng.integers(0, len(price_data), 2))
+        if hi - lo < 30:
+            continue
+        sliced = price_data.iloc[lo:hi + 1].reset_index(drop=True)
+        expected = m.run_backtest_with_rebalance(sliced, range_percent,
+                                                 gas_cost_usd=gas_cost_usd,
+                                                 engine='vectorized',
+                                                 metrics_only=True)
+        result = index.query(timestamps.iloc[lo], timestamps.iloc[hi],
+                             10000)
+        for key in ('rebalance_count', 'periods_in_range'):
+            assert result[key] == expected[key], key
+        for key in ('total_return', 'total_fees_gross', 'final_pool_value',
+                    'vs_hodl', 'total_gas_costs', 'total_slippage_costs'):
+            assert result[key] == pytest.approx(expected[key], rel=1e-9,
+                                                abs=1e-9), key
+
+
+
+def test_walk_forward_index_matches_vectorized(price_data):
+    kwargs = dict(scenarios=[2, 5, 15], train_days=20, test_days=10,
+                  workers=1, verbose=False, gas_cost_usd=0.5)
+    expected = m.run_walk_forward(price_data, engine='vectorized', **kwargs)
+    result = m.run_walk_forward(price_data, **kwargs)
+    assert len(result) == len(expected) > 1
+    for column in ('chosen_range', 'test_best_range', 'test_rebalances',
+                   'test_start'):
+        assert list(result[column]) == list(expected[column]), column
+    for column in ('train_return', 'test_return', 'test_vs_hodl'):
+        np.testing.assert_allclose(result[column], expected[column],
+                                   rtol=1e-9, atol=1e-9)
+
+
+# ─── جستجوی شبکه‌ای و جبهه پارتو ───
+
+def test_fractional_widths_in_scenario_table(price_data, capsys):
+    # مسیر چاپ جدول‌ها (±{:2g}%) با بازه اعشاری
+    results = m.run_all_scenarios(price_data, [2.5, 7], engine='kernel',
+                                  metrics_only=True, verbose=True)
+    assert list(results) == [2.5, 7]
+    m.print_results(results)
+    assert '±2.5%' in capsys.readouterr().out
+
+
+def test_pareto_front_keeps_only_non_dominated():
+    df = pd.DataFrame({
+        'rebalance_count': [1, 1, 2, 3, 3, 4, 5, 5],
+        'total_return': [2.0, 1.0, 1.5, 4.0, 3.0, 4.0, 6.0, 6.0],
+    })
+    front = m.pareto_front(df)
+    assert front[['rebalance_count', 'total_return']].values.tolist() == [
+        [1, 2.0], [3, 4.0], [5, 6.0]]
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'rebalance_count': rng.integers(0, 30, 200),
+                       'total_return': rng.normal(size=200).round(1)})
+    front = m.pareto_front(df)
+    assert front['rebalance_count'].is_unique
+    for _, row in df.iterrows():
+        dominated_or_equal = (
+            (front['rebalance_count'] <= row['rebalance_count']) &
+            (front['total_return'] >= row['total_return'])
+        )
+        assert dominated_or_equal.any()
+    for _, row in front.iterrows():
+        strictly_better = (
+            (df['rebalance_count'] <= row['rebalance_count']) &
+            (df['total_return'] > row['total_return'])
+        )
+        assert not strictly_better.any()
+
+
+def test_grid_search_fractional_widths(price_data, tmp_path, capsys):
+    grid = m.build_parameter_grid([0.5, 2.5, 7.25], fee_tiers=(0.05, 0.25),
+                                  gas_costs=(0.3, 1.0), slippages=(0.1,))
+    output_path = tmp_path / 'grid.csv'
+    results, front = m.run_grid_search(price_data, grid, workers=1,
+                                       output_path=str(output_path))
+    assert f'{len(front)} نقطه' in capsys.readouterr().out
+
+    columns = m.GRID_PARAM_COLUMNS
+    assert [tuple(row) for row in results[columns].values] == grid
+    written = pd.read_csv(output_path)
+    assert len(written) == len(grid)
+    pd.testing.assert_frame_equal(
+        written.sort_values(columns).reset_index(drop=True),
+        results.sort_values(columns).reset_index(drop=True),
+        check_dtype=False
+    )
+    assert set(map(tuple, front[columns].values)) <= set(grid)
+
+    independent, _ = m.run_grid_search(price_data, grid, workers=1,
+                                       output_path=str(output_path),
+                                       share_paths=False, verbose=False)
+    pd.testing.assert_frame_equal(independent, results)
+    expected = m.run_backtest_with_rebalance(
+        price_data, 7.25, fee_tier=0.05, gas_cost_usd=1.0,
+        engine='vectorized', metrics_only=True)
+    row = results.iloc[grid.index((7.25, 0.05, 1.0, 0.1))]
+    assert row['total_return'] == expected['total_return']
+
+
+def test_cost_sweep_default_widths(price_data):
+    sweep = m.run_cost_sweep(price_data, workers=1, verbose=False)
+    assert isinstance(sweep, pd.DataFrame)
+    assert list(sweep['range_percent']) == list(m.DEFAULT_SCENARIOS)
+
+
+# ─── جستجوی تطبیقی بازه ───
+
+def _peaked_at(optimum):
+    """هدف تک‌قله‌ای با بیشینه معلوم (روی range_percent همان بک‌تست)"""
+    def objective(metrics):
+        return -(metrics['range_percent'] - optimum) ** 2
+    return objective
+
+
+def test_optimize_range_width_converges(price_data):
+    report = m.optimize_range_width(price_data, [_peaked_at(7.3)], tol=0.01,
+                                    verbose=False)
+    (best,) = report['objectives'].values()
+    assert best['range_percent'] == pytest.approx(7.3, abs=0.01)
+    assert best['bracket'][0] <= 7.3 <= best['bracket'][1]
+    # ۱۲ نقطه درشت + golden-section، نه یک جستجوی کامل
+    assert best['evaluations'] == report['backtests'] < 40
+
+
+def test_optimize_range_width_counts_seeds_separately(price_data):
+    coarse = [1, 2, 4, 8, 16, 32]
+    seeds = m.run_all_scenarios(price_data, coarse, metrics_only=True,
+                                verbose=False)
+    objective = m.RangeObjective(price_data)
+    report = m.optimize_range_width(
+        price_data, ['total_return', _peaked_at(5.5)], coarse=coarse,
+        seed_results=seeds, range_objective=objective, verbose=False)
+    assert report['seeded'] == objective.seeded == len(coarse)
+    assert report['backtests'] == objective.evaluations == \
+        len(objective.cache) - len(coarse)
+    per_objective = [r['evaluations'] for r in report['objectives'].values()]
+    assert sum(per_objective) == report['backtests']
+
+    # seed دوباره همان نقاط → شمارش تغییر نمی‌کند
+    objective.seed(seeds)
+    assert objective.seeded == len(coarse)
+    assert objective.metrics(8) is seeds[8]
+
+
+def test_optimize_range_width_rejects_mismatched_seeds(price_data):
+    seeds = m.run_all_scenarios(price_data, [2, 8], initial_capital=5000,
+                                metrics_only=True, verbose=False)
+    with pytest.raises(ValueError, match='seed'):
+        m.optimize_range_width(price_data, coarse=[2, 8], seed_results=seeds,
+                               seed_params={'initial_capital': 5000},
+                               verbose=False)
+    with pytest.raises(ValueError, match='seed'):
+        m.optimize_range_width(price_data, coarse=[2, 8], seed_results=seeds,
+                               seed_params={'initial_capital': 5000},
+                               gas_cost_usd=1.0, initial_capital=5000,
+                               verbose=False)
+    report = m.optimize_range_width(price_data, coarse=[2, 8], tol=1,
+                                    seed_results=seeds,
+                                    seed_params={'initial_capital': 5000},
+                                    initial_capital=5000, verbose=False)
+    assert report['seeded'] == 2
+
+
+# ─── چند استخر ───
+
+def test_pool_pair_parse():
+    pair = m.PoolPair.parse(' cake/bnb@0.05 ')
+    assert (pair.key, pair.symbols) == ('CAKE/BNB@0.05',
+                                        ('CAKEUSDT', 'BNBUSDT'))
+    assert m.PoolPair.parse('BNB/USDT').symbols == ('BNBUSDT',)
+    for text in ('CAKE', 'A/B/C', 'CAKE/', '/BNB', 'CAKE/BNB@x',
+                 'CAKE/BNB@-1', 'CAKE/cake', 'CAKE BNB/ETH'):
+        with pytest.raises(ValueError, match='❌'):
+            m.PoolPair.parse(text)
+
+
+def _synthetic_legs(symbols, n_rows=24 * 20):
+    hour = 3_600_000
+    t0 = 1_700_000_000_000 // hour * hour
+    rng = np.random.default_rng(1)
+    legs = {}
+    for symbol in symbols:
+        arr = np.zeros(n_rows, dtype=m.KLINE_DTYPE)
+        arr['timestamp'] = t0 + np.arange(n_rows) * hour
+        arr['close'] = np.exp(np.cumsum(rng.normal(0, 0.01, n_rows)))
+        arr['high'] = arr['close'] * 1.001
+        arr['low'] = arr['close'] * 0.999
+        arr['quote_volume'] = rng.lognormal(15, 0.3, n_rows)
+        legs[symbol] = arr
+    return legs
+
+
+def test_shared_legs_downloaded_once(monkeypatch):
+    calls = []
+
+    def fake_fetch(symbols, target_days, interval='1h', **kwargs):
+        calls.append(list(symbols))
+        return _synthetic_legs(symbols)
+
+    monkeypatch.setattr(m, '_fetch_leg_klines', fake_fetch)
+    pairs = ['CAKE/BNB@0.25', 'ETH/BNB@0.05', 'BNB/USDT@0.01', 'CAKE/BNB@1']
+    pair_data = m.load_pairs_data(pairs, target_days=10, verbose=False)
+    assert calls == [['CAKEUSDT', 'BNBUSDT', 'ETHUSDT']]
+    assert list(pair_data) == ['CAKE/BNB@0.25', 'ETH/BNB@0.05',
+                               'BNB/USDT@0.01', 'CAKE/BNB@1']
+    assert (pair_data['BNB/USDT@0.01']['bnb_usdt'] == 1.0).all()
+
+    reports, overview = m.run_multi_pair_batch(pairs, scenarios=[2, 5],
+                                               target_days=10, workers=1,
+                                               verbose=False)
+    assert len(calls) == 2 and calls[1] == calls[0]
+    assert list(overview['pair']) == ['CAKE/BNB', 'ETH/BNB', 'BNB/USDT',
+                                      'CAKE/BNB']
+    for pair_key, report in reports.items():
+        pair = report['pair']
+        for range_pct in (2, 5):
+            expected = m.run_backtest_with_rebalance(
+                pair_data[pair_key], range_pct, fee_tier=pair.fee_tier,
+                engine='vectorized', metrics_only=True)
+            assert report['results'][range_pct] == expected
+        assert report['best_range'] == max(
+            (2, 5), key=lambda r: report['results'][r]['total_return'])
+
+# ─── دانلود کندل‌ها ───
+
+class _StubResponse:
+    def __init__(self, status_code, payload=()):
+        self.status_code = status_code
+        self.headers = {}
+        self._payload = list(payload)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise m.requests.HTTPError(f'{self.status_code}', response=self)
+
+    def json(self):
+        return self._payload
+
+
+class _StubSession:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        return _StubResponse(self.statuses.pop(0), [[0] * 12])
+
+
+def _fetch_batch(session, **kwargs):
+    return m._fetch_klines_batch(session, 'stub', 'CAKEUSDT', '1h', (0, 1),
+                                 m.TokenBucket(1000), backoff=0,
+                                 log=m._silent, **kwargs)
+
+
+def test_fetch_batch_does_not_retry_client_errors():
+    session = _StubSession(400, 200)
+    with pytest.raises(m.requests.HTTPError):
+        _fetch_batch(session)
+    assert session.calls == 1
+
+
+def test_fetch_batch_retries_server_errors(capsys):
+    session = _StubSession(503, 502, 200)
+    assert _fetch_batch(session) == [[0] * 12]
+    assert session.calls == 3
+    with pytest.raises(m.requests.HTTPError):
+        _fetch_batch(_StubSession(500, 500), max_retries=1)
+    assert capsys.readouterr().out == ''
+
+
+
+class _StubExchange:
+    """جایگزین _download_windows: کندل‌های ساعتی یک نماد از یک آرایه"""
+
+    def __init__(self, timestamps):
+        self.rows = np.zeros(len(timestamps), dtype=m.KLINE_DTYPE)
+        self.rows['timestamp'] = timestamps
+        self.rows['close'] = 1.0
+        self.requested = []
+
+    def __call__(self, windows_by_symbol, interval='1h', **kwargs):
+        self.requested.append(windows_by_symbol)
+        out = {}
+        for symbol, windows in windows_by_symbol.items():
+            ts = self.rows['timestamp']
+            mask = np.zeros(len(ts), dtype=bool)
+            for lo, hi in windows:
+                mask |= (ts >= lo) & (ts <= hi)
+            out[symbol] = self.rows[mask]
+        return out
+
+
+def test_kline_cache_top_up_and_known_gaps(tmp_path, monkeypatch):
+    hour = 3_600_000
+    t0 = 1_700_000_000_000 // hour * hour
+    # لیست شدن در ساعت ۵، توقف صرافی ۴۰..۴۴، ساعت‌های ۹۷+ هنوز نیامده‌اند
+    listed = np.setdiff1d(np.arange(5, 97), np.arange(40, 45))
+    exchange = _StubExchange(t0 + listed * hour)
+    monkeypatch.setattr(m, '_download_windows', exchange)
+    cache = m.KlineCache(str(tmp_path))
+
+    def load(last_hour):
+        return m.load_klines_cached(['CAKEUSDT'], '1h', t0,
+                                    t0 + (last_hour + 1) * hour + 1,
+                                    cache_dir=str(tmp_path), verbose=False)
+
+    rows = load(99)['CAKEUSDT']
+    assert exchange.requested == [{'CAKEUSDT': [(t0, t0 + 99 * hour)]}]
+    np.testing.assert_array_equal(rows['timestamp'], t0 + listed * hour)
+    assert len(cache.load('CAKEUSDT', '1h')) == len(listed)
+    # قبل از لیست شدن و توقف صرافی ثبت می‌شوند، انتهای عقب‌افتاده نه
+    assert cache.known_gaps('CAKEUSDT', '1h') == [
+        (t0, t0 + 4 * hour), (t0 + 40 * hour, t0 + 44 * hour)]
+    assert cache.missing_ranges('CAKEUSDT', '1h', t0, t0 + 99 * hour) == [
+        (t0 + 97 * hour, t0 + 99 * hour)]
+
+    # top-up: فقط انتها دوباره درخواست می‌شود
+    exchange.rows = np.concatenate([exchange.rows,
+                                    _StubExchange(t0 + np.arange(97, 110) *
+                                                  hour).rows])
+    exchange.requested.clear()
+    rows = load(109)['CAKEUSDT']
+    assert exchange.requested == [{'CAKEUSDT': [(t0 + 97 * hour,
+                                                 t0 + 109 * hour)]}]
+    assert len(rows) == len(listed) + 13
+    assert cache.known_gaps('CAKEUSDT', '1h') == [
+        (t0, t0 + 4 * hour), (t0 + 40 * hour, t0 + 44 * hour)]
+
+    # بدون کمبود → بدون درخواست
+    exchange.requested.clear()
+    load(109)
+    assert exchange.requested == []
+
+# ─── هم‌ترازی دو leg ───
+
+def test_non_overlapping_legs_raise():
+    hour = 3600000
+
+    def leg(start, n):
+        arr = np.zeros(n, dtype=m.KLINE_DTYPE)
+        arr['timestamp'] = start + np.arange(n) * hour
+        arr['close'] = arr['high'] = arr['low'] = 1.0
+        return arr
+
+    with pytest.raises(ValueError, match='همپوشانی'):
+        m._build_pair_frame(leg(0, 10), leg(100 * hour, 10), 1,
+                            verbose=False)
+
+
+def _leg_with_holes(n, holes, start=0, price=1.0):
+    hour = 3600000
+    keep = np.setdiff1d(np.arange(n), holes)
+    arr = np.zeros(len(keep), dtype=m.KLINE_DTYPE)
+    arr['timestamp'] = start + keep * hour
+    arr['close'] = price + keep
+    arr['high'] = arr['close'] + 0.5
+    arr['low'] = arr['close'] - 0.5
+    arr['quote_volume'] = 100.0
+    return arr
+
+
+def test_align_ffill_fills_with_last_close():
+    out, gaps = m.align_pair_legs(_leg_with_holes(10, [3, 4]),
+                                  _leg_with_holes(10, [7]), gap_policy='ffill')
+    assert len(out['timestamp']) == 10
+    np.testing.assert_array_equal(out[0]['close'][2:6], [3, 3, 3, 6])
+    np.testing.assert_array_equal(out[0]['quote_volume'][3:5], [0, 0])
+    assert out[0]['high'][3] == out[0]['low'][3] == 3
+    assert out[1]['close'][7] == out[1]['close'][6]
+    assert list(gaps['candles']) == [2, 1]
+
+    # سوراخ بلندتر از max_fill حذف می‌شود، سوراخ کوتاه پر می‌شود
+    out, _ = m.align_pair_legs(_leg_with_holes(10, [3, 4]),
+                               _leg_with_holes(10, [7]), gap_policy='ffill',
+                               max_fill=1)
+    assert len(out['timestamp']) == 9
+    assert 4 * 3600000 not in out['timestamp']
+
+
+def test_align_split_numbers_segments():
+    out, _ = m.align_pair_legs(_leg_with_holes(12, [3, 4]),
+                               _leg_with_holes(12, [8]), gap_policy='split')
+    np.testing.assert_array_equal(out['segment'],
+                                  [0, 0, 0, 1, 1, 1, 2, 2, 2])
+    drop, _ = m.align_pair_legs(_leg_with_holes(12, [3, 4]),
+                                _leg_with_holes(12, [8]), gap_policy='drop')
+    assert 'segment' not in drop
+    np.testing.assert_array_equal(drop['timestamp'], out['timestamp'])
+
+
+@pytest.fixture(scope='module')
+def segmented_data(price_data):
+    data = price_data.copy()
+    data['segment'] = np.repeat([0, 1, 2], [700, 800, 500])
+    return data
+
+
+def test_segmented_backtest_chains_segments(segmented_data):
+    result = m.run_backtest_segmented(segmented_data, 5)
+    capital = 10000
+    for lo, hi in ((0, 700), (700, 1500), (1500, 2000)):
+        part = m.run_backtest_with_rebalance(segmented_data.iloc[lo:hi], 5,
+                                             capital, metrics_only=True)
+        capital = part['final_total_value']
+    assert len(result['segments']) == 3
+    assert result['final_total_value'] == pytest.approx(capital)
+    assert result['rebalance_count'] == sum(
+        seg['rebalance_count'] for seg in result['segments'])
+
+
+def test_segmented_backtest_zero_hodl(segmented_data):
+    data = segmented_data.copy()
+    data.loc[data.index[-1], ['cake_usdt', 'bnb_usdt']] = 0.0
+    result = m.run_backtest_segmented(data, 5)
+    assert result['impermanent_loss'] == 0
+    assert result['vs_hodl'] == 0
+
+
+def test_run_batch_split_policy(segmented_data, tmp_path):
+    batch = m.run_batch(scenarios=[3, 10], workers=1,
+                        price_data=segmented_data,
+                        csv_path=str(tmp_path / 'split.csv'))
+    expected = m.run_backtest_segmented(segmented_data, 3)
+    assert batch['results'][3]['final_total_value'] == pytest.approx(
+        expected['final_total_value'])
+    assert 'segments' not in batch['summary'].columns
+    kernel = m.run_all_scenarios(segmented_data, [3], engine='kernel',
+                                 workers=1, metrics_only=True, verbose=False)
+    assert kernel[3]['segments']
+    with pytest.raises(ValueError, match='split'):
+        m.run_all_scenarios(segmented_data, [3], workers=1, verbose=False)
+
+
+# ─── خروج داخل کندل (intrabar) ───
+
+@pytest.fixture(scope='module')
+def minute_data():
+    return m.generate_synthetic_pair_data(60 * 300, seed=5, freq='min')
+
+
+def _hourly_from_minutes(fine):
+    hours = fine['timestamp'].dt.floor('h')
+    ratio = fine['cake_usdt'] / fine['bnb_usdt']
+    grouped = fine.assign(ratio=ratio).groupby(hours)
+    hourly = grouped.agg(cake_usdt=('cake_usdt', 'last'),
+                         bnb_usdt=('bnb_usdt', 'last'),
+                         close=('ratio', 'last'),
+                         ratio_low=('ratio', 'min'),
+                         ratio_high=('ratio', 'max'),
+                         quote_volume=('quote_volume', 'sum'))
+    return hourly.rename_axis('timestamp').reset_index()
+
+
+def test_intrabar_without_envelope_matches_close_only(price_data):
+    expected = m.run_backtest_with_rebalance(price_data, 3.5,
+                                             engine='vectorized',
+                                             metrics_only=True)
+    result = m.run_backtest_intrabar(price_data, 3.5)
+    assert result['intra_candle_rebalances'] == 0
+    for key, value in expected.items():
+        assert result[key] == value, key
+
+
+def test_intrabar_matches_minute_loop(minute_data):
+    hourly = _hourly_from_minutes(minute_data)
+    result = m.run_backtest_intrabar(
+        hourly, 1.5, fine_source=m.FrameCandleSource(minute_data))
+    close_only = m.run_backtest_intrabar(hourly[['timestamp', 'close',
+                                                 'cake_usdt', 'bnb_usdt',
+                                                 'quote_volume']], 1.5)
+    assert result['intra_candle_rebalances'] > 0
+    assert result['rebalance_count'] > close_only['rebalance_count']
+
+    # مرجع: حلقه دقیقه به دقیقه (پوزیشن روی close ساعت اول باز می‌شود)
+    cake = minute_data['cake_usdt'].to_numpy()
+    bnb = minute_data['bnb_usdt'].to_numpy()
+    ratio = cake / bnb
+    position = m.LiquidityPositionV3()
+    position.open_position(10000, hourly['close'][0], 1.5,
+                           hourly['cake_usdt'][0], hourly['bnb_usdt'][0])
+    rebalances = 0
+    slippage = 0.0
+    for price, cake_usdt, bnb_usdt in zip(ratio, cake, bnb):
+        if position.is_in_range(price):
+            continue
+        value = position.get_value_usd(price, cake_usdt, bnb_usdt)
+        slippage += value / 2 * 0.1 / 100
+        position.open_position(max(value - 0.30 - value / 2 * 0.1 / 100, 0),
+                               price, 1.5, cake_usdt, bnb_usdt)
+        rebalances += 1
+
+    assert result['rebalance_count'] == rebalances
+    assert result['periods_in_range'] == len(hourly)
+    assert result['total_slippage_costs'] == pytest.approx(slippage,
+                                                           rel=1e-12)
+    assert result['final_pool_value'] == pytest.approx(
+        position.get_value_usd(ratio[-1], cake[-1], bnb[-1]), rel=1e-12)
+
+
+def test_fine_source_records_gaps_and_merges(minute_data, tmp_path,
+                                             monkeypatch):
+    minute_ms = 60_000
+    legs = {}
+    for symbol, column in (('CAKEUSDT', 'cake_usdt'), ('BNBUSDT', 'bnb_usdt')):
+        arr = np.zeros(180, dtype=m.KLINE_DTYPE)
+        arr['timestamp'] = minute_data['timestamp'][:180].astype(
+            'datetime64[ms]').astype(np.int64)
+        arr['close'] = minute_data[column][:180]
+        legs[symbol] = arr
+    # سوراخ صرافی: دقیقه‌های 10..19 و انتهای ساعت اول (55..59)
+    holes = np.r_[10:20, 55:60]
+    legs['CAKEUSDT'] = np.delete(legs['CAKEUSDT'], holes)
+    fetched = []
+
+    def fake_download(windows_by_symbol, interval='1h', **kwargs):
+        fetched.append(windows_by_symbol)
+        out = {}
+        for symbol, windows in windows_by_symbol.items():
+            ts = legs[symbol]['timestamp']
+            mask = np.zeros(len(ts), dtype=bool)
+            for lo, hi in windows:
+                mask |= (ts >= lo) & (ts <= hi)
+            out[symbol] = legs[symbol][mask]
+        return out
+
+    monkeypatch.setattr(m, '_download_windows', fake_download)
+    t0 = int(legs['BNBUSDT']['timestamp'][0])
+    hour_ms = 60 * minute_ms
+
+    source = m.FineCandleSource(cache_dir=str(tmp_path), merge_rows=1)
+    cake, bnb = source.candles(t0, t0 + hour_ms)
+    assert len(cake) == len(bnb) == 45
+    assert source.requests == 2
+    cache = m.KlineCache(str(tmp_path))
+    # ادغام تدریجی: قبل از flush در کش است
+    assert len(cache.load('CAKEUSDT', '1m')) == 45
+    assert cache.known_gaps('CAKEUSDT', '1m') == [
+        (t0 + 10 * minute_ms, t0 + 19 * minute_ms),
+        (t0 + 55 * minute_ms, t0 + 59 * minute_ms),
+    ]
+    assert cache.missing_ranges('CAKEUSDT', '1m', t0,
+                                t0 + hour_ms - minute_ms) == []
+
+    # اجرای بعد: سوراخ‌های شناخته‌شده دوباره درخواست نمی‌شوند
+    fetched.clear()
+    again = m.FineCandleSource(cache_dir=str(tmp_path))
+    cake, _ = again.candles(t0, t0 + hour_ms)
+    assert len(cake) == 45
+    assert again.requests == 0 and fetched == []
+
+    # ساعت بعد فقط همان بازه کم درخواست می‌شود
+    again.candles(t0 + hour_ms, t0 + 2 * hour_ms)
+    assert fetched == [{symbol: [(t0 + hour_ms, t0 + 2 * hour_ms - minute_ms)]
+                        for symbol in ('CAKEUSDT', 'BNBUSDT')}]
+    again.flush()
+    assert len(cache.load('BNBUSDT', '1m')) == 120
+
+
+# ─── اجرای بدون رابط (batch) ───
+
+def test_run_batch_is_headless(price_data, tmp_path, capsys):
+    m.plt.close('all')
+    csv_path = tmp_path / 'results.csv'
+    batch = m.run_batch(scenarios=[3, 10], workers=1, price_data=price_data,
+                        csv_path=str(csv_path))
+    assert capsys.readouterr().out == ''
+    assert m.plt.get_fignums() == []
+    assert batch['files'] == [str(csv_path)]
+    table = pd.read_csv(csv_path, encoding='utf-8-sig')
+    assert len(table) == 2
+    assert list(batch['summary']['range_percent']) == [3, 10]
+    assert batch['best_range'] == max(
+        batch['results'], key=lambda r: batch['results'][r]['total_return'])
+    assert not set(m._HISTORY_KEYS) & set(batch['best'])
+
+
+# ─── بنچمارک ───
+
+def test_benchmark_suite_smoke(tmp_path):
+    stages = [s for s in m.BENCHMARK_STAGES if s != 'charts']
+    baseline = str(tmp_path / 'baseline.json')
+    kwargs = dict(sizes=(200,), stages=stages, repeats=1, scenarios=[3, 10],
+                  memory=False, baseline_path=baseline, verbose=False)
+    bench, comparison = m.run_benchmark_suite(**kwargs)
+    assert comparison is None
+    assert list(bench['stage']) == stages
+    assert (bench['rows'] == 200).all()
+    assert (bench['seconds'] > 0).all() and bench['peak_mb'].isna().all()
+
+    bench, comparison = m.run_benchmark_suite(**kwargs)
+    assert list(comparison['stage']) == stages
+    assert comparison['ratio'].notna().all()
+
+    with pytest.raises(ValueError, match='ناشناخته'):
+        m.run_benchmark_suite(stages=['nope'], verbose=False)
+
+
+# ─── مونت‌کارلو ───
+
+@pytest.mark.parametrize('method', ['bootstrap', 'gbm'])
+def test_simulated_paths_seeded_shape_and_start(price_data, method):
+    paths = m.simulate_price_paths(price_data, 8, n_steps=100, method=method,
+                                   seed=3)
+    again = m.simulate_price_paths(price_data, 8, n_steps=100, method=method,
+                                   seed=3)
+    other = m.simulate_price_paths(price_data, 8, n_steps=100, method=method,
+                                   seed=4)
+    for key in ('close', 'cake_usdt', 'bnb_usdt', 'quote_volume'):
+        assert paths[key].shape == (8, 100)
+        np.testing.assert_array_equal(paths[key], again[key])
+    assert not np.array_equal(paths['close'], other['close'])
+    first = price_data.iloc[0]
+    np.testing.assert_allclose(paths['cake_usdt'][:, 0], first['cake_usdt'])
+    np.testing.assert_allclose(paths['bnb_usdt'][:, 0], first['bnb_usdt'])
+    np.testing.assert_allclose(paths['close'][:, 0],
+                               first['cake_usdt'] / first['bnb_usdt'])
+
+
+def test_bootstrap_keeps_historical_blocks(price_data):
+    block = 12
+    paths = m.simulate_price_paths(price_data, 5, n_steps=61, block_size=block,
+                                   seed=1)
+    history = np.diff(np.log(price_data['cake_usdt'].to_numpy()))
+    steps = np.diff(np.log(paths['cake_usdt']), axis=1)
+    for path in steps:
+        for lo in range(0, len(path), block):
+            chunk = path[lo:lo + block]
+            start = int(np.argmin(np.abs(history - chunk[0])))
+            expected = np.take(history, start + np.arange(len(chunk)),
+                               mode='wrap')
+            np.testing.assert_allclose(chunk, expected, atol=1e-12)
+
+
+def test_run_monte_carlo_is_seeded(price_data):
+    kwargs = dict(scenarios=[3, 10], n_paths=6, n_steps=200, batch_size=4,
+                  workers=1, seed=9, verbose=False)
+    summary, dist = m.run_monte_carlo(price_data, **kwargs)
+    again, _ = m.run_monte_carlo(price_data, **kwargs)
+    pd.testing.assert_frame_equal(summary, again)
+    assert list(summary['range_percent']) == [3, 10]
+    assert dist[3]['total_return'].shape == (6,)
+
+
+# ─── کش نتایج بک‌تست ───
+
+def test_backtest_cache_returns_same_result(price_data, tmp_path):
+    cache = m.BacktestCache(disk_dir=str(tmp_path))
+    expected = m.run_backtest_with_rebalance(price_data, 5,
+                                             engine='vectorized',
+                                             metrics_only=True)
+    assert cache.run(price_data, 5, metrics_only=True) == expected
+    assert m.BacktestCache(disk_dir=str(tmp_path)).run(
+        price_data, 5, metrics_only=True) == expected
+    assert cache.stats()['misses'] == 1
+
+
+def test_backtest_cache_evicts_from_index(tmp_path, monkeypatch):
+    result = {'payload': np.zeros(500)}
+    cache = m.BacktestCache(max_entries=0, disk_dir=str(tmp_path),
+                            max_disk_bytes=10_000)
+    cache.put('a', result)
+    size = cache.stats()['disk_bytes']
+    cache.max_disk_bytes = 2 * size
+
+    def no_scan(path):
+        raise AssertionError('put must not rescan the cache directory')
+
+    monkeypatch.setattr(m.os, 'scandir', no_scan)
+    cache.put('b', result)
+    assert cache.get('a') is not None    # hit دیسک → a تازه‌ترین
+    cache.put('c', result)
+    monkeypatch.undo()
+
+    assert sorted(p.name for p in tmp_path.glob('*.pkl')) == ['a.pkl',
+                                                              'c.pkl']
+    stats = cache.stats()
+    assert (stats['disk_entries'], stats['disk_bytes'],
+            stats['evictions']) == (2, 2 * size, 1)
+
+
+def test_backtest_cache_expiry_and_missing_files(tmp_path):
+    cache = m.BacktestCache(disk_dir=str(tmp_path))
+    cache.put('old_1', {'x': 1})
+    cache.put('new_1', {'x': 2})
+    stale = m.time_module.time() - 40 * 86400
+    m.os.utime(tmp_path / 'old_1.pkl', (stale, stale))
+
+    reopened = m.BacktestCache(disk_dir=str(tmp_path), max_age_days=30)
+    assert not (tmp_path / 'old_1.pkl').exists()
+    assert reopened.stats()['disk_entries'] == 1
+
+    # فایل حذف‌شده توسط پروسس دیگر → بدون خطا
+    (tmp_path / 'new_1.pkl').unlink()
+    assert reopened.invalidate(fingerprint='new') == 0
+    reopened.max_disk_bytes = 0
+    reopened._evict_disk()
+    assert reopened.stats()['disk_entries'] == 0
+
+
+# ─── معیارهای pipeline ───
+
+@pytest.fixture
+def metrics():
+    m.METRICS.reset()
+    m.METRICS.enable()
+    yield m.METRICS
+    m.METRICS.disable()
+    m.METRICS.reset()
+
+
+def test_metrics_export_formats(tmp_path):
+    metrics = m.PipelineMetrics(enabled=True)
+    metrics.observe('backtest', 0.5, 'vectorized')
+    metrics.observe('backtest', 1.5, 'vectorized', failed=True)
+    metrics.observe('chart', 0.25, 'a"b')
+    metrics.count('rebalances', 3)
+    json_path, prom_path = tmp_path / 'm.json', tmp_path / 'm.prom'
+    assert m.export_metrics(str(json_path), str(prom_path),
+                            metrics=metrics) == [str(json_path),
+                                                 str(prom_path)]
+
+    snapshot = json.loads(json_path.read_text(encoding='utf-8'))
+    backtest = snapshot['stages']['backtest']
+    assert (backtest['count'], backtest['total_s'], backtest['min_s'],
+            backtest['max_s'], backtest['failures']) == (2, 2.0, 0.5, 1.5, 1)
+    assert backtest['items']['vectorized']['mean_s'] == 1.0
+    assert snapshot['counters'] == {'rebalances': 3}
+
+    prefix = m.METRICS_PREFIX
+    lines = prom_path.read_text(encoding='utf-8').splitlines()
+    sample = re.compile(rf'^{prefix}_\w+(\{{.*\}})? \S+$')
+    assert all(line.startswith('# ') or sample.match(line) for line in lines)
+    label = '{stage="backtest",item="vectorized"}'
+    assert f'{prefix}_stage_seconds_sum{label} 2.0' in lines
+    assert f'{prefix}_stage_seconds_count{label} 2' in lines
+    assert f'{prefix}_stage_seconds_max{label} 1.5' in lines
+    assert f'{prefix}_stage_failures_total{label} 1' in lines
+    assert f'{prefix}_stage_seconds_count{{stage="chart",item="a\\"b"}} 1' \
+        in lines
+    assert f'{prefix}_events_total{{event="rebalances"}} 3' in lines
+    assert f'# TYPE {prefix}_stage_seconds summary' in lines
+
+
+def test_metrics_drain_and_merge(metrics):
+    worker = m.PipelineMetrics(enabled=True)
+    worker.observe('backtest_scenario', 2.0, 3)
+    worker.count('rebalances', 4)
+    delta = worker.drain()
+    assert worker.snapshot()['counters'] == {}
+    metrics.observe('backtest_scenario', 1.0, 3)
+    metrics.merge(delta)
+    metrics.merge(delta)
+    assert metrics.timers[('backtest_scenario', '3')] == [3, 5.0, 1.0, 2.0, 0]
+    assert metrics.counters == {'rebalances': 8}
+    assert m.PipelineMetrics().drain() is None
+
+
+@pytest.mark.skipif('fork' not in m.mp.get_all_start_methods(),
+                    reason='monkeypatch only reaches forked workers')
+def test_worker_metrics_reach_parent(price_data, metrics, monkeypatch):
+    backtest = m.run_backtest_with_rebalance
+
+    def counted(*args, **kwargs):
+        m.METRICS.count('probe')
+        return backtest(*args, **kwargs)
+
+    monkeypatch.setattr(m, 'run_backtest_with_rebalance', counted)
+    m.run_all_scenarios(price_data, [3, 10], engine='vectorized', workers=2,
+                        metrics_only=True, verbose=False)
+    assert metrics.counters['probe'] == 2
+    assert metrics.counters['rows_backtested'] == 2 * len(price_data)
+    assert metrics.timers[('backtest_scenario', '10')][0] == 1
+
+
+def test_cached_scenarios_record_backtest_stage(price_data, metrics,
+                                                tmp_path):
+    cache = m.BacktestCache(disk_dir=str(tmp_path))
+    first = m.run_all_scenarios(price_data, [3, 10], workers=1,
+                                metrics_only=True, cache=cache,
+                                verbose=False)
+    m.run_all_scenarios(price_data, [3, 10], workers=1, metrics_only=True,
+                        cache=cache, verbose=False)
+    assert metrics.timers[('backtest', 'loop')][0] == 2
+    assert metrics.counters['rebalances'] == sum(
+        r['rebalance_count'] for r in first.values())
+    assert metrics.counters['rows_backtested'] == 2 * len(price_data)
+
+
+# ─── نمودارها ───
+
+def test_chart_series_decimated_to_subplot_width():
+    # یک سال کندل ساعتی در یکی از subplot های شبکه 2×3 نمودار ۱
+    fig, axes = m.plt.subplots(2, 3, figsize=(20, 13))
+    columns = m._axes_pixel_columns(axes[0, 0], 300)
+    m.plt.close(fig)
+    assert columns < 20 * 300 / 3
+
+    y = np.random.default_rng(0).normal(size=8760).cumsum()
+    x = np.arange(len(y))
+    dx, dy = m._decimate_minmax(x, y, columns)
+    assert len(dy) <= 2 * columns + 2 < len(y)
+    assert (dx[0], dx[-1]) == (0, len(y) - 1)
+    assert dy.min() == y.min() and dy.max() == y.max()